@@ -35,6 +35,9 @@
 #include <Python.h>
 #include <numpy/arrayobject.h>
 #include "lapack_wrapper.h"
+#ifdef _OPENMP
+#include <omp.h>
+#endif
 
 /* #define ALL_ELEMENTS */
 #ifdef ALL_ELEMENTS
@@ -47,6 +50,7 @@
 
 static PyObject * py_phonopy_pinv_mt(PyObject *self, PyObject *args);
 static PyObject * py_displacement_matrix_fc4(PyObject *self, PyObject *args);
+static PyObject * py_set_num_threads(PyObject *self, PyObject *args);
 void get_tensor1(double sym_u[9], const double *u, const double *sym);
 int set_tensor2(double *disp_matrix, const double u[9]);
 int set_tensor3(double *disp_matrix, const double u[9]);
@@ -54,6 +58,7 @@ int set_tensor3(double *disp_matrix, const double u[9]);
 static PyMethodDef functions[] = {
   {"pinv_mt", py_phonopy_pinv_mt, METH_VARARGS, "Multi-threading pseudo-inverse using Lapack dgesvd"},
   {"displacement_matrix_fc4", py_displacement_matrix_fc4, METH_VARARGS, "Create displacement matrix for fc4"},
+  {"set_num_threads", py_set_num_threads, METH_VARARGS, "Set number of OpenMP threads"},
   {NULL, NULL, 0, NULL}
 };
 
@@ -102,6 +107,21 @@ static PyObject * py_phonopy_pinv_mt(PyObject *self, PyObject *args)
   Py_RETURN_NONE;
 }
 
+static PyObject * py_set_num_threads(PyObject *self, PyObject *args)
+{
+  int num_threads;
+
+  if (!PyArg_ParseTuple(args, "i", &num_threads)) {
+    return NULL;
+  }
+
+#ifdef _OPENMP
+  omp_set_num_threads(num_threads);
+#endif
+
+  Py_RETURN_NONE;
+}
+
 static PyObject * py_displacement_matrix_fc4(PyObject *self, PyObject *args)
 {
   PyArrayObject* disp_matrix_py;
@@ -48,7 +48,9 @@ static PyObject * py_real_to_reciprocal4(PyObject *self, PyObject *args);
 static PyObject * py_reciprocal_to_normal4(PyObject *self, PyObject *args);
 static PyObject * py_set_phonons_grid_points(PyObject *self, PyObject *args);
 static PyObject * py_distribute_fc4(PyObject *self, PyObject *args);
+static PyObject * py_distribute_fc4_atoms(PyObject *self, PyObject *args);
 static PyObject * py_rotate_delta_fc3s_elem(PyObject *self, PyObject *args);
+static PyObject * py_solve_fc4(PyObject *self, PyObject *args);
 static PyObject * py_set_translational_invariance_fc4(PyObject *self,
 						      PyObject *args);
 static PyObject * py_set_permutation_symmetry_fc4(PyObject *self,
@@ -62,7 +64,9 @@ static PyMethodDef functions[] = {
   {"reciprocal_to_normal4", py_reciprocal_to_normal4, METH_VARARGS, "Transform fc4 of reciprocal space to normal coordinate in special case for frequency shift"},
   {"phonons_grid_points", py_set_phonons_grid_points, METH_VARARGS, "Set phonons on grid points"},
   {"distribute_fc4", py_distribute_fc4, METH_VARARGS, "Distribute least fc4 to full fc4"},
+  {"distribute_fc4_atoms", py_distribute_fc4_atoms, METH_VARARGS, "Distribute least fc4 to full fc4 for all atoms at once"},
   {"rotate_delta_fc3s_elem", py_rotate_delta_fc3s_elem, METH_VARARGS, "Rotate delta fc3s for a set of atomic indices"},
+  {"solve_fc4", py_solve_fc4, METH_VARARGS, "Solve fc4 of first atom from rotated delta fc3s of all atomic triplets"},
   {"translational_invariance_fc4", py_set_translational_invariance_fc4, METH_VARARGS, "Set translational invariance for fc4"},
   {"permutation_symmetry_fc4", py_set_permutation_symmetry_fc4, METH_VARARGS, "Set permutation symmetry for fc4"},
   {"drift_fc4", py_get_drift_fc4, METH_VARARGS, "Get drifts of fc4"},
@@ -89,12 +93,13 @@ static PyObject * py_get_fc4_normal_for_frequency_shift(PyObject *self,
   PyArrayObject* multiplicity_py;
   PyArrayObject* masses_py;
   PyArrayObject* p2s_map_py;
-  PyArrayObject* s2p_map_py;
+  PyArrayObject* orbit_offsets_py;
+  PyArrayObject* orbit_atoms_py;
   PyArrayObject* band_indicies_py;
   double cutoff_frequency;
   int grid_point0;
 
-  if (!PyArg_ParseTuple(args, "OOOiOOOOOOOOOOd",
+  if (!PyArg_ParseTuple(args, "OOOiOOOOOOOOOOOd",
 			&fc4_normal_py,
 			&frequencies_py,
 			&eigenvectors_py,
@@ -107,7 +112,8 @@ static PyObject * py_get_fc4_normal_for_frequency_shift(PyObject *self,
 			&multiplicity_py,
 			&masses_py,
 			&p2s_map_py,
-			&s2p_map_py,
+			&orbit_offsets_py,
+			&orbit_atoms_py,
 			&band_indicies_py,
 			&cutoff_frequency)) {
     return NULL;
@@ -127,7 +133,8 @@ static PyObject * py_get_fc4_normal_for_frequency_shift(PyObject *self,
   Iarray* multi = convert_to_iarray(multiplicity_py);
   const double* masses = (double*)masses_py->data;
   const int* p2s = (int*)p2s_map_py->data;
-  const int* s2p = (int*)s2p_map_py->data;
+  const int* orbit_offsets = (int*)orbit_offsets_py->data;
+  const int* orbit_atoms = (int*)orbit_atoms_py->data;
   Iarray* band_indicies = convert_to_iarray(band_indicies_py);
 
   get_fc4_normal_for_frequency_shift(fc4_normal,
@@ -142,7 +149,8 @@ static PyObject * py_get_fc4_normal_for_frequency_shift(PyObject *self,
 				     multi,
 				     masses,
 				     p2s,
-				     s2p,
+				     orbit_offsets,
+				     orbit_atoms,
 				     band_indicies,
 				     cutoff_frequency);
 
@@ -160,15 +168,17 @@ static PyObject * py_get_fc4_frequency_shifts(PyObject *self, PyObject *args)
   PyArrayObject* fc4_normal_py;
   PyArrayObject* frequencies_py;
   PyArrayObject* grid_points1_py;
+  PyArrayObject* weights_py;
   PyArrayObject* temperatures_py;
   PyArrayObject* band_indicies_py;
   double unit_conversion_factor;
 
-  if (!PyArg_ParseTuple(args, "OOOOOOd",
+  if (!PyArg_ParseTuple(args, "OOOOOOOd",
 			&frequency_shifts_py,
 			&fc4_normal_py,
 			&frequencies_py,
 			&grid_points1_py,
+			&weights_py,
 			&temperatures_py,
 			&band_indicies_py,
 			&unit_conversion_factor)) {
@@ -179,6 +189,7 @@ static PyObject * py_get_fc4_frequency_shifts(PyObject *self, PyObject *args)
   double* fc4_normal = (double*)fc4_normal_py->data;
   double* freqs = (double*)frequencies_py->data;
   Iarray* grid_points1 = convert_to_iarray(grid_points1_py);
+  int* weights = (int*)weights_py->data;
   Darray* temperatures = convert_to_darray(temperatures_py);
   int* band_indicies = (int*)band_indicies_py->data;
   const int num_band0 = (int)band_indicies_py->dimensions[0];
@@ -188,6 +199,7 @@ static PyObject * py_get_fc4_frequency_shifts(PyObject *self, PyObject *args)
 			   fc4_normal,
 			   freqs,
 			   grid_points1,
+			   weights,
 			   temperatures,
 			   band_indicies,
 			   num_band0,
@@ -208,16 +220,18 @@ static PyObject * py_real_to_reciprocal4(PyObject *self, PyObject *args)
   PyArrayObject* shortest_vectors;
   PyArrayObject* multiplicity;
   PyArrayObject* p2s_map;
-  PyArrayObject* s2p_map;
+  PyArrayObject* orbit_offsets_py;
+  PyArrayObject* orbit_atoms_py;
 
-  if (!PyArg_ParseTuple(args, "OOOOOOO",
+  if (!PyArg_ParseTuple(args, "OOOOOOOO",
 			&fc4_reciprocal_py,
 			&fc4_py,
 			&q_py,
 			&shortest_vectors,
 			&multiplicity,
 			&p2s_map,
-			&s2p_map)) {
+			&orbit_offsets_py,
+			&orbit_atoms_py)) {
     return NULL;
   }
 
@@ -227,7 +241,8 @@ static PyObject * py_real_to_reciprocal4(PyObject *self, PyObject *args)
   Darray* svecs = convert_to_darray(shortest_vectors);
   Iarray* multi = convert_to_iarray(multiplicity);
   const int* p2s = (int*)p2s_map->data;
-  const int* s2p = (int*)s2p_map->data;
+  const int* orbit_offsets = (int*)orbit_offsets_py->data;
+  const int* orbit_atoms = (int*)orbit_atoms_py->data;
   const double* q = (double*)q_py->data;
 
   real_to_reciprocal4(fc4_reciprocal,
@@ -236,7 +251,8 @@ static PyObject * py_real_to_reciprocal4(PyObject *self, PyObject *args)
 		      svecs,
 		      multi,
 		      p2s,
-		      s2p);
+		      orbit_offsets,
+		      orbit_atoms);
 
   free(svecs);
   free(multi);
@@ -434,6 +450,40 @@ static PyObject * py_distribute_fc4(PyObject *self, PyObject *args)
 					      rot_cart_inv));
 }
 
+static PyObject * py_distribute_fc4_atoms(PyObject *self, PyObject *args)
+{
+  PyArrayObject* fc4_copy_py;
+  PyArrayObject* fc4_py;
+  PyArrayObject* atoms_py;
+  PyArrayObject* atom_mappings_py;
+  PyArrayObject* rotations_cart_inv_py;
+
+  if (!PyArg_ParseTuple(args, "OOOOO",
+			&fc4_copy_py,
+			&fc4_py,
+			&atoms_py,
+			&atom_mappings_py,
+			&rotations_cart_inv_py)) {
+    return NULL;
+  }
+
+  double* fc4_copy = (double*)fc4_copy_py->data;
+  const double* fc4 = (double*)fc4_py->data;
+  const int* atoms = (int*)atoms_py->data;
+  const int num_atoms = (int)atoms_py->dimensions[0];
+  const int* atom_mappings = (int*)atom_mappings_py->data;
+  const double* rot_carts_inv = (double*)rotations_cart_inv_py->data;
+  const int num_atom = (int)fc4_py->dimensions[0];
+
+  return PyInt_FromLong((long) distribute_fc4_atoms(fc4_copy,
+						    fc4,
+						    atoms,
+						    num_atoms,
+						    atom_mappings,
+						    rot_carts_inv,
+						    num_atom));
+}
+
 static PyObject * py_rotate_delta_fc3s_elem(PyObject *self, PyObject *args)
 {
   PyArrayObject* rotated_delta_fc3s_py;
@@ -473,6 +523,45 @@ static PyObject * py_rotate_delta_fc3s_elem(PyObject *self, PyObject *args)
 						      num_atom));
 }
 
+static PyObject * py_solve_fc4(PyObject *self, PyObject *args)
+{
+  PyArrayObject* fc4_py;
+  PyArrayObject* delta_fc3s_py;
+  PyArrayObject* atom_mappings_of_rotations_py;
+  PyArrayObject* site_symmetries_cartesian_py;
+  PyArrayObject* inv_U_py;
+  int first_atom;
+
+  if (!PyArg_ParseTuple(args, "OiOOOO",
+			&fc4_py,
+			&first_atom,
+			&delta_fc3s_py,
+			&atom_mappings_of_rotations_py,
+			&site_symmetries_cartesian_py,
+			&inv_U_py)) {
+    return NULL;
+  }
+
+  double* fc4 = (double*)fc4_py->data;
+  const double* delta_fc3s = (double*)delta_fc3s_py->data;
+  const int* rot_map_syms = (int*)atom_mappings_of_rotations_py->data;
+  const double* site_syms_cart = (double*)site_symmetries_cartesian_py->data;
+  const double* inv_U = (double*)inv_U_py->data;
+  const int num_rot = (int)site_symmetries_cartesian_py->dimensions[0];
+  const int num_delta_fc3s = (int)delta_fc3s_py->dimensions[0];
+  const int num_atom = (int)delta_fc3s_py->dimensions[1];
+
+  return PyInt_FromLong((long) solve_fc4(fc4,
+					 first_atom,
+					 delta_fc3s,
+					 rot_map_syms,
+					 site_syms_cart,
+					 inv_U,
+					 num_rot,
+					 num_delta_fc3s,
+					 num_atom));
+}
+
 static PyObject * py_set_translational_invariance_fc4(PyObject *self,
 						      PyObject *args)
 {
@@ -488,9 +577,11 @@ static PyObject * py_set_translational_invariance_fc4(PyObject *self,
   double* fc4 = (double*)fc4_py->data;
   const int num_atom = (int)fc4_py->dimensions[0];
 
-  set_translational_invariance_fc4_per_index(fc4, num_atom, index);
+  double drift;
 
-  Py_RETURN_NONE;
+  drift = set_translational_invariance_fc4_per_index(fc4, num_atom, index);
+
+  return PyFloat_FromDouble(drift);
 }
 
 static PyObject * py_set_permutation_symmetry_fc4(PyObject *self, PyObject *args)
@@ -505,9 +596,11 @@ static PyObject * py_set_permutation_symmetry_fc4(PyObject *self, PyObject *args
   double* fc4 = (double*)fc4_py->data;
   const int num_atom = (int)fc4_py->dimensions[0];
 
-  set_permutation_symmetry_fc4(fc4, num_atom);
+  double drift;
 
-  Py_RETURN_NONE;
+  drift = set_permutation_symmetry_fc4(fc4, num_atom);
+
+  return PyFloat_FromDouble(drift);
 }
 
 static PyObject * py_get_drift_fc4(PyObject *self, PyObject *args)
@@ -37,6 +37,8 @@
 #include <phonon3_h/fc3.h>
 #include <phonon4_h/fc4.h>
 
+#define DISTRIBUTE_FC4_BLOCK_SIZE 8
+
 static void tensor4_roation(double *rot_tensor,
 			    const double *fc4,
 			    const int atom_i,
@@ -55,13 +57,13 @@ static double tensor4_rotation_elem(const double tensor[81],
 				    const int n,
 				    const int p,
 				    const int q);
-static double get_drift_fc4_elem(const double *fc4,
+static void tensor4_rotation_by_index(double *rot_tensor,
+				      const double *tensor,
+				      const double *r);
+static double sum_fc4_over_index(double *fc4,
 				 const int num_atom,
-				 const int i,
-				 const int j,
-				 const int k,
-				 const int l,
-				 const int index);
+				 const int index,
+				 const int is_subtract);
 static void copy_permutation_symmetry_fc4_elem(double *fc4,
 					       const double fc4_elem[81],
 					       const int a,
@@ -76,6 +78,21 @@ static void set_permutation_symmetry_fc4_elem(double *fc4_elem,
 					      const int c,
 					      const int d,
 					      const int num_atom);
+static void add_drift_fc4_elem(double *drifts,
+			       const double fc4_elem[81],
+			       const int a,
+			       const int b,
+			       const int c,
+			       const int d,
+			       const int num_atom);
+
+static const int permutations4[24][4] = {
+  {0, 1, 2, 3}, {0, 1, 3, 2}, {0, 2, 1, 3}, {0, 2, 3, 1},
+  {0, 3, 1, 2}, {0, 3, 2, 1}, {1, 0, 2, 3}, {1, 0, 3, 2},
+  {1, 2, 0, 3}, {1, 2, 3, 0}, {1, 3, 0, 2}, {1, 3, 2, 0},
+  {2, 0, 1, 3}, {2, 0, 3, 1}, {2, 1, 0, 3}, {2, 1, 3, 0},
+  {2, 3, 0, 1}, {2, 3, 1, 0}, {3, 0, 1, 2}, {3, 0, 2, 1},
+  {3, 1, 0, 2}, {3, 1, 2, 0}, {3, 2, 0, 1}, {3, 2, 1, 0}};
 
 int rotate_delta_fc3s_elem(double *rotated_delta_fc3s,
 			   const double *delta_fc3s,
@@ -106,6 +123,58 @@ int rotate_delta_fc3s_elem(double *rotated_delta_fc3s,
   return 0;
 }
 
+/* fc4[first_atom, i, j, k] = inv_U . rotated delta fc3s[i, j, k] */
+/* for all (i, j, k). inv_U: [3, num_delta_fc3s * num_rot] */
+int solve_fc4(double *fc4,
+	      const int first_atom,
+	      const double *delta_fc3s,
+	      const int *rot_map_syms,
+	      const double *site_sym_cart,
+	      const double *inv_U,
+	      const int num_rot,
+	      const int num_delta_fc3s,
+	      const int num_atom)
+{
+  int i, j, k, l, num_rows, num_triplets;
+  double sum;
+  double *rotated_delta_fc3s, *fc4_elem;
+
+  num_rows = num_rot * num_delta_fc3s;
+  num_triplets = num_atom * num_atom * num_atom;
+
+#pragma omp parallel private(j, k, l, sum, rotated_delta_fc3s, fc4_elem)
+  {
+    rotated_delta_fc3s = (double*)malloc(sizeof(double) * num_rows * 27);
+
+#pragma omp for schedule(static)
+    for (i = 0; i < num_triplets; i++) {
+      rotate_delta_fc3s_elem(rotated_delta_fc3s,
+			     delta_fc3s,
+			     rot_map_syms,
+			     site_sym_cart,
+			     num_rot,
+			     num_delta_fc3s,
+			     i / (num_atom * num_atom),
+			     (i / num_atom) % num_atom,
+			     i % num_atom,
+			     num_atom);
+      fc4_elem = fc4 + ((long)first_atom * num_triplets + i) * 81;
+      for (j = 0; j < 3; j++) {
+	for (k = 0; k < 27; k++) {
+	  sum = 0;
+	  for (l = 0; l < num_rows; l++) {
+	    sum += inv_U[j * num_rows + l] * rotated_delta_fc3s[l * 27 + k];
+	  }
+	  fc4_elem[j * 27 + k] = sum;
+	}
+      }
+    }
+
+    free(rotated_delta_fc3s);
+  }
+
+  return 1;
+}
 
 int distribute_fc4(double *fc4_copy,
 		   const double *fc4,
@@ -152,6 +221,57 @@ int distribute_fc4(double *fc4_copy,
   return 1;
 }
 
+/* fc4_copy[i, j, k, l] = R fc4[map(i), map(j), map(k), map(l)] for i in */
+/* atoms with map and R of operation sending i to an irreducible atom. */
+/* (j, k) are tiled so that blocks of a thread are written contiguously. */
+int distribute_fc4_atoms(double *fc4_copy,
+			 const double *fc4,
+			 const int *atoms,
+			 const int num_atoms,
+			 const int *atom_mappings,
+			 const double *rot_carts,
+			 const int num_atom)
+{
+  int i, j, k, l, m, n, num_blocks, j_start, k_start, j_end, k_end;
+  long adrs, adrs_rot;
+  const int *atom_mapping;
+
+  num_blocks = (num_atom + DISTRIBUTE_FC4_BLOCK_SIZE - 1) /
+    DISTRIBUTE_FC4_BLOCK_SIZE;
+
+#pragma omp parallel for schedule(dynamic) private(i, j, k, l, m, j_start, k_start, j_end, k_end, adrs, adrs_rot, atom_mapping)
+  for (n = 0; n < num_atoms * num_blocks * num_blocks; n++) {
+    m = n / (num_blocks * num_blocks);
+    i = atoms[m];
+    atom_mapping = atom_mappings + m * num_atom;
+    j_start = (n / num_blocks) % num_blocks * DISTRIBUTE_FC4_BLOCK_SIZE;
+    k_start = n % num_blocks * DISTRIBUTE_FC4_BLOCK_SIZE;
+    j_end = j_start + DISTRIBUTE_FC4_BLOCK_SIZE;
+    k_end = k_start + DISTRIBUTE_FC4_BLOCK_SIZE;
+    if (j_end > num_atom) {
+      j_end = num_atom;
+    }
+    if (k_end > num_atom) {
+      k_end = num_atom;
+    }
+
+    for (j = j_start; j < j_end; j++) {
+      for (k = k_start; k < k_end; k++) {
+	for (l = 0; l < num_atom; l++) {
+	  adrs = (((long)i * num_atom + j) * num_atom + k) * num_atom + l;
+	  adrs_rot = (((long)atom_mapping[i] * num_atom + atom_mapping[j]) *
+		      num_atom + atom_mapping[k]) * num_atom + atom_mapping[l];
+	  tensor4_rotation_by_index(fc4_copy + adrs * 81,
+				    fc4 + adrs_rot * 81,
+				    rot_carts + m * 9);
+	}
+      }
+    }
+  }
+
+  return 1;
+}
+
 void set_translational_invariance_fc4(double *fc4,
 				      const int num_atom)
 {
@@ -162,70 +282,118 @@ void set_translational_invariance_fc4(double *fc4,
   }
 }
   
-void set_translational_invariance_fc4_per_index(double *fc4,
-						const int num_atom,
-						const int index)
+/* Returns the drift removed, i.e., the drift of fc4 before the call. */
+double set_translational_invariance_fc4_per_index(double *fc4,
+						  const int num_atom,
+						  const int index)
+{
+  return sum_fc4_over_index(fc4, num_atom, index, 1);
+}
+
+/* Each permutation orbit of atom quartets is visited once by its */
+/* representative i <= j <= k <= l. Orbits are disjoint, so (i, j) pairs */
+/* are distributed to threads dynamically for load balance. */
+/* The sums over the first atom index of the symmetrized fc4 are */
+/* accumulated in the same sweep. The element of largest absolute sum */
+/* (drift) is returned. The symmetrized fc4 has the same drift at all */
+/* four indices. */
+double set_permutation_symmetry_fc4(double *fc4, const int num_atom)
 {
-  int i, j, k, l, m;
+  double fc4_elem[81];
+  int i, j, k, l, n;
+  long m, num_drifts;
   double drift;
+  double *drifts;
 
-#pragma omp parallel for private(j, k, l, m, drift)
-  for (i = 0; i < 81; i++) {
-    for (j = 0; j < num_atom; j++) {
-      for (k = 0; k < num_atom; k++) {
-	for (l = 0; l < num_atom; l++) {
-	  drift =
-	    get_drift_fc4_elem(fc4, num_atom, i, j, k, l, index) / num_atom;
-	  for (m = 0; m < num_atom; m++) {
-	    switch (index) {
-	    case 0:
-	      fc4[m * num_atom * num_atom * num_atom * 81 +
-		  j * num_atom * num_atom * 81 +
-		  k * num_atom * 81 +
-		  l * 81 + i] -= drift;
-	      break;
-	    case 1:
-	      fc4[j * num_atom * num_atom * num_atom * 81 +
-		  m * num_atom * num_atom * 81 +
-		  k * num_atom * 81 +
-		  l * 81 + i] -= drift;
-	      break;
-	    case 2:
-	      fc4[j * num_atom * num_atom * num_atom * 81 +
-		  k * num_atom * num_atom * 81 +
-		  m * num_atom * 81 +			 
-		  l * 81 + i] -= drift;
-	      break;
-	    case 3:
-	      fc4[j * num_atom * num_atom * num_atom * 81 +
-		  k * num_atom * num_atom * 81 +
-		  l * num_atom * 81 +
-		  m * 81 + i] -= drift;
-	      break;
-	    }
-	  }
-	}
+  num_drifts = (long)num_atom * num_atom * num_atom * 81;
+  drifts = (double*)malloc(sizeof(double) * num_drifts);
+  for (m = 0; m < num_drifts; m++) {
+    drifts[m] = 0;
+  }
+
+#pragma omp parallel for schedule(dynamic) private(i, j, k, l, fc4_elem)
+  for (n = 0; n < num_atom * num_atom; n++) {
+    i = n / num_atom;
+    j = n % num_atom;
+    if (j < i) {
+      continue;
+    }
+    for (k = j; k < num_atom; k++) {
+      for (l = k; l < num_atom; l++) {
+	set_permutation_symmetry_fc4_elem(fc4_elem, fc4, i, j, k, l, num_atom);
+	copy_permutation_symmetry_fc4_elem(fc4, fc4_elem,
+					   i, j, k, l, num_atom);
+	add_drift_fc4_elem(drifts, fc4_elem, i, j, k, l, num_atom);
       }
     }
   }
+
+  drift = 0;
+  for (m = 0; m < num_drifts; m++) {
+    if (fabs(drift) < fabs(drifts[m])) {
+      drift = drifts[m];
+    }
+  }
+  free(drifts);
+  drifts = NULL;
+
+  return drift;
 }
 
-void set_permutation_symmetry_fc4(double *fc4, const int num_atom)
+/* fc4_elem is added to the sums at all distinct permutations of */
+/* (a, b, c, d). A permutation fixing (a, b, c, d) gives the same */
+/* position, so each addition is divided by the number of them. */
+static void add_drift_fc4_elem(double *drifts,
+			       const double fc4_elem[81],
+			       const int a,
+			       const int b,
+			       const int c,
+			       const int d,
+			       const int num_atom)
 {
-  double fc4_elem[81];
-  int i, j, k, l;
-
-#pragma omp parallel for private(j, k, l, fc4_elem)
-  for (i = 0; i < num_atom; i++) {
-    for (j = i; j < num_atom; j++) {
-      for (k = j; k < num_atom; k++) {
-	for (l = k; l < num_atom; l++) {
-	  set_permutation_symmetry_fc4_elem(fc4_elem, fc4, i, j, k, l, num_atom);
-	  copy_permutation_symmetry_fc4_elem(fc4, fc4_elem,
-					     i, j, k, l, num_atom);
-	}
+  int i, j, m, num_fixed;
+  int atoms[4], perm_atoms[4], x[4];
+  long address;
+  const int *perm;
+  const int weights[4] = {27, 9, 3, 1};
+
+  atoms[0] = a;
+  atoms[1] = b;
+  atoms[2] = c;
+  atoms[3] = d;
+
+  num_fixed = 0;
+  for (i = 0; i < 24; i++) {
+    for (j = 0; j < 4; j++) {
+      if (atoms[permutations4[i][j]] != atoms[j]) {
+	break;
       }
     }
+    if (j == 4) {
+      num_fixed++;
+    }
+  }
+
+  for (i = 0; i < 24; i++) {
+    perm = permutations4[i];
+    for (j = 0; j < 4; j++) {
+      perm_atoms[j] = atoms[perm[j]];
+    }
+    address = ((long)(perm_atoms[1] * num_atom + perm_atoms[2]) * num_atom +
+	       perm_atoms[3]) * 81;
+    /* fc4[perm_atoms][x[0], x[1], x[2], x[3]] = fc4_elem[y] with */
+    /* y[perm[j]] = x[j] */
+    for (m = 0; m < 81; m++) {
+      x[0] = m / 27;
+      x[1] = (m / 9) % 3;
+      x[2] = (m / 3) % 3;
+      x[3] = m % 3;
+#pragma omp atomic
+      drifts[address + m] += fc4_elem[x[0] * weights[perm[0]] +
+				      x[1] * weights[perm[1]] +
+				      x[2] * weights[perm[2]] +
+				      x[3] * weights[perm[3]]] / num_fixed;
+    }
   }
 }
 
@@ -489,83 +657,78 @@ static void set_permutation_symmetry_fc4_elem(double *fc4_elem,
 
 void get_drift_fc4(double *drifts_out, const double *fc4, const int num_atom)
 {
-  int i, j, k, l, index;
-  double drift;
-  double max_drift[81];
-  
+  int index;
 
   for (index = 0; index < 4; index++) {
-    for (i = 0; i < 81; i++) {
-      max_drift[i] = 0;
-    }
+    drifts_out[index] = sum_fc4_over_index((double*)fc4, num_atom, index, 0);
+  }
+}
 
-#pragma omp parallel for private(j, k, l, drift)
-    for (i = 0; i < 81; i++) {
-      for (j = 0; j < num_atom; j++) {
-	for (k = 0; k < num_atom; k++) {
-	  for (l = 0; l < num_atom; l++) {
-	    drift = get_drift_fc4_elem(fc4, num_atom, i, j, k, l, index);
-	    if (fabs(max_drift[i]) < fabs(drift)) {
-	      max_drift[i] = drift;
-	    }
+/* fc4 is viewed as [num_outer, num_atom, stride] with the atom index */
+/* summed in the middle. The sums of 81 elements are computed from */
+/* contiguous blocks and subtracted while the blocks are still in cache. */
+/* The element of largest absolute sum (drift) is returned. */
+static double sum_fc4_over_index(double *fc4,
+				 const int num_atom,
+				 const int index,
+				 const int is_subtract)
+{
+  int i, m;
+  long n, num_outer, num_blocks, stride;
+  double drift, drift_thread;
+  double sum[81];
+  double *block;
+
+  num_outer = 1;
+  for (i = 0; i < index; i++) {
+    num_outer *= num_atom;
+  }
+  stride = 81;
+  for (i = index + 1; i < 4; i++) {
+    stride *= num_atom;
+  }
+  num_blocks = num_outer * (stride / 81);
+
+  drift = 0;
+#pragma omp parallel private(i, m, n, sum, block, drift_thread)
+  {
+    drift_thread = 0;
+#pragma omp for
+    for (n = 0; n < num_blocks; n++) {
+      block = fc4 + (n / (stride / 81)) * num_atom * stride +
+	(n % (stride / 81)) * 81;
+      for (i = 0; i < 81; i++) {
+	sum[i] = 0;
+      }
+      for (m = 0; m < num_atom; m++) {
+	for (i = 0; i < 81; i++) {
+	  sum[i] += block[m * stride + i];
+	}
+      }
+      for (i = 0; i < 81; i++) {
+	if (fabs(drift_thread) < fabs(sum[i])) {
+	  drift_thread = sum[i];
+	}
+      }
+      if (is_subtract) {
+	for (m = 0; m < num_atom; m++) {
+	  for (i = 0; i < 81; i++) {
+	    block[m * stride + i] -= sum[i] / num_atom;
 	  }
 	}
       }
     }
-
-    drift = 0;
-    for (i = 0; i < 81; i++) {
-      if (fabs(drift) < fabs(max_drift[i])) {
-	drift = max_drift[i];
+#pragma omp critical
+    {
+      if (fabs(drift) < fabs(drift_thread)) {
+	drift = drift_thread;
       }
     }
-    drifts_out[index] = drift;
   }
-}
 
-static double get_drift_fc4_elem(const double *fc4,
-				 const int num_atom,
-				 const int i,
-				 const int j,
-				 const int k,
-				 const int l,
-				 const int index)
-{
-  double sum;
-  int m;
-  
-  sum = 0;
-  for (m = 0; m < num_atom; m++) {
-    switch (index) {
-    case 0:
-      sum += fc4[m * num_atom * num_atom * num_atom * 81 +
-		 j * num_atom * num_atom * 81 +
-		 k * num_atom * 81 +
-		 l * 81 + i];
-      break;
-    case 1:
-      sum += fc4[j * num_atom * num_atom * num_atom * 81 +
-		 m * num_atom * num_atom * 81 +
-		 k * num_atom * 81 +
-		 l * 81 + i];
-      break;
-    case 2:
-      sum += fc4[j * num_atom * num_atom * num_atom * 81 +
-		 k * num_atom * num_atom * 81 +
-		 m * num_atom * 81 +			 
-		 l * 81 + i];
-      break;
-    case 3:
-      sum += fc4[j * num_atom * num_atom * num_atom * 81 +
-		 k * num_atom * num_atom * 81 +
-		 l * num_atom * 81 +
-		 m * 81 + i];
-      break;
-    }
-  }
-
-  return sum;
+  return drift;
 }
+
 static void tensor4_roation(double *rot_tensor,
 			    const double *fc4,
 			    const int atom_i,
@@ -633,3 +796,36 @@ static double tensor4_rotation_elem(const double tensor[81],
   return sum;
 }
 
+/* Indices are rotated one by one, 4 x 243 instead of 81 x 324 products. */
+static void tensor4_rotation_by_index(double *rot_tensor,
+				      const double *tensor,
+				      const double *r)
+{
+  int i, j, k, l, stride;
+  double sum;
+  double buf[2][81];
+  const double *src;
+  double *dst;
+
+  src = tensor;
+  stride = 1;
+  for (i = 0; i < 4; i++) {
+    if (i == 3) {
+      dst = rot_tensor;
+    } else {
+      dst = buf[i % 2];
+    }
+    for (j = 0; j < 81 / (3 * stride); j++) {
+      for (k = 0; k < 3; k++) {
+	for (l = 0; l < stride; l++) {
+	  sum = r[k * 3] * src[j * 3 * stride + l] +
+	    r[k * 3 + 1] * src[j * 3 * stride + stride + l] +
+	    r[k * 3 + 2] * src[j * 3 * stride + 2 * stride + l];
+	  dst[j * 3 * stride + k * stride + l] = sum;
+	}
+      }
+    }
+    src = dst;
+    stride *= 3;
+  }
+}
@@ -34,6 +34,7 @@
 
 #include <lapacke.h>
 #include <stdlib.h>
+#include <cblas.h>
 #include <phonoc_array.h>
 #include <phonoc_utils.h>
 #include <phonon4_h/frequency_shift.h>
@@ -47,21 +48,20 @@ static void get_fc4_normal_for_frequency_shift_at_gp
  const int grid_point1,
  const int *grid_address,
  const int *mesh,
- const double *fc4,
+ const lapack_complex_double *fc4_q,
  const Darray *shortest_vectors,
  const Iarray *multiplicity,
  const double *masses,
  const int *p2s_map,
- const int *s2p_map,
+ const int *orbit_offsets,
+ const int *orbit_atoms,
  const Iarray *band_indices,
  const double cutoff_frequency);
-static lapack_complex_double fc4_sum(const int bi0,
-				     const int bi1,
-				     const lapack_complex_double *eigvecs0,
-				     const lapack_complex_double *eigvecs1,
-				     const lapack_complex_double *fc4_reciprocal,
-				     const double *masses,
-				     const int num_atom);
+static void
+set_mass_weighted_fc4_reciprocal(lapack_complex_double *fc4_mass_weighted,
+				 const lapack_complex_double *fc4_reciprocal,
+				 const double *masses,
+				 const int num_atom);
 static int collect_undone_grid_points(int *undone,
 				      char *phonon_done,
 				      const int num_grid_points,
@@ -71,6 +71,7 @@ void get_fc4_frequency_shifts(double *frequency_shifts,
 			      const double *fc4_normal_real,
 			      const double *frequencies,
 			      const Iarray *grid_points1,
+			      const int *weights,
 			      const Darray *temperatures,
 			      const int *band_indicies,
 			      const int num_band0,
@@ -94,7 +95,7 @@ void get_fc4_frequency_shifts(double *frequency_shifts,
 	  } else {
 	    num_phonon = 1;
 	  }
-	  shift += unit_conversion_factor * fc4_normal_real
+	  shift += unit_conversion_factor * weights[k] * fc4_normal_real
 	    [k * num_band0 * num_band + j * num_band + l] * num_phonon;
 	}
       }
@@ -116,16 +117,40 @@ get_fc4_normal_for_frequency_shift(double *fc4_normal_real,
 				   const Iarray *multiplicity,
 				   const double *masses,
 				   const int *p2s_map,
-				   const int *s2p_map,
+				   const int *orbit_offsets,
+				   const int *orbit_atoms,
 				   const Iarray *band_indicies,
 				   const double cutoff_frequency)
 {
-  int i, num_atom, num_band, num_band0;
+  int i, num_atom, num_satom, num_band, num_band0;
+  lapack_complex_double *fc4_q;
+  double q[12];
 
+  num_satom = multiplicity->dims[0];
   num_atom = multiplicity->dims[1];
   num_band = num_atom * 3;
   num_band0 = band_indicies->dims[0];
 
+  /* The transform over the second atom depends only on q, so it is */
+  /* done once here and shared by all q' below. */
+  fc4_q = (lapack_complex_double*)
+    malloc(sizeof(lapack_complex_double) *
+	   num_atom * num_atom * num_satom * num_satom * 81);
+  for (i = 0; i < 3; i++) {
+    q[i + 3] = (double)grid_address[grid_point0 * 3 + i] / mesh[i];
+    q[i] = -q[i + 3];
+    q[i + 6] = 0;
+    q[i + 9] = 0;
+  }
+  real_to_reciprocal4_first_stage(fc4_q,
+				  q,
+				  fc4,
+				  shortest_vectors,
+				  multiplicity,
+				  p2s_map,
+				  orbit_offsets,
+				  orbit_atoms);
+
 #pragma omp parallel for private(i)
   for (i = 0; i < grid_points1->dims[0]; i++) {
     get_fc4_normal_for_frequency_shift_at_gp(fc4_normal_real +
@@ -136,15 +161,18 @@ get_fc4_normal_for_frequency_shift(double *fc4_normal_real,
 					     grid_points1->data[i],
 					     grid_address,
 					     mesh,
-					     fc4,
+					     fc4_q,
 					     shortest_vectors,
 					     multiplicity,
 					     masses,
 					     p2s_map,
-					     s2p_map,
+					     orbit_offsets,
+					     orbit_atoms,
 					     band_indicies,
 					     cutoff_frequency);
   }
+
+  free(fc4_q);
 }
 
 
@@ -200,6 +228,11 @@ void set_phonons_for_frequency_shift(Darray *frequencies,
   free(undone);
 }
 
+/* fc4_normal[num_band0, num_band] is obtained by contracting the */
+/* mass weighted fc4 matrix Phi[(i,m), (j,n), (k,p), (l,q)] in two stages: */
+/*   A[b0, (k,p), (l,q)] = sum e0*[(i,m), b0] e0[(j,n), b0] Phi  (zgemm) */
+/*   B[b0, (k,p), b1] = sum_(l,q) A e1*[(l,q), b1]                (zgemm) */
+/*   fc4_normal[b0, b1] = sum_(k,p) e1[(k,p), b1] B[b0, (k,p), b1] */
 void reciprocal_to_normal4(lapack_complex_double *fc4_normal,
 			   const lapack_complex_double *fc4_reciprocal,
 			   const double *freqs0,
@@ -212,36 +245,88 @@ void reciprocal_to_normal4(lapack_complex_double *fc4_normal,
 			   const int num_band,
 			   const double cutoff_frequency)
 {
-  int i, j, bi, num_atom;
-  lapack_complex_double fc4_sum_elem;
+  int i, j, k, bi, num_band_sq;
+  double sum_real, sum_imag;
+  lapack_complex_double one, zero, prod, eigvec_conj;
+  lapack_complex_double *fc4_mass_weighted, *eigvecs0_prod, *eigvecs1_conj;
+  lapack_complex_double *fc4_q0, *fc4_q0_q1;
+
+  num_band_sq = num_band * num_band;
+  one = lapack_make_complex_double(1, 0);
+  zero = lapack_make_complex_double(0, 0);
+
+  fc4_mass_weighted = (lapack_complex_double*)
+    malloc(sizeof(lapack_complex_double) * num_band_sq * num_band_sq);
+  eigvecs0_prod = (lapack_complex_double*)
+    malloc(sizeof(lapack_complex_double) * num_band0 * num_band_sq);
+  eigvecs1_conj = (lapack_complex_double*)
+    malloc(sizeof(lapack_complex_double) * num_band_sq);
+  fc4_q0 = (lapack_complex_double*)
+    malloc(sizeof(lapack_complex_double) * num_band0 * num_band_sq);
+  fc4_q0_q1 = (lapack_complex_double*)
+    malloc(sizeof(lapack_complex_double) * num_band0 * num_band_sq);
+
+  set_mass_weighted_fc4_reciprocal(fc4_mass_weighted,
+				   fc4_reciprocal,
+				   masses,
+				   num_band / 3);
+
+  for (i = 0; i < num_band0; i++) {
+    bi = band_indices[i];
+    for (j = 0; j < num_band; j++) {
+      eigvec_conj = lapack_make_complex_double
+	(lapack_complex_double_real(eigvecs0[j * num_band + bi]),
+	 -lapack_complex_double_imag(eigvecs0[j * num_band + bi]));
+      for (k = 0; k < num_band; k++) {
+	eigvecs0_prod[i * num_band_sq + j * num_band + k] =
+	  phonoc_complex_prod(eigvec_conj, eigvecs0[k * num_band + bi]);
+      }
+    }
+  }
 
-  num_atom = num_band / 3;
+  for (i = 0; i < num_band_sq; i++) {
+    eigvecs1_conj[i] = lapack_make_complex_double
+      (lapack_complex_double_real(eigvecs1[i]),
+       -lapack_complex_double_imag(eigvecs1[i]));
+  }
+
+  cblas_zgemm(CblasRowMajor, CblasNoTrans, CblasNoTrans,
+	      num_band0, num_band_sq, num_band_sq,
+	      &one, eigvecs0_prod, num_band_sq,
+	      fc4_mass_weighted, num_band_sq,
+	      &zero, fc4_q0, num_band_sq);
+  cblas_zgemm(CblasRowMajor, CblasNoTrans, CblasNoTrans,
+	      num_band0 * num_band, num_band, num_band,
+	      &one, fc4_q0, num_band,
+	      eigvecs1_conj, num_band,
+	      &zero, fc4_q0_q1, num_band);
 
   for (i = 0; i < num_band0; i++) {
     bi = band_indices[i];
-    if (freqs0[bi] > cutoff_frequency) {
-      for (j = 0; j < num_band; j++) {
-	if (freqs1[j] > cutoff_frequency) {
-	  fc4_sum_elem = fc4_sum(bi,
-				 j,
-				 eigvecs0,
-				 eigvecs1,
-				 fc4_reciprocal,
-				 masses,
-				 num_atom);
-	  fc4_normal[i * num_band + j] = lapack_make_complex_double
-	    (lapack_complex_double_real(fc4_sum_elem) / freqs0[bi] / freqs1[j],
-	     lapack_complex_double_imag(fc4_sum_elem) / freqs0[bi] / freqs1[j]);
-	} else {
-	  fc4_normal[i * num_band + j] = lapack_make_complex_double(0, 0);
+    for (j = 0; j < num_band; j++) {
+      if (freqs0[bi] > cutoff_frequency && freqs1[j] > cutoff_frequency) {
+	sum_real = 0;
+	sum_imag = 0;
+	for (k = 0; k < num_band; k++) {
+	  prod = phonoc_complex_prod
+	    (eigvecs1[k * num_band + j],
+	     fc4_q0_q1[i * num_band_sq + k * num_band + j]);
+	  sum_real += lapack_complex_double_real(prod);
+	  sum_imag += lapack_complex_double_imag(prod);
 	}
-      }
-    } else {
-      for (j = 0; j < num_band; j++) {
+	fc4_normal[i * num_band + j] = lapack_make_complex_double
+	  (sum_real / freqs0[bi] / freqs1[j], sum_imag / freqs0[bi] / freqs1[j]);
+      } else {
 	fc4_normal[i * num_band + j] = lapack_make_complex_double(0, 0);
       }
     }
   }
+
+  free(fc4_mass_weighted);
+  free(eigvecs0_prod);
+  free(eigvecs1_conj);
+  free(fc4_q0);
+  free(fc4_q0_q1);
 }
 
 static void get_fc4_normal_for_frequency_shift_at_gp
@@ -252,12 +337,13 @@ static void get_fc4_normal_for_frequency_shift_at_gp
  const int grid_point1,
  const int *grid_address,
  const int *mesh,
- const double *fc4,
+ const lapack_complex_double *fc4_q,
  const Darray *shortest_vectors,
  const Iarray *multiplicity,
  const double *masses,
  const int *p2s_map,
- const int *s2p_map,
+ const int *orbit_offsets,
+ const int *orbit_atoms,
  const Iarray *band_indices,
  const double cutoff_frequency)
 {
@@ -282,13 +368,14 @@ static void get_fc4_normal_for_frequency_shift_at_gp
     q[i + 9] = -q[i + 6];
   }
     
-  real_to_reciprocal4(fc4_reciprocal,
-		      q,
-		      fc4,
-		      shortest_vectors,
-		      multiplicity,
-		      p2s_map,
-		      s2p_map);
+  real_to_reciprocal4_second_stage(fc4_reciprocal,
+				   q,
+				   fc4_q,
+				   shortest_vectors,
+				   multiplicity,
+				   p2s_map,
+				   orbit_offsets,
+				   orbit_atoms);
   reciprocal_to_normal4(fc4_normal,
 			fc4_reciprocal,
 			frequencies + grid_point0 * num_band,
@@ -309,67 +396,48 @@ static void get_fc4_normal_for_frequency_shift_at_gp
   free(fc4_normal);
 }
 
-static lapack_complex_double fc4_sum(const int bi0,
-				     const int bi1,
-				     const lapack_complex_double *eigvecs0,
-				     const lapack_complex_double *eigvecs1,
-				     const lapack_complex_double *fc4_reciprocal,
-				     const double *masses,
-				     const int num_atom)
+/* fc4_reciprocal[i, j, k, l, m, n, p, q] / sqrt(m_i m_j m_k m_l) */
+/* is stored as Phi[(i,m), (j,n), (k,p), (l,q)]. */
+static void
+set_mass_weighted_fc4_reciprocal(lapack_complex_double *fc4_mass_weighted,
+				 const lapack_complex_double *fc4_reciprocal,
+				 const double *masses,
+				 const int num_atom)
 {
-  int i, j, k, l, m, n, p, q;
-  double sum_real, sum_imag, sum_real_cart, sum_imag_cart, mmm;
-  lapack_complex_double eig_prod, eigvec0conj, eigvec1conj;
+  int i, j, k, l, m, n, p, q, num_band, adrs;
+  double mmm;
+  lapack_complex_double fc4_elem;
+
+  num_band = num_atom * 3;
 
-  sum_real = 0;
-  sum_imag = 0;
   for (i = 0; i < num_atom; i++) {
     for (j = 0; j < num_atom; j++) {
       for (k = 0; k < num_atom; k++) {
 	for (l = 0; l < num_atom; l++) {
-	  sum_real_cart = 0;
-	  sum_imag_cart = 0;
 	  mmm = sqrt(masses[i] * masses[j] * masses[k] * masses[l]);
+	  adrs = (i * num_atom * num_atom * num_atom +
+		  j * num_atom * num_atom +
+		  k * num_atom +
+		  l) * 81;
 	  for (m = 0; m < 3; m++) {
-	    eigvec0conj = lapack_make_complex_double
-	      (lapack_complex_double_real
-	       (eigvecs0[(i * 3 + m) * num_atom * 3 + bi0]),
-	       -lapack_complex_double_imag
-	       (eigvecs0[(i * 3 + m) * num_atom * 3 + bi0]));
-	    for (n = 0; n < 3; n++) {
-	    for (p = 0; p < 3; p++) {
-	    for (q = 0; q < 3; q++) {
-	      eigvec1conj = lapack_make_complex_double
-		(lapack_complex_double_real
-		 (eigvecs1[(l * 3 + q) * num_atom * 3 + bi1]),
-		 -lapack_complex_double_imag
-		 (eigvecs1[(l * 3 + q) * num_atom * 3 + bi1]));
-	      eig_prod =
-		phonoc_complex_prod(eigvec0conj,
-		phonoc_complex_prod(eigvecs0[(j * 3 + n) * num_atom * 3 + bi0],
-                phonoc_complex_prod(eigvecs1[(k * 3 + p) * num_atom * 3 + bi1],
-                phonoc_complex_prod(eigvec1conj,
-                fc4_reciprocal[i * num_atom * num_atom * num_atom * 81 +
-			       j * num_atom * num_atom * 81 +
-			       k * num_atom * 81 +
-			       l * 81 +
-			       m * 27 +
-			       n * 9 +
-			       p * 3 +
-			       q]))));
-	      sum_real_cart += lapack_complex_double_real(eig_prod);
-	      sum_imag_cart += lapack_complex_double_imag(eig_prod);
-	    }
-	    }
-	    }
+	  for (n = 0; n < 3; n++) {
+	  for (p = 0; p < 3; p++) {
+	  for (q = 0; q < 3; q++) {
+	    fc4_elem = fc4_reciprocal[adrs + m * 27 + n * 9 + p * 3 + q];
+	    fc4_mass_weighted[(i * 3 + m) * num_band * num_band * num_band +
+			      (j * 3 + n) * num_band * num_band +
+			      (k * 3 + p) * num_band +
+			      l * 3 + q] = lapack_make_complex_double
+	      (lapack_complex_double_real(fc4_elem) / mmm,
+	       lapack_complex_double_imag(fc4_elem) / mmm);
+	  }
+	  }
+	  }
 	  }
-	  sum_real += sum_real_cart / mmm;
-	  sum_imag += sum_imag_cart / mmm;
 	}
       }
     }
   }
-  return lapack_make_complex_double(sum_real, sum_imag);
 }
 
 static int collect_undone_grid_points(int *undone,
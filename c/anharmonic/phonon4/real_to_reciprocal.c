@@ -32,22 +32,53 @@
 /* ANY WAY OUT OF THE USE OF THIS SOFTWARE, EVEN IF ADVISED OF THE */
 /* POSSIBILITY OF SUCH DAMAGE. */
 
+#include <stdlib.h>
 #include <lapacke.h>
 #include <phonoc_array.h>
 #include <phonoc_utils.h>
 #include <phonon4_h/real_to_reciprocal.h>
 
+static lapack_complex_double *
+get_phase_factor_table(const double q[12],
+		       const Darray *shortest_vectors,
+		       const Iarray *multiplicity);
 static void real_to_reciprocal_elements(lapack_complex_double *fc4_rec_elem,
-					const double q[12],
+					const lapack_complex_double *phase_factors,
 					const double *fc4,
-					const Darray *shortest_vectors,
-					const Iarray *multiplicity,
+					const int num_satom,
+					const int num_patom,
 					const int *p2s,
-					const int *s2p,
+					const int *orbit_offsets,
+					const int *orbit_atoms,
 					const int pi0,
 					const int pi1,
 					const int pi2,
 					const int pi3);
+static void
+real_to_reciprocal_first_stage_elements(lapack_complex_double *fc4_q_elem,
+					const lapack_complex_double *phase_factors,
+					const double *fc4,
+					const int num_satom,
+					const int num_patom,
+					const int *p2s,
+					const int *orbit_offsets,
+					const int *orbit_atoms,
+					const int pi0,
+					const int pi1,
+					const int k);
+static void
+real_to_reciprocal_second_stage_elements(lapack_complex_double *fc4_rec_elem,
+					 const lapack_complex_double *phase_factors,
+					 const lapack_complex_double *fc4_q,
+					 const int num_satom,
+					 const int num_patom,
+					 const int *p2s,
+					 const int *orbit_offsets,
+					 const int *orbit_atoms,
+					 const int pi0,
+					 const int pi1,
+					 const int pi2,
+					 const int pi3);
 
 /* fc4_reciprocal[num_patom, num_patom, num_patom, num_patom, 3, 3, 3, 3] */
 void real_to_reciprocal4(lapack_complex_double *fc4_reciprocal,
@@ -56,49 +87,158 @@ void real_to_reciprocal4(lapack_complex_double *fc4_reciprocal,
 			 const Darray *shortest_vectors,
 			 const Iarray *multiplicity,
 			 const int *p2s_map,
-			 const int *s2p_map)
+			 const int *orbit_offsets,
+			 const int *orbit_atoms)
+{
+  int i, num_patom, num_satom;
+  lapack_complex_double *phase_factors;
+
+  num_satom = multiplicity->dims[0];
+  num_patom = multiplicity->dims[1];
+
+  phase_factors = get_phase_factor_table(q, shortest_vectors, multiplicity);
+
+#pragma omp parallel for
+  for (i = 0; i < num_patom * num_patom * num_patom * num_patom; i++) {
+    real_to_reciprocal_elements(fc4_reciprocal + i * 81,
+				phase_factors,
+				fc4,
+				num_satom,
+				num_patom,
+				p2s_map,
+				orbit_offsets,
+				orbit_atoms,
+				i / (num_patom * num_patom * num_patom),
+				(i / (num_patom * num_patom)) % num_patom,
+				(i / num_patom) % num_patom,
+				i % num_patom);
+  }
+
+  free(phase_factors);
+}		       
+
+/* Partial transform over the second atom for fixed q[3:6] */
+/* fc4_q[num_patom, num_patom, num_satom, num_satom, 3, 3, 3, 3] */
+void real_to_reciprocal4_first_stage(lapack_complex_double *fc4_q,
+				     const double q[12],
+				     const double *fc4,
+				     const Darray *shortest_vectors,
+				     const Iarray *multiplicity,
+				     const int *p2s_map,
+				     const int *orbit_offsets,
+				     const int *orbit_atoms)
 {
-  int i, j, k, l, num_patom;
+  int i, num_patom, num_satom;
+  lapack_complex_double *phase_factors;
+
+  num_satom = multiplicity->dims[0];
+  num_patom = multiplicity->dims[1];
+
+  phase_factors = get_phase_factor_table(q, shortest_vectors, multiplicity);
+
+#pragma omp parallel for
+  for (i = 0; i < num_patom * num_patom * num_satom; i++) {
+    real_to_reciprocal_first_stage_elements
+      (fc4_q + i * num_satom * 81,
+       phase_factors,
+       fc4,
+       num_satom,
+       num_patom,
+       p2s_map,
+       orbit_offsets,
+       orbit_atoms,
+       i / (num_patom * num_satom),
+       (i / num_satom) % num_patom,
+       i % num_satom);
+  }
+
+  free(phase_factors);
+}
+
+/* Remaining transform over the third and fourth atoms of fc4_q */
+/* fc4_reciprocal[num_patom, num_patom, num_patom, num_patom, 3, 3, 3, 3] */
+void real_to_reciprocal4_second_stage(lapack_complex_double *fc4_reciprocal,
+				      const double q[12],
+				      const lapack_complex_double *fc4_q,
+				      const Darray *shortest_vectors,
+				      const Iarray *multiplicity,
+				      const int *p2s_map,
+				      const int *orbit_offsets,
+				      const int *orbit_atoms)
+{
+  int i, num_patom, num_satom;
+  lapack_complex_double *phase_factors;
   
+  num_satom = multiplicity->dims[0];
   num_patom = multiplicity->dims[1];
 
-  for (i = 0; i < num_patom; i++) {
+  phase_factors = get_phase_factor_table(q, shortest_vectors, multiplicity);
+
+  for (i = 0; i < num_patom * num_patom * num_patom * num_patom; i++) {
+    real_to_reciprocal_second_stage_elements
+      (fc4_reciprocal + i * 81,
+       phase_factors,
+       fc4_q,
+       num_satom,
+       num_patom,
+       p2s_map,
+       orbit_offsets,
+       orbit_atoms,
+       i / (num_patom * num_patom * num_patom),
+       (i / (num_patom * num_patom)) % num_patom,
+       (i / num_patom) % num_patom,
+       i % num_patom);
+  }
+
+  free(phase_factors);
+}
+
+/* phase_factors[4, num_patom, num_satom] */
+/* Phase factor of supercell atom j relative to primitive atom pi0 for */
+/* q of each slot in the quartet. */
+static lapack_complex_double *
+get_phase_factor_table(const double q[12],
+		       const Darray *shortest_vectors,
+		       const Iarray *multiplicity)
+{
+  int i, j, k, num_patom, num_satom;
+  lapack_complex_double *phase_factors;
+
+  num_satom = multiplicity->dims[0];
+  num_patom = multiplicity->dims[1];
+
+  phase_factors = (lapack_complex_double*)
+    malloc(sizeof(lapack_complex_double) * 4 * num_patom * num_satom);
+
+  for (i = 0; i < 4; i++) {
     for (j = 0; j < num_patom; j++) {
-      for (k = 0; k < num_patom; k++) {
-	for (l = 0; l < num_patom; l++) {
-	  real_to_reciprocal_elements
-	    (fc4_reciprocal +
-	     i * 81 * num_patom * num_patom * num_patom +
-	     j * 81 * num_patom * num_patom +
-	     k * 81 * num_patom +
-	     l * 81,
-	     q,
-	     fc4,
-	     shortest_vectors,
-	     multiplicity,
-	     p2s_map,
-	     s2p_map,
-	     i, j, k, l);
-	}
+      for (k = 0; k < num_satom; k++) {
+	phase_factors[i * num_patom * num_satom + j * num_satom + k] =
+	  get_phase_factor(q, shortest_vectors, multiplicity, j, k, i);
       }
     }
   }
-}		       
+
+  return phase_factors;
+}
 
 static void real_to_reciprocal_elements(lapack_complex_double *fc4_rec_elem,
-					const double q[12],
+					const lapack_complex_double *phase_factors,
 					const double *fc4,
-					const Darray *shortest_vectors,
-					const Iarray *multiplicity,
+					const int num_satom,
+					const int num_patom,
 					const int *p2s,
-					const int *s2p,
+					const int *orbit_offsets,
+					const int *orbit_atoms,
 					const int pi0,
 					const int pi1,
 					const int pi2,
 					const int pi3)
 {
-  int i, j, k, l, m, num_satom;
-  lapack_complex_double phase_factor, phase_factors[3];
+  int i, j, k, l, m, jj, kk, ll;
+  lapack_complex_double phase_factor, phase_factor_jk;
+  const lapack_complex_double *phase_factors_j, *phase_factors_k;
+  const lapack_complex_double *phase_factors_l;
   double fc4_rec_real[81], fc4_rec_imag[81];
   int fc4_elem_address;
 
@@ -107,38 +247,28 @@ static void real_to_reciprocal_elements(lapack_complex_double *fc4_rec_elem,
     fc4_rec_imag[i] = 0;
   }
   
-  num_satom = multiplicity->dims[0];
+  phase_factors_j = phase_factors + (num_patom + pi0) * num_satom;
+  phase_factors_k = phase_factors + (2 * num_patom + pi0) * num_satom;
+  phase_factors_l = phase_factors + (3 * num_patom + pi0) * num_satom;
 
   i = p2s[pi0];
 
-  for (j = 0; j < num_satom; j++) {
-    if (s2p[j] != p2s[pi1]) {
-      continue;
-    }
-    phase_factors[0] =
-      get_phase_factor(q, shortest_vectors, multiplicity, pi0, j, 1);
+  for (jj = orbit_offsets[pi1]; jj < orbit_offsets[pi1 + 1]; jj++) {
+    j = orbit_atoms[jj];
 
-    for (k = 0; k < num_satom; k++) {
-      if (s2p[k] != p2s[pi2]) {
-	continue;
-      }
-      phase_factors[1] =
-	get_phase_factor(q, shortest_vectors, multiplicity, pi0, k, 2);
+    for (kk = orbit_offsets[pi2]; kk < orbit_offsets[pi2 + 1]; kk++) {
+      k = orbit_atoms[kk];
+      phase_factor_jk =
+	phonoc_complex_prod(phase_factors_j[j], phase_factors_k[k]);
 
-      for (l = 0; l < num_satom; l++) {
-	if (s2p[l] != p2s[pi3]) {
-	  continue;
-	}
-	phase_factors[2] =
-	  get_phase_factor(q, shortest_vectors, multiplicity, pi0, l, 3);
-	
+      for (ll = orbit_offsets[pi3]; ll < orbit_offsets[pi3 + 1]; ll++) {
+	l = orbit_atoms[ll];
 	fc4_elem_address = (i * 81 * num_satom * num_satom * num_satom +
 			    j * 81 * num_satom * num_satom +
 			    k * 81 * num_satom +
 			    l * 81);
 
-	phase_factor = phonoc_complex_prod(phase_factors[0], phase_factors[1]);
-	phase_factor = phonoc_complex_prod(phase_factor, phase_factors[2]);
+	phase_factor = phonoc_complex_prod(phase_factor_jk, phase_factors_l[l]);
 	for (m = 0; m < 81; m++) {
 	  fc4_rec_real[m] +=
 	    lapack_complex_double_real(phase_factor) * fc4[fc4_elem_address + m];
@@ -154,3 +284,115 @@ static void real_to_reciprocal_elements(lapack_complex_double *fc4_rec_elem,
       lapack_make_complex_double(fc4_rec_real[i], fc4_rec_imag[i]);
   }
 }
+
+static void
+real_to_reciprocal_first_stage_elements(lapack_complex_double *fc4_q_elem,
+					const lapack_complex_double *phase_factors,
+					const double *fc4,
+					const int num_satom,
+					const int num_patom,
+					const int *p2s,
+					const int *orbit_offsets,
+					const int *orbit_atoms,
+					const int pi0,
+					const int pi1,
+					const int k)
+{
+  int i, j, m, jj;
+  lapack_complex_double phase_factor;
+  double *fc4_q_real, *fc4_q_imag;
+  int fc4_elem_address;
+
+  fc4_q_real = (double*)malloc(sizeof(double) * num_satom * 81);
+  fc4_q_imag = (double*)malloc(sizeof(double) * num_satom * 81);
+  for (i = 0; i < num_satom * 81; i++) {
+    fc4_q_real[i] = 0;
+    fc4_q_imag[i] = 0;
+  }
+  
+  i = p2s[pi0];
+
+  for (jj = orbit_offsets[pi1]; jj < orbit_offsets[pi1 + 1]; jj++) {
+    j = orbit_atoms[jj];
+    phase_factor = phase_factors[(num_patom + pi0) * num_satom + j];
+    fc4_elem_address = (i * 81 * num_satom * num_satom * num_satom +
+			j * 81 * num_satom * num_satom +
+			k * 81 * num_satom);
+    for (m = 0; m < num_satom * 81; m++) {
+      fc4_q_real[m] +=
+	lapack_complex_double_real(phase_factor) * fc4[fc4_elem_address + m];
+      fc4_q_imag[m] +=
+	lapack_complex_double_imag(phase_factor) * fc4[fc4_elem_address + m];
+    }
+  }
+
+  for (m = 0; m < num_satom * 81; m++) {
+    fc4_q_elem[m] = lapack_make_complex_double(fc4_q_real[m], fc4_q_imag[m]);
+  }
+
+  free(fc4_q_real);
+  free(fc4_q_imag);
+}
+
+static void
+real_to_reciprocal_second_stage_elements(lapack_complex_double *fc4_rec_elem,
+					 const lapack_complex_double *phase_factors,
+					 const lapack_complex_double *fc4_q,
+					 const int num_satom,
+					 const int num_patom,
+					 const int *p2s,
+					 const int *orbit_offsets,
+					 const int *orbit_atoms,
+					 const int pi0,
+					 const int pi1,
+					 const int pi2,
+					 const int pi3)
+{
+  int i, k, l, m, kk, ll;
+  lapack_complex_double phase_factor, fc4_q_elem;
+  const lapack_complex_double *phase_factors_k, *phase_factors_l;
+  double fc4_rec_real[81], fc4_rec_imag[81];
+  int fc4_q_address;
+
+  for (i = 0; i < 81; i++) {
+    fc4_rec_real[i] = 0;
+    fc4_rec_imag[i] = 0;
+  }
+  
+  phase_factors_k = phase_factors + (2 * num_patom + pi0) * num_satom;
+  phase_factors_l = phase_factors + (3 * num_patom + pi0) * num_satom;
+
+  for (kk = orbit_offsets[pi2]; kk < orbit_offsets[pi2 + 1]; kk++) {
+    k = orbit_atoms[kk];
+
+    for (ll = orbit_offsets[pi3]; ll < orbit_offsets[pi3 + 1]; ll++) {
+      l = orbit_atoms[ll];
+      phase_factor =
+	phonoc_complex_prod(phase_factors_k[k], phase_factors_l[l]);
+
+      fc4_q_address = (pi0 * 81 * num_satom * num_satom * num_patom +
+		       pi1 * 81 * num_satom * num_satom +
+		       k * 81 * num_satom +
+		       l * 81);
+
+      for (m = 0; m < 81; m++) {
+	fc4_q_elem = fc4_q[fc4_q_address + m];
+	fc4_rec_real[m] +=
+	  lapack_complex_double_real(phase_factor) *
+	  lapack_complex_double_real(fc4_q_elem) -
+	  lapack_complex_double_imag(phase_factor) *
+	  lapack_complex_double_imag(fc4_q_elem);
+	fc4_rec_imag[m] +=
+	  lapack_complex_double_real(phase_factor) *
+	  lapack_complex_double_imag(fc4_q_elem) +
+	  lapack_complex_double_imag(phase_factor) *
+	  lapack_complex_double_real(fc4_q_elem);
+      }
+    }
+  }
+
+  for (i = 0; i < 81; i++) {
+    fc4_rec_elem[i] =
+      lapack_make_complex_double(fc4_rec_real[i], fc4_rec_imag[i]);
+  }
+}
@@ -42,6 +42,7 @@ void get_fc4_frequency_shifts(double *frequency_shifts,
 			      const double *fc4_normal_real,
 			      const double *frequencies,
 			      const Iarray *grid_points1,
+			      const int *weights,
 			      const Darray *temperatures,
 			      const int *band_indicies,
 			      const int num_band0,
@@ -60,7 +61,8 @@ get_fc4_normal_for_frequency_shift(double *fc4_normal_real,
 				   const Iarray *multiplicity,
 				   const double *masses,
 				   const int *p2s_map,
-				   const int *s2p_map,
+				   const int *orbit_offsets,
+				   const int *orbit_atoms,
 				   const Iarray *band_indicies,
 				   const double cutoff_frequency);
 void reciprocal_to_normal4(lapack_complex_double *fc4_normal,
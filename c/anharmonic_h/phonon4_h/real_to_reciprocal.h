@@ -44,6 +44,23 @@ void real_to_reciprocal4(lapack_complex_double *fc4_reciprocal,
 			 const Darray *shortest_vectors,
 			 const Iarray *multiplicity,
 			 const int *p2s_map,
-			 const int *s2p_map);
+			 const int *orbit_offsets,
+			 const int *orbit_atoms);
+void real_to_reciprocal4_first_stage(lapack_complex_double *fc4_q,
+				     const double q[12],
+				     const double *fc4,
+				     const Darray *shortest_vectors,
+				     const Iarray *multiplicity,
+				     const int *p2s_map,
+				     const int *orbit_offsets,
+				     const int *orbit_atoms);
+void real_to_reciprocal4_second_stage(lapack_complex_double *fc4_reciprocal,
+				      const double q[12],
+				      const lapack_complex_double *fc4_q,
+				      const Darray *shortest_vectors,
+				      const Iarray *multiplicity,
+				      const int *p2s_map,
+				      const int *orbit_offsets,
+				      const int *orbit_atoms);
 
 #endif
@@ -0,0 +1,235 @@
+import numpy as np
+
+class DisplacementDataset:
+    """Columnar form of nested displacement dataset
+
+    Displacement dataset of phonopy/phono3py/phono4py is a dict of nested
+    lists, 'first_atoms' -> 'second_atoms' -> 'third_atoms'. Here each
+    level is stored as arrays:
+
+      numbers: Displaced atoms [num_entries]
+      displacements: Displacements [num_entries, 3]
+      parents: Entry indices of the previous level [num_entries]
+        (-1 at the first level)
+      forces: Forces [num_entries, num_atom, 3] or None
+
+    Entries are sorted by (parent entry, atom number) so that those of
+    an atom are obtained as a view of an index array by binary search.
+    The index takes memory proportional to the number of entries.
+
+    """
+    def __init__(self, natom, numbers, displacements, parents, forces):
+        self._natom = natom
+        self._numbers = [np.array(x, dtype='intc') for x in numbers]
+        self._displacements = [np.array(x, dtype='double').reshape(-1, 3)
+                               for x in displacements]
+        self._parents = [np.array(x, dtype='intc') for x in parents]
+        self._forces = [
+            None if x is None else
+            np.array(x, dtype='double').reshape(-1, natom, 3)
+            for x in forces]
+        self._set_index()
+
+    def get_number_of_atoms(self):
+        return self._natom
+
+    def get_number_of_levels(self):
+        return len(self._numbers)
+
+    def get_number_of_displacements(self, level=None):
+        """Number of entries at level, or of all levels if level is None"""
+        if level is None:
+            return sum([len(x) for x in self._numbers])
+        return len(self._numbers[level])
+
+    def get_numbers(self, level=0):
+        return self._numbers[level]
+
+    def get_displacements(self, level=0):
+        return self._displacements[level]
+
+    def get_parents(self, level=0):
+        return self._parents[level]
+
+    def get_forces(self, level=0):
+        return self._forces[level]
+
+    def set_forces(self, forces, level=None):
+        """Set forces of level
+
+        If level is None, forces of all levels are given stacked in the
+        order of levels, which is the order of FORCES_FC3 and FORCES_FC4.
+
+        """
+        natom = self._natom
+        if level is not None:
+            self._forces[level] = np.array(
+                forces, dtype='double').reshape(-1, natom, 3)
+            return
+
+        forces = np.array(forces, dtype='double').reshape(-1, natom, 3)
+        if len(forces) != self.get_number_of_displacements():
+            print "Number of sets of forces is inconsistent with dataset."
+            raise ValueError
+        count = 0
+        for level, numbers in enumerate(self._numbers):
+            self._forces[level] = forces[count:(count + len(numbers))]
+            count += len(numbers)
+
+    def get_delta_forces(self, level):
+        """Forces minus those of parent entries"""
+        forces = self._forces[level]
+        if level == 0:
+            return forces
+        return forces - self._forces[level - 1][self._parents[level]]
+
+    def get_first_atom_numbers(self):
+        """Unique first displaced atoms"""
+        return np.unique(self._numbers[0])
+
+    def get_indices(self, atom_num, parent=-1, level=0):
+        """Entry indices of atom_num at level under parent entry"""
+        sorted_keys = self._sorted_keys[level]
+        key = (parent + 1) * self._natom + atom_num
+        return self._sorted_indices[level][
+            sorted_keys.searchsorted(key, side='left'):
+            sorted_keys.searchsorted(key, side='right')]
+
+    def get_first_atom_indices(self, first_atom_num):
+        return self.get_indices(first_atom_num)
+
+    def get_second_atom_indices(self, first_index, second_atom_num):
+        return self.get_indices(second_atom_num, parent=first_index, level=1)
+
+    def get_third_atom_indices(self, second_index, third_atom_num):
+        return self.get_indices(third_atom_num, parent=second_index, level=2)
+
+    def _set_index(self):
+        self._sorted_indices = []
+        self._sorted_keys = []
+        for numbers, parents in zip(self._numbers, self._parents):
+            keys = ((parents.astype('int64') + 1) * self._natom + numbers)
+            sorted_indices = np.array(np.argsort(keys, kind='mergesort'),
+                                      dtype='intc')
+            self._sorted_indices.append(sorted_indices)
+            self._sorted_keys.append(keys[sorted_indices])
+
+def get_displacement_dataset(disp_dataset):
+    """Convert nested dict dataset to DisplacementDataset"""
+    if isinstance(disp_dataset, DisplacementDataset):
+        return disp_dataset
+
+    natom = disp_dataset['natom']
+    numbers = []
+    displacements = []
+    parents = []
+    forces = []
+    entries = [(-1, x) for x in disp_dataset['first_atoms']]
+    for key in ('second_atoms', 'third_atoms', None):
+        if not entries and numbers:
+            break
+        numbers.append([x['number'] for p, x in entries])
+        displacements.append([x['displacement'] for p, x in entries])
+        parents.append([p for p, x in entries])
+        if all(['forces' in x for p, x in entries]):
+            forces.append([x['forces'] for p, x in entries])
+        else:
+            forces.append(None)
+        if key is None:
+            break
+        entries = [(i, y) for i, (p, x) in enumerate(entries)
+                   for y in x.get(key, [])]
+
+    return DisplacementDataset(natom, numbers, displacements, parents, forces)
+
+def get_dict_dataset(dataset, is_delta_forces=False):
+    """Convert DisplacementDataset to nested dict dataset
+
+    With is_delta_forces, 'delta_forces' (forces minus those of parent
+    displacement) is also attached at the second and third levels as
+    used by Phono4py.
+
+    """
+    if not isinstance(dataset, DisplacementDataset):
+        return dataset
+
+    entries = []
+    for level in range(dataset.get_number_of_levels()):
+        forces = dataset.get_forces(level)
+        if (is_delta_forces and level > 0 and forces is not None and
+            dataset.get_forces(level - 1) is not None):
+            delta_forces = dataset.get_delta_forces(level)
+        else:
+            delta_forces = None
+        level_entries = []
+        for i, (num, disp) in enumerate(
+                zip(dataset.get_numbers(level),
+                    dataset.get_displacements(level))):
+            entry = {'number': int(num), 'displacement': disp}
+            if forces is not None:
+                entry['forces'] = forces[i]
+            if delta_forces is not None:
+                entry['delta_forces'] = delta_forces[i]
+            level_entries.append(entry)
+        if level > 0:
+            key = ('second_atoms', 'third_atoms')[level - 1]
+            for x in entries[level - 1]:
+                x[key] = []
+            for parent, entry in zip(dataset.get_parents(level),
+                                     level_entries):
+                entries[level - 1][parent][key].append(entry)
+        entries.append(level_entries)
+
+    return {'natom': dataset.get_number_of_atoms(),
+            'first_atoms': entries[0] if entries else []}
+
+def write_displacement_dataset(dataset, filename='disp_dataset.hdf5'):
+    """Write dataset to .npz or HDF5 file chosen by filename extension"""
+    dataset = get_displacement_dataset(dataset)
+    arrays = {'natom': np.array(dataset.get_number_of_atoms(), dtype='intc'),
+              'num_levels': np.array(dataset.get_number_of_levels(),
+                                     dtype='intc')}
+    for level in range(dataset.get_number_of_levels()):
+        arrays['numbers_%d' % level] = dataset.get_numbers(level)
+        arrays['displacements_%d' % level] = dataset.get_displacements(level)
+        arrays['parents_%d' % level] = dataset.get_parents(level)
+        if dataset.get_forces(level) is not None:
+            arrays['forces_%d' % level] = dataset.get_forces(level)
+
+    if filename.endswith('.npz'):
+        np.savez(filename, **arrays)
+    else:
+        import h5py
+        with h5py.File(filename, 'w') as w:
+            for key in arrays:
+                w.create_dataset(key, data=arrays[key])
+
+def read_displacement_dataset(filename='disp_dataset.hdf5'):
+    """Read dataset written by write_displacement_dataset"""
+    if filename.endswith('.npz'):
+        with np.load(filename) as f:
+            return _get_dataset_from_arrays(f)
+    else:
+        import h5py
+        with h5py.File(filename, 'r') as f:
+            return _get_dataset_from_arrays(f)
+
+def _get_dataset_from_arrays(f):
+    num_levels = int(f['num_levels'][()])
+    numbers = []
+    displacements = []
+    parents = []
+    forces = []
+    for level in range(num_levels):
+        numbers.append(f['numbers_%d' % level][:])
+        displacements.append(f['displacements_%d' % level][:])
+        parents.append(f['parents_%d' % level][:])
+        if ('forces_%d' % level) in f:
+            forces.append(f['forces_%d' % level][:])
+        else:
+            forces.append(None)
+    return DisplacementDataset(int(f['natom'][()]),
+                               numbers,
+                               displacements,
+                               parents,
+                               forces)
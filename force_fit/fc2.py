@@ -1,8 +1,10 @@
 import numpy as np
 from phonopy.harmonic.force_constants import (similarity_transformation,
-                                              get_positions_sent_by_rot_inv,
                                               distribute_force_constants)
-from phonopy.harmonic.dynamical_matrix import get_equivalent_smallest_vectors
+from force_fit.symmetry_cache import SymmetryCache
+from force_fit.dataset import get_displacement_dataset
+from force_fit.smallest_vectors import (get_smallest_vector_table,
+                                        get_mean_smallest_vectors)
 
 class FC2Fit:
     def __init__(self,
@@ -12,13 +14,18 @@ class FC2Fit:
                  translational_invariance=False,
                  rotational_invariance=False,
                  coef_invariants=None,
-                 pinv_cutoff=1e-13):
+                 pinv_cutoff=1e-13,
+                 solver='pinv',
+                 sparse_solver='lsmr',
+                 sparse_tolerance=1e-10,
+                 initial_fc2=None,
+                 symmetry_cache=None):
 
         self._supercell = supercell
         self._lattice = supercell.get_cell().T
         self._positions = supercell.get_scaled_positions()
         self._num_atom = len(self._positions)
-        self._dataset = disp_dataset
+        self._dataset = get_displacement_dataset(disp_dataset)
         self._symmetry = symmetry
         self._symprec = symmetry.get_symmetry_tolerance()
         self._coef_invariants = coef_invariants
@@ -31,19 +38,38 @@ class FC2Fit:
                              dtype='double')
         self._rot_inv = rotational_invariance
         self._trans_inv = translational_invariance
+        self._solver = solver
+        self._sparse_solver = sparse_solver
+        self._sparse_tolerance = sparse_tolerance
+        self._initial_fc2 = initial_fc2
+        if symmetry_cache is None:
+            self._symmetry_cache = SymmetryCache(supercell, symmetry)
+        else:
+            self._symmetry_cache = symmetry_cache
+        self._mean_smallest_vectors = None
 
     def run(self):
-        self._unique_first_atom_nums = np.unique(
-            [x['number'] for x in self._dataset['first_atoms']])
+        self._unique_first_atom_nums = self._dataset.get_first_atom_numbers()
 
-        if self._rot_inv or self._trans_inv:
+        if self._solver == 'sparse':
+            if self._trans_inv:
+                print("Translational invariance: On")
+            if self._rot_inv:
+                print("Rotational invariance: On")
+            print("Index permutation symmetry: On")
+            self._set_fc2_global_sparse()
+        elif self._rot_inv or self._trans_inv:
             if self._trans_inv:
                 print("Translational invariance: On")
             if self._rot_inv:
                 print("Rotational invariance: On")
-            self._set_fc2_displaced_atoms_one_shot()
+            if self._solver == 'kron':
+                self._set_fc2_displaced_atoms_one_shot_kron()
+            else:
+                self._set_fc2_displaced_atoms_one_shot()
         else:
             self._set_fc2_each_displaced_atom()
+        self._symmetry_cache.show_statistics()
         self._distribute()
 
     def get_fc2(self):
@@ -59,45 +85,257 @@ class FC2Fit:
             print("  Recidual force (atom %d): %s" % (i + 1, fc2[:3]))
             self._fc2[i] = fc2[3:].reshape(-1, 3, 3)
 
+    def _set_fc2_displaced_atoms_one_shot_kron(self):
+        for first_atom_num in self._unique_first_atom_nums:
+            rot_disps, rot_forces = self._get_matrices(first_atom_num)
+            disp_mat = self._get_disp_mat(rot_disps)
+            inv_mat = self._get_invariance_matrix(first_atom_num, rot_disps)
+            try:
+                fc2 = -self._solve_kron(disp_mat,
+                                        rot_forces.reshape(self._num_atom, -1),
+                                        inv_mat)
+            except np.linalg.LinAlgError:
+                print("  Displacements of atom %d are insufficient for "
+                      "Kronecker solver. Pseudo-inverse is used."
+                      % (first_atom_num + 1))
+                disp_big_mat, force_mat = self._get_big_matrix(
+                    disp_mat, rot_forces, inv_mat)
+                fc2 = -np.dot(self._pinv(disp_big_mat), force_mat).flatten()
+            print("  Recidual force (atom %d): %s" %
+                  (first_atom_num + 1, fc2[:3]))
+            self._fc2[first_atom_num] = fc2[3:].reshape(-1, 3, 3)
+
+    def _solve_kron(self, disp_mat, force_mat, inv_mat):
+        """Solve the one-shot least squares problem using its structure
+
+        The matrix built by _get_big_matrix is [R, I_N x D] with the
+        invariance rows C = [C_r, C_f] appended, where R = 1 x I_3
+        gives the residual force. Its normal matrix is block diagonal
+        (I_N x D^T D) except for the residual force and the invariance
+        rows, which are eliminated by Schur complement and Woodbury
+        identity, respectively. Only 9x9 and len(C) x len(C) matrices
+        are inverted.
+
+        LinAlgError is raised when one of them is ill-conditioned, in
+        which case the pseudo-inverse has to be used.
+
+        """
+        num_atom = self._num_atom
+        num_rows = len(disp_mat) // 3 * num_atom
+        inv_G = _inv(np.dot(disp_mat.T, disp_mat))
+        inv_mat_r = inv_mat[:, :3]
+        inv_mat_f = inv_mat[:, 3:].reshape(len(inv_mat), num_atom, 9)
+        inv_mat_f_G = np.dot(inv_mat_f, inv_G)
+        coupling = _inv(
+            np.eye(len(inv_mat)) +
+            np.tensordot(inv_mat_f_G, inv_mat_f, axes=([1, 2], [1, 2])))
+
+        def solve_ff(y):
+            # (I_N x G + C_f^T C_f)^-1 y for y of shape (num_atom, 9, n)
+            x = np.einsum('ab,ibn->ian', inv_G, y)
+            w = np.dot(coupling, np.einsum('kia,ian->kn', inv_mat_f, x))
+            return x - np.einsum('kia,kn->ian', inv_mat_f_G, w)
+
+        rhs_f = np.dot(force_mat, disp_mat)
+        rhs_r = force_mat.reshape(-1, 3).sum(axis=0)
+        N_rr = num_rows * np.eye(3) + np.dot(inv_mat_r.T, inv_mat_r)
+        N_fr = (disp_mat.reshape(-1, 3, 9).sum(axis=0).T +
+                np.einsum('kia,kb->iab', inv_mat_f, inv_mat_r))
+        x = solve_ff(np.concatenate((rhs_f[:, :, None], N_fr), axis=2))
+        schur = N_rr - np.einsum('iab,iac->bc', N_fr, x[:, :, 1:])
+        r = np.dot(_inv(schur),
+                   rhs_r - np.einsum('iab,ia->b', N_fr, x[:, :, 0]))
+        fc = x[:, :, 0] - np.dot(x[:, :, 1:], r)
+        return np.hstack((r, fc.flatten()))
+
+    def _set_fc2_global_sparse(self):
+        """Fit rows of fc2 of all unique atoms in one sparse system
+
+        Columns are [residual force (3), fc2[u, :] (9N)] for each unique
+        atom u. Besides the force and invariance rows of each u, index
+        permutation symmetry fc2[u, j] = fc2[j, u]^T couples the unique
+        atoms, where fc2[j, u] of a non-unique atom j is expressed by
+        the unique row it is sent to by symmetry. The system is solved
+        by LSMR (or LSQR) starting from initial_fc2 if given.
+
+        """
+        import scipy.sparse as sparse
+        from scipy.sparse.linalg import lsmr, lsqr
+
+        num_atom = self._num_atom
+        num_col = 9 * num_atom + 3
+        blocks = []
+        force_mats = []
+        amplitudes = []
+        for first_atom_num in self._unique_first_atom_nums:
+            rot_disps, rot_forces = self._get_matrices(first_atom_num)
+            disp_mat = self._get_disp_mat(rot_disps)
+            residual_force_mat = sparse.kron(
+                np.ones((len(disp_mat) // 3 * num_atom, 1)),
+                sparse.identity(3))
+            block = sparse.hstack(
+                (residual_force_mat,
+                 sparse.kron(sparse.identity(num_atom), disp_mat)))
+            inv_mat = self._get_invariance_matrix(first_atom_num, rot_disps)
+            blocks.append(sparse.vstack((block, sparse.csr_matrix(inv_mat))))
+            force_mats.append(np.reshape(rot_forces, -1))
+            force_mats.append(np.zeros(len(inv_mat)))
+            if self._coef_invariants is None:
+                amplitudes.append(
+                    np.sqrt((rot_disps ** 2).sum() / len(rot_disps)))
+            else:
+                amplitudes.append(self._coef_invariants)
+
+        perm_mat = self._get_permutation_symmetry_matrix(np.mean(amplitudes))
+        big_mat = sparse.vstack((sparse.block_diag(blocks), perm_mat),
+                                format='csr')
+        force_vec = np.hstack(force_mats + [np.zeros(perm_mat.shape[0])])
+
+        if self._initial_fc2 is None:
+            x0 = None
+        else:
+            x0 = np.zeros((len(self._unique_first_atom_nums), num_col),
+                          dtype='double')
+            for i, first_atom_num in enumerate(self._unique_first_atom_nums):
+                x0[i, 3:] = -np.ravel(self._initial_fc2[first_atom_num])
+            x0 = x0.ravel()
+
+        print("  Solving %d x %d sparse system (%d non-zero elements) by %s" %
+              (big_mat.shape + (big_mat.nnz, self._sparse_solver)))
+        tol = self._sparse_tolerance
+        if self._sparse_solver == 'lsqr':
+            ret = lsqr(big_mat, force_vec, atol=tol, btol=tol, x0=x0)
+        else:
+            ret = lsmr(big_mat, force_vec, atol=tol, btol=tol, x0=x0)
+        print("  Number of iterations: %d" % ret[2])
+
+        fc2 = -ret[0].reshape(-1, num_col)
+        for first_atom_num, fc2_row in zip(self._unique_first_atom_nums, fc2):
+            print("  Recidual force (atom %d): %s" %
+                  (first_atom_num + 1, fc2_row[:3]))
+            self._fc2[first_atom_num] = fc2_row[3:].reshape(-1, 3, 3)
+
+    def _get_permutation_symmetry_matrix(self, amplitude):
+        import scipy.sparse as sparse
+
+        num_atom = self._num_atom
+        num_col = 9 * num_atom + 3
+        unique_atoms = list(self._unique_first_atom_nums)
+        transpose = np.eye(9)[[0, 3, 6, 1, 4, 7, 2, 5, 8]]
+        row_maps = self._get_row_mappings()
+
+        rows = []
+        cols = []
+        vals = []
+        num_rows = 0
+        for p, u in enumerate(unique_atoms):
+            for j in range(num_atom):
+                q, rot_cart, perm = row_maps[j]
+                if j in unique_atoms and q < p:
+                    continue
+                # vec(fc2[j, u]^T) = (R^T x R^T) T vec(fc2[u_j, perm[u]])
+                mat = np.dot(np.kron(rot_cart.T, rot_cart.T), transpose)
+                for c, v in ((p * num_col + 3 + j * 9, np.eye(9)),
+                             (q * num_col + 3 + perm[u] * 9, -mat)):
+                    r_idx, c_idx = np.nonzero(np.abs(v) > 1e-12)
+                    rows.append(r_idx + num_rows)
+                    cols.append(c_idx + c)
+                    vals.append(v[r_idx, c_idx])
+                num_rows += 9
+
+        return sparse.coo_matrix(
+            (np.hstack(vals) * amplitude, (np.hstack(rows), np.hstack(cols))),
+            shape=(num_rows, num_col * len(unique_atoms)))
+
+    def _get_row_mappings(self):
+        """Symmetry operations sending atoms to unique atoms
+
+        For each atom j, (q, R, perm) is returned, where R is the
+        Cartesian rotation and perm is the atom permutation of the
+        operation (r, t) with (r, t) x_j = x_u, u being the q-th unique
+        atom, i.e., fc2[j, i] = R^T fc2[u, perm[i]] R.
+
+        """
+        rotations = self._symmetry.get_symmetry_operations()['rotations']
+        trans = self._symmetry.get_symmetry_operations()['translations']
+        unique_atoms = self._unique_first_atom_nums
+        perms = {}
+        row_maps = []
+        for j in range(self._num_atom):
+            found = False
+            for k, (r, t) in enumerate(zip(rotations, trans)):
+                diff = (self._positions[unique_atoms] -
+                        np.dot(r, self._positions[j]) - t)
+                diff -= np.rint(diff)
+                dist = np.sqrt((np.dot(diff, self._lattice.T) ** 2).sum(axis=1))
+                q = np.nonzero(dist < self._symprec)[0]
+                if len(q) > 0:
+                    found = True
+                    break
+            assert found, "Something is wrong."
+            if k not in perms:
+                perms[k] = self._get_atom_permutation(r, t)
+            row_maps.append((q[0],
+                             similarity_transformation(self._lattice, r),
+                             perms[k]))
+        return row_maps
+
+    def _get_atom_permutation(self, r, t):
+        rot_pos = np.dot(self._positions, r.T) + t
+        perm = np.zeros(self._num_atom, dtype='intc')
+        for i, pos in enumerate(rot_pos):
+            diff = self._positions - pos
+            diff -= np.rint(diff)
+            dist = np.sqrt((np.dot(diff, self._lattice.T) ** 2).sum(axis=1))
+            perm[i] = np.argmin(dist)
+        return perm
+
     def _get_big_matrices_for_one_shot(self):
         disp_big_matrices = []
         force_matrices = []
         for first_atom_num in self._unique_first_atom_nums:
-            disp_mat = []
             rot_disps, rot_forces = self._get_matrices(first_atom_num)
-            for d in rot_disps:
-                disp_mat.append(np.kron(d, np.eye(3)))
-            disp_big_mat = np.kron(np.eye(self._num_atom),
-                                   np.reshape(disp_mat, (-1, 9)))
-            residual_force_mat = np.kron(np.ones((len(disp_big_mat) / 3, 1)),
-                                         np.eye(3))
-            disp_big_mat = np.hstack((residual_force_mat, disp_big_mat))
-            force_mat = np.reshape(rot_forces, (-1, 1))
-            if self._rot_inv:
-                if self._coef_invariants is None:
-                    amplitude = np.sqrt((rot_disps ** 2).sum() / len(rot_disps))
-                else:
-                    amplitude = self._coef_invariants
-                rimat = self._get_rotational_invariance_matrix(first_atom_num)
-                rimat *= amplitude
-                disp_big_mat = np.vstack((disp_big_mat, rimat))
-                force_mat = np.vstack((force_mat, np.zeros((9, 1))))
-
-            if self._trans_inv:
-                if self._coef_invariants is None:
-                    amplitude = np.sqrt((rot_disps ** 2).sum() / len(rot_disps))
-                else:
-                    amplitude = self._coef_invariants
-                timat = self._get_translational_invariance_matrix()
-                timat *= amplitude
-                disp_big_mat = np.vstack((disp_big_mat, timat))
-                force_mat = np.vstack((force_mat, np.zeros((9, 1))))
-
+            disp_big_mat, force_mat = self._get_big_matrix(
+                self._get_disp_mat(rot_disps),
+                rot_forces,
+                self._get_invariance_matrix(first_atom_num, rot_disps))
             disp_big_matrices.append(disp_big_mat)
             force_matrices.append(force_mat)
 
         return disp_big_matrices, force_matrices
 
+    def _get_disp_mat(self, rot_disps):
+        disp_mat = []
+        for d in rot_disps:
+            disp_mat.append(np.kron(d, np.eye(3)))
+        return np.reshape(disp_mat, (-1, 9))
+
+    def _get_big_matrix(self, disp_mat, rot_forces, inv_mat):
+        disp_big_mat = np.kron(np.eye(self._num_atom), disp_mat)
+        residual_force_mat = np.kron(np.ones((len(disp_big_mat) // 3, 1)),
+                                     np.eye(3))
+        disp_big_mat = np.hstack((residual_force_mat, disp_big_mat))
+        force_mat = np.reshape(rot_forces, (-1, 1))
+        disp_big_mat = np.vstack((disp_big_mat, inv_mat))
+        force_mat = np.vstack((force_mat, np.zeros((len(inv_mat), 1))))
+        return disp_big_mat, force_mat
+
+    def _get_invariance_matrix(self, first_atom_num, rot_disps):
+        if self._coef_invariants is None:
+            amplitude = np.sqrt((rot_disps ** 2).sum() / len(rot_disps))
+        else:
+            amplitude = self._coef_invariants
+        inv_mat = np.zeros((0, 9 * self._num_atom + 3), dtype='double')
+        if self._rot_inv:
+            rimat = self._get_rotational_invariance_matrix(first_atom_num)
+            rimat *= amplitude
+            inv_mat = np.vstack((inv_mat, rimat))
+        if self._trans_inv:
+            timat = self._get_translational_invariance_matrix()
+            timat *= amplitude
+            inv_mat = np.vstack((inv_mat, timat))
+        return inv_mat
+
     def _get_rotational_invariance_matrix(self, patom_num):
         rimat = np.zeros((9, 9 * self._num_atom + 3), dtype='double')
         rimat[:9, :3] = [[ 0, 0, 0],
@@ -109,20 +347,29 @@ class FC2Fit:
                          [ 0, 0,-1],
                          [ 0, 0, 1],
                          [ 0, 0, 0]]
-        for i in range(self._num_atom):
-            vectors = get_equivalent_smallest_vectors(i,
-                                                      patom_num,
-                                                      self._supercell,
-                                                      self._lattice.T,
-                                                      self._symprec)
-            r_frac = np.array(vectors).sum(axis=0) / len(vectors)
-            r = np.dot(self._lattice, r_frac)
-            rimat_each = np.kron(np.eye(3), [[0, r[2], -r[1]],
-                                             [-r[2], 0, r[0]],
-                                             [r[1], -r[0], 0]])
-            rimat[:, (i * 9 + 3):((i + 1) * 9 + 3)] = rimat_each
+        r = self._get_mean_smallest_vectors(patom_num)
+        zeros = np.zeros(self._num_atom)
+        rimat_each = np.transpose([[zeros, r[:, 2], -r[:, 1]],
+                                   [-r[:, 2], zeros, r[:, 0]],
+                                   [r[:, 1], -r[:, 0], zeros]], (2, 0, 1))
+        rimat[:, 3:] = np.einsum(
+            'ac,ibd->abicd', np.eye(3), rimat_each).reshape(9, -1)
         return rimat
 
+    def _get_mean_smallest_vectors(self, patom_num):
+        # Cartesian shortest vectors from the unique first atoms to all
+        # atoms, computed once for all invariance matrices.
+        if self._mean_smallest_vectors is None:
+            svecs, multi = get_smallest_vector_table(
+                self._supercell,
+                self._unique_first_atom_nums,
+                self._lattice.T,
+                self._symprec)
+            self._mean_smallest_vectors = np.dot(
+                get_mean_smallest_vectors(svecs, multi), self._lattice.T)
+        i = np.where(self._unique_first_atom_nums == patom_num)[0][0]
+        return self._mean_smallest_vectors[:, i]
+
     def _get_translational_invariance_matrix(self):
         timat = np.zeros((9, 9 * self._num_atom + 3))
         timat[:, 3:] = np.kron(np.ones(self._num_atom), np.eye(9))
@@ -133,27 +380,17 @@ class FC2Fit:
             rot_disps, rot_forces = self._get_matrices(first_atom_num)
             ones = np.ones(len(rot_disps)).reshape((-1, 1))
             fc = self._solve(np.hstack((ones, rot_disps)), rot_forces)
-            for i in range(self._num_atom):
-                self._fc2[first_atom_num, i] = fc[i, 1:, :]
+            self._fc2[first_atom_num] = fc[:, 1:, :]
 
     def _get_matrices(self, first_atom_num):
-        disps = []
-        sets_of_forces = []
-        for dataset_1st in self._dataset['first_atoms']:
-            if first_atom_num != dataset_1st['number']:
-                continue
-            disps.append(dataset_1st['displacement'])
-            sets_of_forces.append(dataset_1st['forces'])
-
-        site_symmetry = self._symmetry.get_site_symmetry(first_atom_num)
-        positions = (self._positions.copy() -
-                     self._positions[first_atom_num])
-        rot_map_syms = get_positions_sent_by_rot_inv(self._lattice,
-                                                     positions,
-                                                     site_symmetry,
-                                                     self._symprec)
-        site_sym_cart = [similarity_transformation(self._lattice, sym)
-                         for sym in site_symmetry]
+        indices = self._dataset.get_first_atom_indices(first_atom_num)
+        disps = self._dataset.get_displacements()[indices]
+        sets_of_forces = self._dataset.get_forces()[indices]
+
+        rot_map_syms = self._symmetry_cache.get_rot_map_syms(
+            (first_atom_num,))
+        site_sym_cart = self._symmetry_cache.get_rotations_cart(
+            (first_atom_num,))
         rot_disps = self._create_displacement_matrix(disps, site_sym_cart)
         rot_forces = self._create_force_matrix(sets_of_forces,
                                                site_sym_cart,
@@ -176,6 +413,24 @@ class FC2Fit:
                              sets_of_forces,
                              site_sym_cart,
                              rot_map_syms):
+        # [set, atom, sym, 3]
+        forces = np.array(sets_of_forces, dtype='double')[:, rot_map_syms.T]
+        force_matrix = np.einsum('kab,sikb->iska', site_sym_cart, forces)
+        return np.reshape(force_matrix, (self._num_atom, -1, 3))
+
+    def _create_displacement_matrix(self,
+                                    disps,
+                                    site_sym_cart):
+        rot_disps = np.einsum('kab,ub->uka',
+                              site_sym_cart,
+                              np.array(disps, dtype='double'))
+        return rot_disps.reshape(-1, 3)
+
+    def _create_force_matrix_loop(self,
+                                  sets_of_forces,
+                                  site_sym_cart,
+                                  rot_map_syms):
+        # Reference implementation of _create_force_matrix
         force_matrix = []
         for i in range(self._num_atom):
             for forces in sets_of_forces:
@@ -184,9 +439,10 @@ class FC2Fit:
                     force_matrix.append(np.dot(ssym_c, f))
         return np.reshape(force_matrix, (self._num_atom, -1, 3))
 
-    def _create_displacement_matrix(self,
-                                    disps,
-                                    site_sym_cart):
+    def _create_displacement_matrix_loop(self,
+                                         disps,
+                                         site_sym_cart):
+        # Reference implementation of _create_displacement_matrix
         rot_disps = []
         for u in disps:
             for ssym_c in site_sym_cart:
@@ -197,8 +453,12 @@ class FC2Fit:
 
     def _solve(self, rot_disps, rot_forces):
         inv_disps = self._pinv(rot_disps)
-        return np.array([-np.dot(inv_disps, f) for f in rot_forces],
-                        dtype='double')
+        # One GEMM for all atoms: (column, row) x (row, atom * 3)
+        forces = np.transpose(rot_forces, (1, 0, 2)).reshape(
+            inv_disps.shape[1], -1)
+        fc = np.dot(inv_disps, forces)
+        fc *= -1
+        return fc.reshape(len(inv_disps), -1, 3).transpose(1, 0, 2)
 
     def _pinv(self, matrix):
         try:
@@ -242,6 +502,12 @@ class FC2Fit:
                 inv_matrices.append(inv_mat)
         return inv_matrices
 
+def _inv(matrix, max_condition_number=1e12):
+    # np.linalg.inv raises LinAlgError only for exactly singular matrices.
+    if np.linalg.cond(matrix) > max_condition_number:
+        raise np.linalg.LinAlgError("Ill-conditioned matrix")
+    return np.linalg.inv(matrix)
+
 class FC2allFit:
     def __init__(self,
                  supercell,
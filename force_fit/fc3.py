@@ -1,26 +1,49 @@
 import sys
+import os
 import numpy as np
-from phonopy.harmonic.force_constants import (similarity_transformation,
-                                              get_positions_sent_by_rot_inv)
-from anharmonic.phonon3.displacement_fc3 import get_reduced_site_symmetry
 from anharmonic.phonon3.fc3 import distribute_fc3
+from force_fit.symmetry_cache import SymmetryCache
+from force_fit.pinv_cache import PinvCache
+from force_fit.dataset import get_displacement_dataset
 
 class FC3Fit:
+    """Fit fc3 (and fc2) of first displaced atoms to forces
+
+    pinv_cutoff is an absolute cutoff: singular values of displacement
+    matrices not larger than it are dropped in the pseudo-inversion.
+    This is what pinv_mt of the C extension has always done (with
+    1e-13), and the NumPy fallback does the same. Note that the fallback
+    used np.linalg.pinv, whose cutoff is relative to the largest
+    singular value, so its results differ from before for displacement
+    matrices with singular values around or below pinv_cutoff.
+
+    """
     def __init__(self,
                  supercell,
                  disp_dataset,
                  symmetry,
-                 verbose=False):
+                 verbose=False,
+                 pinv_cutoff=1e-13,
+                 symmetry_cache=None):
 
         self._scell = supercell
         self._lattice = supercell.get_cell().T
         self._positions = supercell.get_scaled_positions()
         self._num_atom = len(self._positions)
-        self._dataset = disp_dataset
+        self._dataset = get_displacement_dataset(disp_dataset)
         self._symmetry = symmetry
         self._verbose = verbose
+        if pinv_cutoff is None:
+            self._pinv_cutoff = 1e-13
+        else:
+            self._pinv_cutoff = pinv_cutoff
         
         self._symprec = symmetry.get_symmetry_tolerance()
+        if symmetry_cache is None:
+            self._symmetry_cache = SymmetryCache(supercell, symmetry)
+        else:
+            self._symmetry_cache = symmetry_cache
+        self._pinv_cache = PinvCache()
         
         self._fc2 = np.zeros((self._num_atom, self._num_atom, 3, 3),
                              dtype='double')
@@ -34,21 +57,23 @@ class FC3Fit:
         return self._fc3
         
     def _calculate(self):
-        unique_first_atom_nums = np.unique(
-            [x['number'] for x in self._dataset['first_atoms']])
+        unique_first_atom_nums = self._dataset.get_first_atom_numbers()
         
         for first_atom_num in unique_first_atom_nums:
             disp_pairs = []
             sets_of_forces = []
-            for dataset_1st in self._dataset['first_atoms']:
-                if first_atom_num != dataset_1st['number']:
-                    continue
-                d, f = self._collect_disp_pairs_and_forces(dataset_1st)
+            for first_index in self._dataset.get_first_atom_indices(
+                    first_atom_num):
+                d, f = self._collect_disp_pairs_and_forces(first_index)
                 disp_pairs.append(d)
                 sets_of_forces.append(f)
 
             self._fit(first_atom_num, disp_pairs, sets_of_forces)
 
+        if self._verbose:
+            self._symmetry_cache.show_statistics()
+            self._pinv_cache.show_statistics()
+
         rotations = self._symmetry.get_symmetry_operations()['rotations']
         translations = self._symmetry.get_symmetry_operations()['translations']
 
@@ -64,46 +89,138 @@ class FC3Fit:
         self._fc3 = fc3
 
     def _fit(self, first_atom_num, disp_pairs, sets_of_forces):
-        site_symmetry = self._symmetry.get_site_symmetry(first_atom_num)
-        positions = self._positions.copy() - self._positions[first_atom_num]
-        rot_map_syms = get_positions_sent_by_rot_inv(self._lattice,
-                                                     positions,
-                                                     site_symmetry,
-                                                     self._symprec)
+        rot_map_syms = self._symmetry_cache.get_rot_map_syms(
+            (first_atom_num,))
+        site_syms_cart = self._symmetry_cache.get_rotations_cart(
+            (first_atom_num,))
+
+        rot_disps_set = [
+            self._create_displacement_matrix(disp_pairs,
+                                             site_syms_cart,
+                                             rot_map_syms[:, second_atom_num])
+            for second_atom_num in range(self._num_atom)]
+        inv_disps_set = self._pinv_cache.get_pinvs(
+            rot_disps_set, pinv_func=self._invert_displacements)
 
         for second_atom_num in range(self._num_atom):
             rot_atom_map = rot_map_syms[:, second_atom_num]
-            rot_disps = self._create_displacement_matrix(disp_pairs,
-                                                         site_symmetry,
-                                                         rot_atom_map)
             rot_forces = self._create_force_matrix(sets_of_forces,
-                                                   site_symmetry,
+                                                   site_syms_cart,
                                                    rot_atom_map,
                                                    rot_map_syms)
-            fc = self._solve(rot_disps, rot_forces)
+            fc = self._solve(inv_disps_set[second_atom_num], rot_forces)
             fc2 = fc[:, 1:4, :].reshape((self._num_atom, 3, 3))
             fc2_2 = fc[:, 4:7, :].reshape((self._num_atom, 3, 3))
             fc3 = fc[:, 7:16, :].reshape((self._num_atom, 3, 3, 3))
             fc3_21 = fc[:, 16:25, :].reshape((self._num_atom, 3, 3, 3))
-            for i, j in list(np.ndindex(3, 3)):
-                self._fc3[first_atom_num, second_atom_num, :, i, j, :] = (
-                    fc3[:, i, j, :] + fc3_21[:, j, i, :]) / 2
+            fc3_sym = self._fc3[first_atom_num, second_atom_num]
+            np.add(fc3, fc3_21.swapaxes(1, 2), out=fc3_sym)
+            fc3_sym /= 2
 
-    def _solve(self, rot_disps, rot_forces):
-        fc = []
-        inv_disps = np.linalg.pinv(rot_disps)
-        for i in range(self._num_atom):
-            fc.append(-np.dot(inv_disps, rot_forces[i]))
-        
-        return np.array(fc)
+    def _invert_displacements(self, rot_disps_set):
+        try:
+            import anharmonic._forcefit as forcefit
+            row_nums = np.array([x.shape[0] for x in rot_disps_set],
+                                dtype='intc')
+            info = np.zeros(len(row_nums), dtype='intc')
+            max_row_num = max(row_nums)
+            column_num = rot_disps_set[0].shape[1]
+            rot_disps = np.zeros((len(row_nums), max_row_num * column_num),
+                                 dtype='double')
+            for i in range(len(row_nums)):
+                rot_disps[
+                    i, :row_nums[i] * column_num] = rot_disps_set[i].flatten()
+            inv_disps = np.zeros_like(rot_disps)
+            forcefit.pinv_mt(rot_disps,
+                             inv_disps,
+                             row_nums,
+                             max_row_num,
+                             column_num,
+                             self._pinv_cutoff,
+                             info)
+            inv_disps_set = [
+                inv_disps[i, :row_nums[i] * column_num].reshape(column_num, -1)
+                for i in range(len(row_nums))]
+        except ImportError:
+            # LAPACK called from numpy releases GIL.
+            from multiprocessing import cpu_count
+            from multiprocessing.pool import ThreadPool
+            num_threads = int(os.environ.get('OMP_NUM_THREADS', cpu_count()))
+            num_threads = min(num_threads, len(rot_disps_set))
+            if num_threads > 1:
+                pool = ThreadPool(num_threads)
+                inv_disps_set = pool.map(
+                    lambda d: _pinv(d, self._pinv_cutoff), rot_disps_set)
+                pool.close()
+                pool.join()
+            else:
+                inv_disps_set = [_pinv(d, self._pinv_cutoff)
+                                 for d in rot_disps_set]
+
+        return inv_disps_set
+
+    def _solve(self, inv_disps, rot_forces):
+        # One GEMM for all atoms: (column, row) x (row, atom * 3)
+        forces = np.transpose(rot_forces, (1, 0, 2)).reshape(
+            inv_disps.shape[1], -1)
+        fc = np.dot(inv_disps, forces)
+        fc *= -1
+        return fc.reshape(len(inv_disps), -1, 3).transpose(1, 0, 2)
 
     def _create_force_matrix(self,
                              sets_of_forces,
-                             site_symmetry,
+                             site_syms_cart,
                              rot_atom_map,
                              rot_map_syms):
-        site_syms_cart = [similarity_transformation(self._lattice, sym)
-                          for sym in site_symmetry]
+        forces, sym_indices = self._collect_by_symmetry(sets_of_forces,
+                                                        rot_atom_map)
+        # [row, atom, 3]
+        forces = forces[np.arange(len(forces))[:, None],
+                        rot_map_syms[sym_indices]]
+        force_matrix = np.einsum('rab,rib->ira',
+                                 site_syms_cart[sym_indices],
+                                 forces)
+        return np.array(force_matrix, dtype='double', order='C')
+
+    def _create_displacement_matrix(self,
+                                    disp_pairs,
+                                    site_syms_cart,
+                                    rot_atom_map):
+        disp_pairs, sym_indices = self._collect_by_symmetry(disp_pairs,
+                                                            rot_atom_map)
+        # [row, pair, 3]
+        rot_pairs = np.einsum('rab,rpb->rpa',
+                              site_syms_cart[sym_indices],
+                              disp_pairs)
+        Su1 = rot_pairs[:, 0]
+        Su2 = rot_pairs[:, 1]
+        rot_pair12 = np.einsum('ra,rb->rab', Su1, Su2).reshape(-1, 9) / 2
+        rot_pair21 = np.einsum('ra,rb->rab', Su2, Su1).reshape(-1, 9) / 2
+        rot_pair11 = np.einsum('ra,rb->rab', Su1, Su1).reshape(-1, 9) / 2
+        rot_pair22 = np.einsum('ra,rb->rab', Su2, Su2).reshape(-1, 9) / 2
+        ones = np.ones(len(rot_pairs)).reshape((-1, 1))
+
+        return np.hstack((ones, Su1, Su2,
+                          rot_pair12, rot_pair21, rot_pair11, rot_pair22))
+
+    def _collect_by_symmetry(self, values, rot_atom_map):
+        # Stack values[u1][rot_atom_num] in the order of rows of the
+        # matrices with indices of site symmetry operations.
+        stacked = []
+        sym_indices = []
+        for values_u1 in values:
+            for i, rot_atom_num in enumerate(rot_atom_map):
+                stacked += list(values_u1[rot_atom_num])
+                sym_indices += [i] * len(values_u1[rot_atom_num])
+        return (np.array(stacked, dtype='double'),
+                np.array(sym_indices, dtype='intc'))
+
+    def _create_force_matrix_loop(self,
+                                  sets_of_forces,
+                                  site_syms_cart,
+                                  rot_atom_map,
+                                  rot_map_syms):
+        # Reference implementation of _create_force_matrix
         force_matrix = []
         for i in range(self._num_atom):
             force_matrix_atom = []
@@ -116,10 +233,11 @@ class FC3Fit:
             force_matrix.append(force_matrix_atom)
         return np.array(force_matrix, dtype='double', order='C')
         
-    def _create_displacement_matrix(self,
-                                    disp_pairs,
-                                    site_symmetry,
-                                    rot_atom_map):
+    def _create_displacement_matrix_loop(self,
+                                         disp_pairs,
+                                         site_syms_cart,
+                                         rot_atom_map):
+        # Reference implementation of _create_displacement_matrix
         rot_disp1s = []
         rot_disp2s = []
         rot_pair12 = []
@@ -128,8 +246,7 @@ class FC3Fit:
         rot_pair22 = []
 
         for disp_pairs_u1 in disp_pairs:
-            for rot_atom_num, ssym in zip(rot_atom_map, site_symmetry):
-                ssym_c = similarity_transformation(self._lattice, ssym)
+            for rot_atom_num, ssym_c in zip(rot_atom_map, site_syms_cart):
                 for (u1, u2) in disp_pairs_u1[rot_atom_num]:
                     Su1 = np.dot(ssym_c, u1)
                     Su2 = np.dot(ssym_c, u2)
@@ -145,23 +262,22 @@ class FC3Fit:
         return np.hstack((ones, rot_disp1s, rot_disp2s,
                           rot_pair12, rot_pair21, rot_pair11, rot_pair22))
 
-    def _collect_disp_pairs_and_forces(self, dataset_1st):
-        second_atom_nums = [x['number'] for x in dataset_1st['second_atoms']]
-        unique_second_atom_nums = np.unique(second_atom_nums)
+    def _collect_disp_pairs_and_forces(self, first_index):
+        disps_2nd = self._dataset.get_displacements(1)
+        forces_2nd = self._dataset.get_forces(1)
+        second_indices = [
+            self._dataset.get_second_atom_indices(first_index, i)
+            for i in range(self._num_atom)]
+        unique_second_atom_nums = np.array(
+            [i for i, indices in enumerate(second_indices) if len(indices)],
+            dtype='intc')
 
         set_of_disps = []
         sets_of_forces = []
-        for second_atom_num in range(self._num_atom):
-            if second_atom_num in unique_second_atom_nums:
-                set_of_disps_atom2 = []
-                sets_of_forces_atom2 = []
-                for dataset_2nd in dataset_1st['second_atoms']:
-                    if dataset_2nd['number'] != second_atom_num:
-                        continue
-                    set_of_disps_atom2.append(dataset_2nd['displacement'])
-                    sets_of_forces_atom2.append(dataset_2nd['forces'])
-                set_of_disps.append(set_of_disps_atom2)
-                sets_of_forces.append(sets_of_forces_atom2)
+        for indices in second_indices:
+            if len(indices):
+                set_of_disps.append(list(disps_2nd[indices]))
+                sets_of_forces.append(list(forces_2nd[indices]))
             else:
                 set_of_disps.append(None)
                 sets_of_forces.append(None)
@@ -169,8 +285,8 @@ class FC3Fit:
         return self._distribute_displacements_and_forces(
             set_of_disps,
             sets_of_forces,
-            dataset_1st['number'],
-            dataset_1st['displacement'],
+            self._dataset.get_numbers()[first_index],
+            self._dataset.get_displacements()[first_index],
             unique_second_atom_nums)
                 
     def _distribute_displacements_and_forces(self,
@@ -179,15 +295,10 @@ class FC3Fit:
                                              first_atom_num,
                                              disp1,
                                              unique_second_atom_nums):
-        site_symmetry = self._symmetry.get_site_symmetry(first_atom_num)
-        direction = np.dot(np.linalg.inv(self._lattice), disp1)
-        reduced_site_sym = get_reduced_site_symmetry(
-            site_symmetry, direction, self._symprec)
-        positions = self._positions.copy() - self._positions[first_atom_num]
-        rot_map_syms = get_positions_sent_by_rot_inv(self._lattice,
-                                                     positions,
-                                                     reduced_site_sym,
-                                                     self._symprec)
+        reduced_site_syms_cart = self._symmetry_cache.get_rotations_cart(
+            (first_atom_num,), (disp1,))
+        rot_map_syms = self._symmetry_cache.get_rot_map_syms(
+            (first_atom_num,), (disp1,))
 
         disp_pairs = []
         for second_atom_num in range(self._num_atom):
@@ -198,7 +309,7 @@ class FC3Fit:
                     set_of_disps,
                     sets_of_forces,
                     unique_second_atom_nums,
-                    reduced_site_sym,
+                    reduced_site_syms_cart,
                     rot_map_syms)
                 disp_pairs.append(
                     [[disp1, d] for d in set_of_disps_atom2])
@@ -214,13 +325,13 @@ class FC3Fit:
                           set_of_disps,
                           sets_of_forces,
                           unique_second_atom_nums,
-                          reduced_site_sym,
+                          reduced_site_syms_cart,
                           rot_map_syms):
         sym_cart = None
         rot_atom_map = None
-        for i, sym in enumerate(reduced_site_sym):
+        for i, sym in enumerate(reduced_site_syms_cart):
             if rot_map_syms[i, second_atom_num] in unique_second_atom_nums:
-                sym_cart = similarity_transformation(self._lattice, sym)
+                sym_cart = sym
                 rot_atom_map = rot_map_syms[i, :]
                 break
 
@@ -236,3 +347,10 @@ class FC3Fit:
                  for d in set_of_disps[rot_atom_map[second_atom_num]]]
 
         return forces, disps
+
+def _pinv(matrix, cutoff):
+    # Singular values not larger than cutoff are dropped as in pinv_mt.
+    u, s, vt = np.linalg.svd(matrix, full_matrices=False)
+    s_inv = np.zeros_like(s)
+    s_inv[s > cutoff] = 1.0 / s[s > cutoff]
+    return np.dot(vt.T * s_inv, u.T)
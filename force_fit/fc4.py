@@ -1,37 +1,71 @@
 import sys
 import numpy as np
-from phonopy.harmonic.force_constants import (similarity_transformation,
-                                              get_positions_sent_by_rot_inv,
-                                              distribute_force_constants)
-from anharmonic.phonon3.displacement_fc3 import (get_reduced_site_symmetry,
-                                                 get_bond_symmetry)
+from phonopy.harmonic.force_constants import distribute_force_constants
 from anharmonic.phonon4.fc4 import distribute_fc4
 from anharmonic.phonon3.fc3 import distribute_fc3
+from force_fit.symmetry_cache import SymmetryCache
+from force_fit.pinv_cache import PinvCache
+from force_fit.dataset import get_displacement_dataset
+from force_fit.sparse_fc4 import SparseFC4
+from force_fit.smallest_vectors import get_smallest_distances
+from force_fit.parallel import (get_pool, get_shared_array,
+                                get_shared_file_array, get_shared_file_copy,
+                                open_shared_file_array,
+                                remove_shared_file_array)
 
 class FC4Fit:
     def __init__(self,
                  supercell,
                  disp_dataset,
                  symmetry,
-                 verbose=False):
+                 verbose=False,
+                 symmetry_cache=None,
+                 cutoff_distance=None,
+                 num_processes=1):
 
         self._scell = supercell
         self._lattice = supercell.get_cell().T
         self._positions = supercell.get_scaled_positions()
         self._num_atom = len(self._positions)
-        self._dataset = disp_dataset
+        self._dataset = get_displacement_dataset(disp_dataset)
         self._symmetry = symmetry
         self._verbose = verbose
         
         self._symprec = symmetry.get_symmetry_tolerance()
+        if symmetry_cache is None:
+            self._symmetry_cache = SymmetryCache(supercell, symmetry)
+        else:
+            self._symmetry_cache = symmetry_cache
+        self._pinv_cache = PinvCache()
+        # Worker processes run OpenMP kernels with one thread each (see
+        # force_fit.parallel.get_pool).
+        self._num_processes = num_processes
+        self._pool = None
+        self._has_disp_pairs = None
+
+        # With worker processes, force constants are written into memory
+        # shared with them.
+        if num_processes > 1:
+            zeros = get_shared_array
+        else:
+            zeros = np.zeros
         
-        self._fc2 = np.zeros((self._num_atom, self._num_atom, 3, 3),
-                             dtype='double')
-        self._fc3 = np.zeros((self._num_atom, self._num_atom, self._num_atom,
-                              3, 3, 3), dtype='double')
-        self._fc4 = np.zeros(
-            (self._num_atom, self._num_atom, self._num_atom, self._num_atom,
-             3, 3, 3, 3), dtype='double')
+        self._fc2 = zeros((self._num_atom, self._num_atom, 3, 3),
+                          dtype='double')
+        self._fc3 = zeros((self._num_atom, self._num_atom, self._num_atom,
+                           3, 3, 3), dtype='double')
+        self._cutoff_distance = cutoff_distance
+        if cutoff_distance is None:
+            self._fc4 = zeros(
+                (self._num_atom, self._num_atom, self._num_atom,
+                 self._num_atom, 3, 3, 3, 3), dtype='double')
+            self._is_within_cutoff = None
+        else:
+            # Atom quartets whose pairs are all within cutoff are fitted.
+            self._fc4 = SparseFC4(self._num_atom)
+            self._is_within_cutoff = (
+                get_smallest_distances(supercell, self._symprec) <
+                cutoff_distance + self._symprec)
 
     def run(self):
         self._calculate()
@@ -46,34 +80,57 @@ class FC4Fit:
         return self._fc4
         
     def _calculate(self):
-        unique_first_atom_nums = np.unique(
-            [x['number'] for x in self._dataset['first_atoms']])
-
-        for first_atom_num in unique_first_atom_nums:
-            disp_triplets = []
-            sets_of_forces = []
-            for dataset_1st in self._dataset['first_atoms']:
-                if first_atom_num != dataset_1st['number']:
-                    continue
-                d1 = dataset_1st['displacement']
-                d3, f = self._collect_forces_and_disps(dataset_1st)
-                disp_triplets.append(d3)
-                sets_of_forces.append(f)
-
-            self._fit(first_atom_num, disp_triplets, sets_of_forces)
+        unique_first_atom_nums = self._dataset.get_first_atom_numbers()
+
+        # One pool of workers for all first atoms. It is forked before
+        # any OpenMP kernel runs in this process.
+        if self._num_processes > 1:
+            _fit_context['fc4fit'] = self
+            self._pool = get_pool(self._num_processes)
+
+        try:
+            for first_atom_num in unique_first_atom_nums:
+                disp_triplets = []
+                sets_of_forces = []
+                for first_index in self._dataset.get_first_atom_indices(
+                        first_atom_num):
+                    d3, f = self._collect_forces_and_disps(first_index)
+                    disp_triplets.append(d3)
+                    sets_of_forces.append(f)
+
+                self._fit(first_atom_num, disp_triplets, sets_of_forces)
+        finally:
+            if self._pool is not None:
+                self._pool.close()
+                self._pool.join()
+                self._pool = None
+                _fit_context.clear()
+
+        if self._verbose:
+            self._symmetry_cache.show_statistics()
+            self._pinv_cache.show_statistics()
 
         rotations = self._symmetry.get_symmetry_operations()['rotations']
         translations = self._symmetry.get_symmetry_operations()['translations']
 
         print "ditributing fc4..."
-        distribute_fc4(self._fc4,
-                       unique_first_atom_nums,
-                       self._lattice,
-                       self._positions,
-                       rotations,
-                       translations,
-                       self._symprec,
-                       verbose=self._verbose)
+        if self._cutoff_distance is None:
+            distribute_fc4(self._fc4,
+                           unique_first_atom_nums,
+                           self._lattice,
+                           self._positions,
+                           rotations,
+                           translations,
+                           self._symprec,
+                           verbose=self._verbose)
+        else:
+            self._fc4.distribute(unique_first_atom_nums,
+                                 self._lattice,
+                                 self._positions,
+                                 rotations,
+                                 translations,
+                                 self._symprec,
+                                 verbose=self._verbose)
 
         # print "ditributing fc3..."
         # distribute_fc3(self._fc3,
@@ -96,73 +153,239 @@ class FC4Fit:
         #                            self._symprec)
 
     def _fit(self, first_atom_num, disp_triplets, sets_of_forces):
-        site_symmetry = self._symmetry.get_site_symmetry(first_atom_num)
-        positions = self._positions.copy() - self._positions[first_atom_num]
-        rot_map_syms = get_positions_sent_by_rot_inv(self._lattice,
-                                                     positions,
-                                                     site_symmetry,
-                                                     self._symprec)
-        site_syms_cart = np.array([similarity_transformation(self._lattice, sym)
-                                   for sym in site_symmetry],
-                                  dtype='double')
+        # Displacement matrices rarely repeat across first atoms.
+        self._pinv_cache.clear()
+        rot_map_syms = self._symmetry_cache.get_rot_map_syms(
+            (first_atom_num,))
+        site_syms_cart = self._symmetry_cache.get_rotations_cart(
+            (first_atom_num,))
 
         (disp_triplets_rearranged,
          num_triplets) = self._create_displacement_triplets_for_c(disp_triplets)
         max_num_disp = np.amax(num_triplets[:, :, :, 1])
-
-        for second_atom_num in range(self._num_atom):
-            print second_atom_num + 1
-
-            rot_disps_set = []
-            for third_atom_num in range(self._num_atom):
-                try:
-                    import anharmonic._forcefit as forcefit
-                    rot_disps_set.append(self._create_displacement_matrix_c(
-                            second_atom_num,
-                            third_atom_num,
-                            disp_triplets_rearranged,
-                            num_triplets,
-                            site_syms_cart,
-                            rot_map_syms,
-                            max_num_disp))
-                except ImportError:
-                    rot_disps_set.append(self._create_displacement_matrix(
-                            second_atom_num,
-                            third_atom_num,
-                            disp_triplets,
-                            site_syms_cart,
-                            rot_map_syms))
-                    
-                print third_atom_num + 1, rot_disps_set[third_atom_num].shape
-
-            inv_disps_set = self._invert_displacements(rot_disps_set)
-
-            for third_atom_num in range(self._num_atom):
-                rot_forces = self._create_force_matrix(
-                    second_atom_num,
-                    third_atom_num,
-                    sets_of_forces,
-                    site_syms_cart,
-                    rot_map_syms)
-
-                fc = self._solve(inv_disps_set[third_atom_num], rot_forces)
-
-                # For elements with index exchange symmetry 
-                fc2 = fc[:, 7:10, :].reshape((self._num_atom, 3, 3))
-                fc3 = fc[:, 46:55, :].reshape((self._num_atom, 3, 3, 3))
-                fc4 = fc[:, 172:199, :].reshape((self._num_atom, 3, 3, 3, 3))
-                self._fc2[third_atom_num] = fc2
-                self._fc3[second_atom_num, third_atom_num] = fc3
-                self._fc4[first_atom_num, second_atom_num, third_atom_num] = fc4
-
-                # # For all elements
-                # fc2 = fc[:, 7:10, :].reshape((self._num_atom, 3, 3))
-                # fc3 = fc[:, 55:64, :].reshape((self._num_atom, 3, 3, 3))
-                # fc4 = fc[:, 226:253, :].reshape((self._num_atom, 3, 3, 3, 3))
-                # self._fc2[third_atom_num] = fc2
-                # self._fc3[second_atom_num, third_atom_num] = fc3 * 2
-                # self._fc4[first_atom_num, second_atom_num, third_atom_num] = fc4 * 6
-
+        force_triplets = self._create_force_triplets(sets_of_forces)
+
+        # Pairs of second and third atoms without displacements, which
+        # appear in datasets generated with interaction cutoffs, are not
+        # fitted.
+        has_disps = num_triplets[:, :, :, 1].sum(axis=0) > 0
+        self._has_disp_pairs = has_disps[rot_map_syms[:, :, None],
+                                         rot_map_syms[:, None, :]].any(axis=0)
+        second_atom_nums = [
+            i for i in self._get_atoms_within_cutoff(first_atom_num)
+            if len(self._get_third_atom_nums(first_atom_num, i))]
+        last_second_atom_nums = self._get_last_second_atom_nums(
+            first_atom_num, second_atom_nums)
+
+        if self._num_processes > 1:
+            fc4_blocks = self._fit_parallel(first_atom_num,
+                                            second_atom_nums,
+                                            disp_triplets_rearranged,
+                                            num_triplets,
+                                            force_triplets,
+                                            site_syms_cart,
+                                            rot_map_syms,
+                                            last_second_atom_nums)
+        else:
+            fc4_blocks = []
+            for second_atom_num in second_atom_nums:
+                fc4_blocks += self._fit_second_atom(first_atom_num,
+                                                    second_atom_num,
+                                                    disp_triplets,
+                                                    force_triplets,
+                                                    disp_triplets_rearranged,
+                                                    num_triplets,
+                                                    max_num_disp,
+                                                    site_syms_cart,
+                                                    rot_map_syms,
+                                                    last_second_atom_nums)
+
+        for fc4_block in fc4_blocks:
+            self._fc4.append(*fc4_block)
+
+    def _fit_second_atom(self,
+                         first_atom_num,
+                         second_atom_num,
+                         disp_triplets,
+                         force_triplets,
+                         disp_triplets_rearranged,
+                         num_triplets,
+                         max_num_disp,
+                         site_syms_cart,
+                         rot_map_syms,
+                         last_second_atom_nums):
+        print second_atom_num + 1
+
+        third_atom_nums = self._get_third_atom_nums(first_atom_num,
+                                                    second_atom_num)
+        rot_disps_set = []
+        for third_atom_num in third_atom_nums:
+            try:
+                import anharmonic._forcefit as forcefit
+                rot_disps_set.append(self._create_displacement_matrix_c(
+                        second_atom_num,
+                        third_atom_num,
+                        disp_triplets_rearranged,
+                        num_triplets,
+                        site_syms_cart,
+                        rot_map_syms,
+                        max_num_disp))
+            except ImportError:
+                rot_disps_set.append(self._create_displacement_matrix(
+                        second_atom_num,
+                        third_atom_num,
+                        disp_triplets,
+                        site_syms_cart,
+                        rot_map_syms))
+                
+            print third_atom_num + 1, rot_disps_set[-1].shape
+
+        inv_disps_set = self._pinv_cache.get_pinvs(
+            rot_disps_set, pinv_func=self._invert_displacements)
+
+        fc4_blocks = []
+        for third_atom_num, inv_disps in zip(third_atom_nums,
+                                             inv_disps_set):
+            fourth_atom_nums = self._get_atoms_within_cutoff(
+                first_atom_num, second_atom_num, third_atom_num)
+            rot_forces = self._create_force_matrix(
+                second_atom_num,
+                third_atom_num,
+                force_triplets,
+                num_triplets,
+                site_syms_cart,
+                rot_map_syms,
+                fourth_atom_nums=fourth_atom_nums)
+
+            fc = self._solve(inv_disps, rot_forces)
+
+            # For elements with index exchange symmetry 
+            num_fourth = len(fourth_atom_nums)
+            fc2 = fc[:, 7:10, :].reshape((num_fourth, 3, 3))
+            fc3 = fc[:, 46:55, :].reshape((num_fourth, 3, 3, 3))
+            fc4 = fc[:, 172:199, :].reshape((num_fourth, 3, 3, 3, 3))
+
+            # fc2 is overwritten by later second atoms. Only the last one
+            # is written so that the result does not depend on the order
+            # in which second atoms are processed.
+            is_last = (last_second_atom_nums[third_atom_num,
+                                             fourth_atom_nums] ==
+                       second_atom_num)
+            self._fc2[third_atom_num, fourth_atom_nums[is_last]] = fc2[is_last]
+            self._fc3[second_atom_num, third_atom_num, fourth_atom_nums] = fc3
+            if self._cutoff_distance is None:
+                self._fc4[first_atom_num,
+                          second_atom_num,
+                          third_atom_num] = fc4
+            else:
+                fc4_blocks.append((first_atom_num,
+                                   second_atom_num,
+                                   third_atom_num,
+                                   fourth_atom_nums,
+                                   fc4))
+
+            # # For all elements
+            # fc2 = fc[:, 7:10, :].reshape((self._num_atom, 3, 3))
+            # fc3 = fc[:, 55:64, :].reshape((self._num_atom, 3, 3, 3))
+            # fc4 = fc[:, 226:253, :].reshape((self._num_atom, 3, 3, 3, 3))
+            # self._fc2[third_atom_num] = fc2
+            # self._fc3[second_atom_num, third_atom_num] = fc3 * 2
+            # self._fc4[first_atom_num, second_atom_num, third_atom_num] = fc4 * 6
+
+        return fc4_blocks
+
+    def _fit_parallel(self,
+                      first_atom_num,
+                      second_atom_nums,
+                      disp_triplets_rearranged,
+                      num_triplets,
+                      force_triplets,
+                      site_syms_cart,
+                      rot_map_syms,
+                      last_second_atom_nums):
+        # The workers were forked before these inputs were made. Large
+        # ones are passed through files mapped in memory, not by
+        # pickling. fc2, fc3 and dense fc4 are written by the workers
+        # into memory shared at fork. Blocks of sparse fc4 are written
+        # into a buffer in the same way at offsets fixed here.
+        descriptors = []
+        for array in (disp_triplets_rearranged, num_triplets, force_triplets):
+            descriptors.append(get_shared_file_copy(array)[1])
+
+        block_layout = []
+        block_offsets = {}
+        num_blocks = 0
+        if self._cutoff_distance is not None:
+            for second_atom_num in second_atom_nums:
+                for third_atom_num in self._get_third_atom_nums(
+                        first_atom_num, second_atom_num):
+                    fourth_atom_nums = self._get_atoms_within_cutoff(
+                        first_atom_num, second_atom_num, third_atom_num)
+                    block_layout.append((second_atom_num,
+                                         third_atom_num,
+                                         fourth_atom_nums,
+                                         num_blocks))
+                    block_offsets[(second_atom_num,
+                                   third_atom_num)] = num_blocks
+                    num_blocks += len(fourth_atom_nums)
+        fc4_blocks, descriptor = get_shared_file_array(
+            (num_blocks, 3, 3, 3, 3), dtype='double')
+        descriptors.append(descriptor)
+
+        args = (first_atom_num,
+                descriptors,
+                site_syms_cart,
+                rot_map_syms,
+                last_second_atom_nums,
+                self._has_disp_pairs,
+                block_offsets)
+        try:
+            results = self._pool.map(
+                _fit_second_atoms,
+                [(second_atom_nums[i::self._num_processes],) + args
+                 for i in range(self._num_processes)])
+            fc4_blocks = [
+                (first_atom_num,
+                 second_atom_num,
+                 third_atom_num,
+                 fourth_atom_nums,
+                 np.array(fc4_blocks[offset:(offset + len(fourth_atom_nums))]))
+                for (second_atom_num,
+                     third_atom_num,
+                     fourth_atom_nums,
+                     offset) in block_layout]
+        finally:
+            for descriptor in descriptors:
+                remove_shared_file_array(descriptor)
+
+        # Pseudo-inverse caches of the workers
+        for num_inversions, num_avoided in results:
+            self._pinv_cache.add_statistics(num_inversions, num_avoided)
+
+        return fc4_blocks
+
+    def _get_last_second_atom_nums(self, first_atom_num, second_atom_nums):
+        last_second_atom_nums = np.zeros((self._num_atom, self._num_atom),
+                                         dtype='intc')
+        for second_atom_num in second_atom_nums:
+            for third_atom_num in self._get_third_atom_nums(
+                first_atom_num, second_atom_num):
+                fourth_atom_nums = self._get_atoms_within_cutoff(
+                    first_atom_num, second_atom_num, third_atom_num)
+                last_second_atom_nums[third_atom_num,
+                                      fourth_atom_nums] = second_atom_num
+        return last_second_atom_nums
+
+    def _get_third_atom_nums(self, first_atom_num, second_atom_num):
+        third_atom_nums = self._get_atoms_within_cutoff(first_atom_num,
+                                                        second_atom_num)
+        return third_atom_nums[
+            self._has_disp_pairs[second_atom_num, third_atom_nums]]
+
+    def _get_atoms_within_cutoff(self, *atom_nums):
+        if self._is_within_cutoff is None:
+            return np.arange(self._num_atom)
+        return np.where(self._is_within_cutoff[list(atom_nums)].all(axis=0))[0]
 
     def _invert_displacements(self, rot_disps_set):
         try:
@@ -172,9 +395,9 @@ class FC4Fit:
             info = np.zeros(len(row_nums), dtype='intc')
             max_row_num = max(row_nums)
             column_num = rot_disps_set[0].shape[1]
-            rot_disps = np.zeros((self._num_atom, max_row_num * column_num),
+            rot_disps = np.zeros((len(row_nums), max_row_num * column_num),
                                  dtype='double')
-            for i in range(self._num_atom):
+            for i in range(len(row_nums)):
                 rot_disps[
                     i, :row_nums[i] * column_num] = rot_disps_set[i].flatten()
             inv_disps = np.zeros_like(rot_disps)
@@ -187,7 +410,7 @@ class FC4Fit:
                              info)
             inv_disps_set = [
                 inv_disps[i, :row_nums[i] * column_num].reshape(column_num, -1)
-                for i in range(self._num_atom)]
+                for i in range(len(row_nums))]
             
         except ImportError:
             inv_disps_set = [np.linalg.pinv(d) for d in rot_disps_set]
@@ -195,21 +418,58 @@ class FC4Fit:
         return inv_disps_set
     
     def _solve(self, inv_disps, rot_forces):
-        fc = []
-        for i in range(self._num_atom):
-            fc.append(-np.dot(inv_disps, rot_forces[i]))
-        
-        return np.array(fc)
+        # One GEMM for all atoms: (column, row) x (row, atom * 3)
+        forces = np.transpose(rot_forces, (1, 0, 2)).reshape(
+            inv_disps.shape[1], -1)
+        fc = np.dot(inv_disps, forces)
+        fc *= -1
+        return fc.reshape(len(inv_disps), -1, 3).transpose(1, 0, 2)
 
     def _create_force_matrix(self,
                              second_atom_num,
                              third_atom_num,
-                             sets_of_forces,
+                             force_triplets,
+                             num_triplets,
                              site_syms_cart,
-                             rot_map_syms):
+                             rot_map_syms,
+                             fourth_atom_nums=None):
+        if fourth_atom_nums is None:
+            fourth_atom_nums = np.arange(self._num_atom)
+
+        # Rows are ordered by (first displacement, site symmetry,
+        # displacement triplet) as in _create_displacement_matrix.
+        address_num = num_triplets[:,
+                                   rot_map_syms[:, second_atom_num],
+                                   rot_map_syms[:, third_atom_num]]
+        addresses = address_num[:, :, 0].ravel()
+        nums = address_num[:, :, 1].ravel()
+        row_sym_indices = np.repeat(
+            np.tile(np.arange(len(rot_map_syms)), len(num_triplets)), nums)
+        row_addresses = (np.arange(nums.sum()) +
+                         np.repeat(addresses - np.cumsum(nums) + nums, nums))
+
+        # [row, fourth atom, 3]
+        forces = force_triplets[
+            row_addresses[:, None],
+            rot_map_syms[row_sym_indices][:, fourth_atom_nums]]
+        force_matrix = np.einsum('rab,rlb->lra',
+                                 site_syms_cart[row_sym_indices],
+                                 forces)
+        return np.array(force_matrix, dtype='double', order='C')
+
+    def _create_force_matrix_loop(self,
+                                  second_atom_num,
+                                  third_atom_num,
+                                  sets_of_forces,
+                                  site_syms_cart,
+                                  rot_map_syms,
+                                  fourth_atom_nums=None):
+        # Reference implementation of _create_force_matrix
+        if fourth_atom_nums is None:
+            fourth_atom_nums = range(self._num_atom)
         force_matrix = []
 
-        for fourth_atom_num in range(self._num_atom):
+        for fourth_atom_num in fourth_atom_nums:
             force_matrix_atom = []
             for forces in sets_of_forces:
                 for rot_atom_map, sym in zip(rot_map_syms, site_syms_cart):
@@ -245,6 +505,27 @@ class FC4Fit:
 
         return np.array(rot_disps, dtype='double')
                     
+    def _create_force_triplets(self, sets_of_forces):
+        # Forces in the same order as _create_displacement_triplets_for_c
+        forces = []
+        for i in range(len(sets_of_forces)):
+            for j in range(self._num_atom):
+                for k in range(self._num_atom):
+                    forces += list(sets_of_forces[i][j][k])
+        return np.array(forces, dtype='double')
+
+    def _get_nested_triplets(self, triplets, num_triplets):
+        # Inverse of _create_displacement_triplets_for_c made of views
+        nested = []
+        for i in range(len(num_triplets)):
+            nested.append([])
+            for j in range(self._num_atom):
+                nested[i].append([])
+                for k in range(self._num_atom):
+                    address, num_disp = num_triplets[i, j, k]
+                    nested[i][j].append(triplets[address:(address + num_disp)])
+        return nested
+
     def _create_displacement_triplets_for_c(self, disp_triplets):
         num_disps = np.zeros(
             (len(disp_triplets), self._num_atom, self._num_atom, 2),
@@ -359,44 +640,38 @@ class FC4Fit:
                         tensor.append(u1x * u2x * u3x)
         return tensor
                         
-    def _collect_forces_and_disps(self, dataset_1st):
-        disp1 = dataset_1st['displacement']
+    def _collect_forces_and_disps(self, first_index):
+        dataset = self._dataset
+        disp1 = dataset.get_displacements()[first_index]
         disps = [None] * self._num_atom
         forces = [None] * self._num_atom
-        first_atom_num = dataset_1st['number']
-        reduced_site_sym = self._get_reduced_site_sym(dataset_1st)
+        first_atom_num = dataset.get_numbers()[first_index]
+        disps_2nd = dataset.get_displacements(1)
+        disps_3rd = dataset.get_displacements(2)
+        forces_3rd = dataset.get_forces(2)
 
         for i in range(self._num_atom):
-            for dataset_2nd in dataset_1st['second_atoms']:
-                if dataset_2nd['number'] != i:
-                    continue
-                disp2 = dataset_2nd['displacement']
+            for second_index in dataset.get_second_atom_indices(first_index,
+                                                                i):
+                disp2 = disps_2nd[second_index]
                 disps_3 = [None] * self._num_atom
                 forces_3 = [None] * self._num_atom
                 for j in range(self._num_atom):
-                    for dataset_3rd in dataset_2nd['third_atoms']:
-                        if dataset_3rd['number'] != j:
-                            continue
-                        if disps_3[j] is None:
-                            disps_3[j] = []
-                            forces_3[j] = []
-                        disps_3[j].append(
-                            [disp1, disp2, dataset_3rd['displacement']])
-                        forces_3[j].append(dataset_3rd['forces'])
+                    third_indices = dataset.get_third_atom_indices(
+                        second_index, j)
+                    if len(third_indices):
+                        disps_3[j] = [[disp1, disp2, d3]
+                                      for d3 in disps_3rd[third_indices]]
+                        forces_3[j] = list(forces_3rd[third_indices])
 
                 for j in range(self._num_atom):
                     if disps_3[j] is None:
-                        reduced_bond_sym = self._get_reduced_bond_sym(
-                            reduced_site_sym,
-                            first_atom_num,
-                            i,
-                            disp2)
                         self._distribute_3(
                             disps_3,
                             forces_3,
-                            i,
-                            j,
-                            reduced_bond_sym)
+                            (first_atom_num, i),
+                            (disp1, disp2),
+                            j)
                 
                 if disps[i] is None:
                     disps[i] = []
@@ -415,8 +690,8 @@ class FC4Fit:
                     disps,
                     forces,
                     first_atom_num,
-                    i,
-                    reduced_site_sym)
+                    disp1,
+                    i)
                 
         return disps, forces
 
@@ -424,26 +699,32 @@ class FC4Fit:
                       disps,
                       forces,
                       first_atom_num,
-                      second_atom_num,
-                      reduced_site_sym):
-        positions = self._positions.copy() - self._positions[first_atom_num]
-        rot_map_syms = get_positions_sent_by_rot_inv(self._lattice,
-                                                     positions,
-                                                     reduced_site_sym,
-                                                     self._symprec)
+                      disp1,
+                      second_atom_num):
+        rot_map_syms = self._symmetry_cache.get_rot_map_syms(
+            (first_atom_num,), (disp1,))
+        reduced_site_syms_cart = self._symmetry_cache.get_rotations_cart(
+            (first_atom_num,), (disp1,))
 
         sym_cart = None
         rot_atom_map = None
-        for i, sym in enumerate(reduced_site_sym):
+        for i, sym in enumerate(reduced_site_syms_cart):
             if disps[rot_map_syms[i, second_atom_num]] is not None:
-                sym_cart = similarity_transformation(self._lattice, sym)
+                sym_cart = sym
                 rot_atom_map = rot_map_syms[i, :]
                 break
 
-        assert sym_cart is not None, "Something is wrong."
-
         forces[second_atom_num] = []
         disps[second_atom_num] = []
+
+        # No second atom of the orbit is displaced when the dataset was
+        # generated with interaction cutoffs.
+        if sym_cart is None:
+            for i in range(self._num_atom):
+                forces[second_atom_num].append([])
+                disps[second_atom_num].append([])
+            return
+
         for i in range(self._num_atom):
             forces_2 = [
                 np.dot(f[rot_atom_map], sym_cart.T)
@@ -458,24 +739,28 @@ class FC4Fit:
     def _distribute_3(self,
                       disps_3,
                       forces_3,
-                      second_atom_num,
-                      third_atom_num,
-                      reduced_bond_sym):
-        positions = self._positions.copy() - self._positions[second_atom_num]
-        rot_map_syms = get_positions_sent_by_rot_inv(self._lattice,
-                                                     positions,
-                                                     reduced_bond_sym,
-                                                     self._symprec)
+                      atom_nums,
+                      bond_disps,
+                      third_atom_num):
+        rot_map_syms = self._symmetry_cache.get_rot_map_syms(atom_nums,
+                                                             bond_disps)
+        reduced_bond_syms_cart = self._symmetry_cache.get_rotations_cart(
+            atom_nums, bond_disps)
 
         sym_cart = None
         rot_atom_map = None
-        for i, sym in enumerate(reduced_bond_sym):
+        for i, sym in enumerate(reduced_bond_syms_cart):
             if disps_3[rot_map_syms[i, third_atom_num]] is not None:
-                sym_cart = similarity_transformation(self._lattice, sym)
+                sym_cart = sym
                 rot_atom_map = rot_map_syms[i, :]
                 break
 
-        assert sym_cart is not None, "Something is wrong."
+        # No third atom of the orbit is displaced when the dataset was
+        # generated with interaction cutoffs.
+        if sym_cart is None:
+            disps_3[third_atom_num] = []
+            forces_3[third_atom_num] = []
+            return
 
         forces = [np.dot(f[rot_atom_map], sym_cart.T)
                   for f in forces_3[rot_atom_map[third_atom_num]]]
@@ -485,30 +770,49 @@ class FC4Fit:
         disps_3[third_atom_num] = disps
         forces_3[third_atom_num] = forces
 
-    def _get_reduced_site_sym(self, dataset_1st):
-        disp1 = dataset_1st['displacement']
-        first_atom_num = dataset_1st['number']
-        site_symmetry = self._symmetry.get_site_symmetry(first_atom_num)
-        direction = np.dot(np.linalg.inv(self._lattice), disp1)
-        reduced_site_sym = get_reduced_site_symmetry(site_symmetry,
-                                                     direction,
-                                                     self._symprec)
-        return reduced_site_sym
-
-    def _get_reduced_bond_sym(self,
-                              reduced_site_sym,
-                              first_atom_num,
-                              second_atom_num,
-                              disp2):
-        bond_sym = get_bond_symmetry(
-            reduced_site_sym,
-            self._positions,
-            first_atom_num,
-            second_atom_num,
-            self._symprec)
-        direction = np.dot(np.linalg.inv(self._lattice), disp2)
-        reduced_bond_sym = get_reduced_site_symmetry(
-            bond_sym, direction, self._symprec)
-
-        return reduced_bond_sym
-
+_fit_context = {}
+
+def _fit_second_atoms(args):
+    # Run in worker processes forked by FC4Fit._calculate
+    (second_atom_nums,
+     first_atom_num,
+     descriptors,
+     site_syms_cart,
+     rot_map_syms,
+     last_second_atom_nums,
+     has_disp_pairs,
+     block_offsets) = args
+    fc4fit = _fit_context['fc4fit']
+    pinv_cache = fc4fit._pinv_cache
+    if _fit_context.get('first_atom_num') != first_atom_num:
+        # As in FC4Fit._fit
+        pinv_cache.clear()
+        _fit_context['first_atom_num'] = first_atom_num
+    fc4fit._has_disp_pairs = has_disp_pairs
+    (disp_triplets_rearranged,
+     num_triplets,
+     force_triplets,
+     fc4_blocks) = [open_shared_file_array(d) for d in descriptors]
+    disp_triplets = fc4fit._get_nested_triplets(
+        disp_triplets_rearranged.reshape(-1, 3, 3), num_triplets)
+    max_num_disp = np.amax(num_triplets[:, :, :, 1])
+
+    num_inversions = pinv_cache.get_number_of_inversions()
+    num_avoided = pinv_cache.get_number_of_avoided_inversions()
+    for second_atom_num in second_atom_nums:
+        for (_, _, third_atom_num, fourth_atom_nums,
+             fc4) in fc4fit._fit_second_atom(first_atom_num,
+                                             second_atom_num,
+                                             disp_triplets,
+                                             force_triplets,
+                                             disp_triplets_rearranged,
+                                             num_triplets,
+                                             max_num_disp,
+                                             site_syms_cart,
+                                             rot_map_syms,
+                                             last_second_atom_nums):
+            offset = block_offsets[(second_atom_num, third_atom_num)]
+            fc4_blocks[offset:(offset + len(fourth_atom_nums))] = fc4
+
+    return (pinv_cache.get_number_of_inversions() - num_inversions,
+            pinv_cache.get_number_of_avoided_inversions() - num_avoided)
@@ -0,0 +1,73 @@
+import os
+import mmap
+import tempfile
+import numpy as np
+
+def get_pool(num_processes):
+    """Pool of worker processes forked from the current process
+
+    The workers run OpenMP kernels with one thread. The OpenMP runtime
+    (libgomp) is not fork-safe once its thread team has been started in
+    the parent, e.g., by pinv_mt, and a forked child may hang when it
+    starts a new team. A single thread does not use the team. This also
+    keeps the number of busy threads at num_processes instead of
+    num_processes times OMP_NUM_THREADS.
+
+    """
+    from multiprocessing import Pool
+    return Pool(num_processes, initializer=_init_worker)
+
+def get_shared_array(shape, dtype='double'):
+    # Anonymous shared mapping is inherited by forked processes.
+    dtype = np.dtype(dtype)
+    count = int(np.prod(shape))
+    buf = mmap.mmap(-1, max(count * dtype.itemsize, 1))
+    return np.frombuffer(buf, dtype=dtype, count=count).reshape(shape)
+
+def get_shared_copy(array):
+    shared_array = get_shared_array(array.shape, dtype=array.dtype)
+    shared_array[:] = array
+    return shared_array
+
+def get_shared_file_array(shape, dtype='double'):
+    """Zero array in a file mapped in memory and its descriptor
+
+    Unlike get_shared_array, this is seen by workers forked before it
+    was made. They open it by the descriptor with open_shared_file_array.
+    The file is removed by remove_shared_file_array.
+
+    """
+    if os.path.isdir('/dev/shm'):
+        shm_dir = '/dev/shm'
+    else:
+        shm_dir = None
+    fd, filename = tempfile.mkstemp(prefix='force_fit-', dir=shm_dir)
+    os.close(fd)
+    descriptor = (filename, np.dtype(dtype).str, tuple(shape))
+    return open_shared_file_array(descriptor, mode='w+'), descriptor
+
+def get_shared_file_copy(array):
+    shared_array, descriptor = get_shared_file_array(array.shape,
+                                                     dtype=array.dtype)
+    shared_array[:] = array
+    return shared_array, descriptor
+
+def open_shared_file_array(descriptor, mode='r+'):
+    filename, dtype, shape = descriptor
+    count = int(np.prod(shape))
+    # np.memmap does not map zero bytes.
+    array = np.memmap(filename, dtype=dtype, mode=mode,
+                      shape=(max(count, 1),))
+    return array[:count].reshape(shape)
+
+def remove_shared_file_array(descriptor):
+    os.remove(descriptor[0])
+
+def _init_worker():
+    # For libraries loaded after fork
+    os.environ['OMP_NUM_THREADS'] = '1'
+    try:
+        import anharmonic._forcefit as forcefit
+        forcefit.set_num_threads(1)
+    except ImportError:
+        pass
@@ -9,7 +9,9 @@ from phonopy.structure.symmetry import Symmetry
 from phonopy.structure.cells import get_supercell, get_primitive
 from anharmonic.phonon4.displacement_fc4 import get_fourth_order_displacements
 from anharmonic.phonon4.displacement_fc4 import direction_to_displacement
+from anharmonic.phonon4.displacement_fc4 import fill_excluded_displacements
 from anharmonic.file_IO import write_frequency_shift
+from force_fit.dataset import get_displacement_dataset, get_dict_dataset
 
 class Phono4py:
     def __init__(self,
@@ -101,16 +103,30 @@ class Phono4py:
     def generate_displacements(self,
                                distance=0.03,
                                is_plusminus='auto',
-                               is_diagonal=True):
+                               is_diagonal=True,
+                               cutoff_pair_distance=None,
+                               cutoff_triplet_distance=None,
+                               max_num_shells=None):
         direction_dataset = get_fourth_order_displacements(
             self._supercell,
             self._symmetry,
             is_plusminus=is_plusminus,
-            is_diagonal=is_diagonal)
+            is_diagonal=is_diagonal,
+            cutoff_pair_distance=cutoff_pair_distance,
+            cutoff_triplet_distance=cutoff_triplet_distance,
+            max_num_shells=max_num_shells)
         self._displacement_dataset = direction_to_displacement(
             direction_dataset,
             distance,
             self._supercell)
+        dataset = self._displacement_dataset
+        dataset['is_diagonal'] = is_diagonal
+        if cutoff_pair_distance is not None:
+            dataset['cutoff_pair_distance'] = cutoff_pair_distance
+        if cutoff_triplet_distance is not None:
+            dataset['cutoff_triplet_distance'] = cutoff_triplet_distance
+        if max_num_shells is not None:
+            dataset['max_num_shells'] = max_num_shells
 
     def produce_fc4(self,
                     forces_fc4,
@@ -118,12 +134,36 @@ class Phono4py:
                     translational_symmetry_type=0,
                     is_permutation_symmetry=False,
                     is_permutation_symmetry_fc3=False,
-                    is_permutation_symmetry_fc2=False):
-        disp_dataset = displacement_dataset
-        file_count = 0
-        for disp1 in disp_dataset['first_atoms']:
-            disp1['forces'] = forces_fc4[file_count]
-            file_count += 1
+                    is_permutation_symmetry_fc2=False,
+                    scratch_dir=None,
+                    num_processes=1,
+                    is_diagonal=None):
+        dataset = get_displacement_dataset(displacement_dataset)
+        if forces_fc4 is not None:
+            dataset.set_forces(forces_fc4)
+        disp_dataset = get_dict_dataset(dataset, is_delta_forces=True)
+
+        # Displacements excluded by interaction cutoffs are added with zero
+        # delta forces. The cutoffs and is_diagonal are recorded in the
+        # dataset by generate_displacements and in disp_fc4.yaml.
+        if isinstance(displacement_dataset, dict):
+            generation = displacement_dataset
+        else:
+            generation = {}
+        if ('cutoff_pair_distance' in generation or
+            'cutoff_triplet_distance' in generation or
+            'max_num_shells' in generation):
+            if is_diagonal is None:
+                is_diagonal = generation.get('is_diagonal')
+            num_excluded = fill_excluded_displacements(
+                disp_dataset,
+                self._supercell,
+                self._symmetry,
+                is_diagonal=is_diagonal)
+            if self._log_level:
+                print "Number of displacements excluded by cutoffs:",
+                print num_excluded
+
         self._fc2 = get_fc2(self._supercell, self._symmetry, disp_dataset)
         if is_permutation_symmetry_fc2:
             set_permutation_symmetry(self._fc2)
@@ -132,12 +172,6 @@ class Phono4py:
                 self._fc2,
                 translational_symmetry_type=translational_symmetry_type)
         
-        for disp1 in disp_dataset['first_atoms']:
-            for disp2 in disp1['second_atoms']:
-                disp2['forces'] = forces_fc4[file_count]
-                disp2['delta_forces'] = disp2['forces'] - disp1['forces']
-                file_count += 1
-
         self._fc3 = get_fc3(
             self._supercell,
             disp_dataset,
@@ -147,13 +181,6 @@ class Phono4py:
             is_permutation_symmetry=is_permutation_symmetry_fc3,
             verbose=self._log_level)
 
-        for disp1 in disp_dataset['first_atoms']:
-            for disp2 in disp1['second_atoms']:
-                for disp3 in disp2['third_atoms']:
-                    disp3['delta_forces'] = (forces_fc4[file_count] -
-                                             disp2['forces'])
-                    file_count += 1
-        
         self._fc4 = get_fc4(
             self._supercell,
             disp_dataset,
@@ -161,6 +188,8 @@ class Phono4py:
             self._symmetry,
             translational_symmetry_type=translational_symmetry_type,
             is_permutation_symmetry=is_permutation_symmetry,
+            scratch_dir=scratch_dir,
+            num_processes=num_processes,
             verbose=self._log_level)
 
     def set_frequency_shift(self, temperatures=None):
@@ -2,6 +2,7 @@ import numpy as np
 from phonopy.harmonic.displacement import get_least_displacements, \
     get_displacement, directions_axis, is_minus_displacement
 from anharmonic.phonon3.displacement_fc3 import get_reduced_site_symmetry, get_least_orbits, get_next_displacements, get_bond_symmetry
+from force_fit.smallest_vectors import get_smallest_distances
 
 def direction_to_displacement(dataset,
                               distance,
@@ -46,7 +47,10 @@ def direction_to_displacement(dataset,
 def get_fourth_order_displacements(cell,
                                    symmetry,
                                    is_plusminus='auto',
-                                   is_diagonal=False):
+                                   is_diagonal=False,
+                                   cutoff_pair_distance=None,
+                                   cutoff_triplet_distance=None,
+                                   max_num_shells=None):
     # Atoms 1, 2, and 3 are defined as follows:
     #
     # Atom 1: The first displaced atom. Fourth order force constant
@@ -69,6 +73,17 @@ def get_fourth_order_displacements(cell,
     #                                       [[-0.007071, 0.000000, -0.007071],
     #                                        ,...]}, {...}, ... ]},
 
+    # Interaction cutoffs
+    #
+    # Atom 2 is displaced only if the distance between Atoms 1 and 2 is
+    # within cutoff_pair_distance. Atom 3 is displaced only if the
+    # distances of all pairs of Atoms 1, 2, and 3 are within
+    # cutoff_triplet_distance. With max_num_shells, the atoms are also
+    # limited to the neighbour shells of Atom 1 (and Atom 2 for Atom 3).
+    # Distances are measured under the minimum image convention.
+    # Displacements of excluded atoms are not generated, i.e., their fc4
+    # elements are treated as zero (see fill_excluded_displacements).
+
     # Least displacements of first atoms (Atom 1) are searched by
     # using respective site symmetries of the original crystal.
     disps_first = get_least_displacements(symmetry,
@@ -76,6 +91,12 @@ def get_fourth_order_displacements(cell,
                                           is_diagonal=False)
 
     symprec = symmetry.get_symmetry_tolerance()
+    is_pair_included, is_triplet_included = _get_included_pairs(
+        cell,
+        symprec,
+        cutoff_pair_distance,
+        cutoff_triplet_distance,
+        max_num_shells)
 
     dds = []
     for disp in disps_first:
@@ -93,6 +114,8 @@ def get_fourth_order_displacements(cell,
                                         symprec)
         
         for atom2 in second_atoms:
+            if not is_pair_included[atom1, atom2]:
+                continue
             reduced_bond_sym = get_bond_symmetry(
                 reduced_site_sym,
                 cell.get_scaled_positions(),
@@ -100,6 +123,9 @@ def get_fourth_order_displacements(cell,
                 atom2,
                 symprec)
 
+            is_third_included = (is_triplet_included[atom1] &
+                                 is_triplet_included[atom2] &
+                                 is_triplet_included[atom1, atom2])
             for disp2 in _get_displacements_second(reduced_bond_sym,
                                                    symprec,
                                                    is_diagonal):
@@ -108,7 +134,8 @@ def get_fourth_order_displacements(cell,
                                                       cell,
                                                       reduced_bond_sym,
                                                       symprec,
-                                                      is_diagonal)
+                                                      is_diagonal,
+                                                      is_third_included)
                 dds_atom1['second_atoms'].append(dds_atom2)
         dds.append(dds_atom1)
 
@@ -135,7 +162,8 @@ def _get_second_displacements(atom2,
                               cell,
                               reduced_bond_sym,
                               symprec,
-                              is_diagonal):
+                              is_diagonal,
+                              is_third_included=None):
     positions = cell.get_scaled_positions()
     dds_atom2 = {'number': atom2,
                  'direction': disp2,
@@ -149,6 +177,8 @@ def _get_second_displacements(atom2,
                                    symprec)
 
     for atom3 in third_atoms:
+        if is_third_included is not None and not is_third_included[atom3]:
+            continue
         reduced_plane_sym = get_bond_symmetry(
             reduced_bond_sym2,
             cell.get_scaled_positions(),
@@ -164,3 +194,183 @@ def _get_second_displacements(atom2,
         dds_atom2['third_atoms'].append(dds_atom3)
 
     return dds_atom2
+
+def fill_excluded_displacements(disp_dataset,
+                                cell,
+                                symmetry,
+                                is_diagonal=None):
+    """Add displacements excluded by interaction cutoffs with zero forces
+
+    Displacement dataset generated with cutoffs lacks second and third
+    atoms of some orbits, which are required to distribute fc3 and delta
+    fc3 by site symmetry. The displacements that
+    get_fourth_order_displacements would have generated without cutoffs
+    are added to disp_dataset in place, with forces of the parent
+    displacements, i.e., with zero delta forces, so that the force
+    constants of the excluded atoms become zero. The number of added
+    displacements is returned.
+
+    is_diagonal has to be the value used to generate the dataset. If it
+    is None, disp_dataset['is_diagonal'] is used, and without it, the
+    dataset is regarded as diagonal if it has a displacement not
+    parallel to a lattice vector.
+
+    """
+    lattice = cell.get_cell()
+    positions = cell.get_scaled_positions()
+    symprec = symmetry.get_symmetry_tolerance()
+    if is_diagonal is None:
+        if 'is_diagonal' in disp_dataset:
+            is_diagonal = disp_dataset['is_diagonal']
+        else:
+            is_diagonal = _has_diagonal_displacement(disp_dataset, lattice)
+
+    num_added = 0
+    for disp1 in disp_dataset['first_atoms']:
+        if 'forces' not in disp1:
+            continue
+        atom1 = disp1['number']
+        reduced_site_sym = get_reduced_site_symmetry(
+            symmetry.get_site_symmetry(atom1),
+            _get_direction(disp1, lattice),
+            symprec)
+        if 'second_atoms' not in disp1:
+            disp1['second_atoms'] = []
+        disps_second = _get_displacement_indices(disp1['second_atoms'],
+                                                 lattice)
+
+        for atom2 in get_least_orbits(atom1, cell, reduced_site_sym, symprec):
+            reduced_bond_sym = get_bond_symmetry(reduced_site_sym,
+                                                 positions,
+                                                 atom1,
+                                                 atom2,
+                                                 symprec)
+            for disp2 in _get_displacements_second(reduced_bond_sym,
+                                                   symprec,
+                                                   is_diagonal):
+                dds_atom2 = _get_second_displacements(atom2,
+                                                      disp2,
+                                                      cell,
+                                                      reduced_bond_sym,
+                                                      symprec,
+                                                      is_diagonal)
+                index = disps_second.get(_get_displacement_key(atom2,
+                                                               disp2))
+                if index is None:
+                    disp_atom2 = _get_excluded_displacement(atom2,
+                                                            disp2,
+                                                            disp1,
+                                                            lattice)
+                    disp_atom2['third_atoms'] = []
+                    disp1['second_atoms'].append(disp_atom2)
+                    num_added += 1
+                else:
+                    disp_atom2 = disp1['second_atoms'][index]
+                    if 'third_atoms' not in disp_atom2:
+                        disp_atom2['third_atoms'] = []
+                num_added += _fill_third_displacements(disp_atom2,
+                                                       dds_atom2,
+                                                       lattice)
+
+    return num_added
+
+def _fill_third_displacements(disp_atom2, dds_atom2, lattice):
+    disps_third = _get_displacement_indices(disp_atom2['third_atoms'],
+                                            lattice)
+    num_added = 0
+    for dds_atom3 in dds_atom2['third_atoms']:
+        atom3 = dds_atom3['number']
+        for disp3 in dds_atom3['directions']:
+            if _get_displacement_key(atom3, disp3) not in disps_third:
+                disp_atom2['third_atoms'].append(
+                    _get_excluded_displacement(atom3,
+                                               disp3,
+                                               disp_atom2,
+                                               lattice))
+                num_added += 1
+    return num_added
+
+def _get_direction(disp, lattice):
+    # Direction in fractional coordinates scaled to max(|d_i|) = 1
+    if 'direction' in disp:
+        direction = np.array(disp['direction'], dtype='double')
+    else:
+        direction = np.dot(disp['displacement'], np.linalg.inv(lattice))
+    return direction / abs(direction).max()
+
+def _get_displacement_indices(disps, lattice):
+    return dict([(_get_displacement_key(x['number'],
+                                        _get_direction(x, lattice)), i)
+                 for i, x in enumerate(disps)])
+
+def _get_displacement_key(atom_num, direction, decimals=5):
+    # Atom number and direction scaled to max(|d_i|) = 1 and rounded
+    direction = np.array(direction, dtype='double')
+    direction /= abs(direction).max()
+    # +0.0 turns -0.0 into 0.0
+    return (atom_num,) + tuple(np.round(direction, decimals) + 0.0)
+
+def _has_diagonal_displacement(disp_dataset, lattice):
+    for disp1 in disp_dataset['first_atoms']:
+        disps = list(disp1.get('second_atoms', []))
+        for disp2 in disp1.get('second_atoms', []):
+            disps += disp2.get('third_atoms', [])
+        for disp in disps:
+            if (abs(_get_direction(disp, lattice)) > 1e-5).sum() > 1:
+                return True
+    return False
+
+def _get_excluded_displacement(atom_num, direction, disp_parent, lattice):
+    disp_cart = np.dot(direction, lattice)
+    disp_cart *= (np.linalg.norm(disp_parent['displacement']) /
+                  np.linalg.norm(disp_cart))
+    return {'number': atom_num,
+            'direction': direction,
+            'displacement': disp_cart,
+            'forces': disp_parent['forces'],
+            'delta_forces': np.zeros_like(disp_parent['forces'])}
+
+def _get_included_pairs(cell,
+                        symprec,
+                        cutoff_pair_distance,
+                        cutoff_triplet_distance,
+                        max_num_shells):
+    """Pairs of atoms to be displaced together
+
+    Returns boolean arrays [num_atom, num_atom] for pairs of Atoms 1 and 2,
+    and for pairs in triplets of Atoms 1, 2, and 3.
+
+    """
+    num_atom = cell.get_number_of_atoms()
+    is_pair_included = np.ones((num_atom, num_atom), dtype='bool')
+    if (cutoff_pair_distance is None and
+        cutoff_triplet_distance is None and
+        max_num_shells is None):
+        return is_pair_included, is_pair_included
+
+    distances = get_smallest_distances(cell, symprec)
+    is_triplet_included = np.ones((num_atom, num_atom), dtype='bool')
+    if max_num_shells is not None:
+        is_within_shells = (_get_shell_numbers(distances, symprec) <=
+                            max_num_shells)
+        is_pair_included &= is_within_shells
+        is_triplet_included &= is_within_shells
+    if cutoff_pair_distance is not None:
+        is_pair_included &= distances < cutoff_pair_distance + symprec
+    if cutoff_triplet_distance is not None:
+        is_triplet_included &= distances < cutoff_triplet_distance + symprec
+    return is_pair_included, is_triplet_included
+
+def _get_shell_numbers(distances, symprec):
+    """Neighbour shell numbers of atoms (columns) around atoms (rows)
+
+    Shells are counted in order of distance, where the centering atom
+    itself is at shell 0.
+
+    """
+    shell_numbers = np.zeros(distances.shape, dtype='intc')
+    for i, d in enumerate(distances):
+        sorted_indices = np.argsort(d)
+        shell_numbers[i, sorted_indices[1:]] = np.cumsum(
+            np.diff(d[sorted_indices]) > symprec)
+    return shell_numbers
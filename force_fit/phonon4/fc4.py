@@ -1,4 +1,6 @@
 import sys
+import itertools
+import tempfile
 import numpy as np
 from phonopy.harmonic.force_constants import (similarity_transformation,
                                               get_positions_sent_by_rot_inv,
@@ -6,9 +8,6 @@ from phonopy.harmonic.force_constants import (similarity_transformation,
 from phonopy.harmonic.force_constants import show_drift_force_constants
 from anharmonic.phonon3.fc3 import (set_translational_invariance_fc3_per_index,
                                     solve_fc3, distribute_fc3,
-                                    third_rank_tensor_rotation,
-                                    get_atom_mapping_by_symmetry,
-                                    get_atom_by_symmetry,
                                     show_drift_fc3,
                                     set_permutation_symmetry_fc3,
                                     get_delta_fc2,
@@ -16,6 +15,9 @@ from anharmonic.phonon3.fc3 import (set_translational_invariance_fc3_per_index,
 from anharmonic.phonon3.displacement_fc3 import (get_reduced_site_symmetry,
                                                  get_bond_symmetry)
 from phonopy.structure.symmetry import Symmetry
+from force_fit.tensor_rotation import (rotate_third_rank_tensors,
+                                       rotate_fourth_rank_tensors)
+from force_fit.parallel import get_pool, get_shared_array
 
 def get_fc4(supercell,
             disp_dataset,
@@ -23,11 +25,26 @@ def get_fc4(supercell,
             symmetry,
             translational_symmetry_type=0,
             is_permutation_symmetry=False,
+            scratch_dir=None,
+            num_processes=1,
             verbose=False):
+    """Calculate fc4 from delta fc3s of first displacements
 
+    With scratch_dir, delta fc3s of the displacements of a first atom
+    are stored in a memory-mapped file created in scratch_dir instead
+    of memory.
+
+    With num_processes > 1, fc4 of unique first atoms are computed in
+    worker processes that write into fc4 placed in shared memory. The
+    workers run OpenMP kernels with one thread each.
+
+    """
     num_atom = supercell.get_number_of_atoms()
-    fc4 = np.zeros((num_atom, num_atom, num_atom, num_atom,
-                    3, 3, 3, 3), dtype='double')
+    shape = (num_atom, num_atom, num_atom, num_atom, 3, 3, 3, 3)
+    if num_processes > 1:
+        fc4 = get_shared_array(shape)
+    else:
+        fc4 = np.zeros(shape, dtype='double')
 
     _get_fc4_least_atoms(fc4,
                          supercell,
@@ -36,6 +53,8 @@ def get_fc4(supercell,
                          symmetry,
                          translational_symmetry_type,
                          is_permutation_symmetry,
+                         scratch_dir,
+                         num_processes,
                          verbose)
 
     if verbose:
@@ -61,90 +80,67 @@ def get_fc4(supercell,
         set_translational_invariance_fc4_per_index(fc4)
 
     if is_permutation_symmetry:
-        set_permutation_symmetry_fc4(fc4)
+        drift = set_permutation_symmetry_fc4(fc4)
+        if verbose:
+            print "max drift of fc4:",
+            print ("%f " * 4) % ((drift,) * 4)
+    elif verbose:
+        show_drift_fc4(fc4)
 
     return fc4
-    
+
 def set_translational_invariance_fc4(fc4):
-    try:
-        import anharmonic._phono4py as phono4c
-        for i in range(4):
-            phono4c.translational_invariance_fc4(fc4, i)
-    except ImportError:
-        for i in range(4):
-            set_translational_invariance_fc4_per_index(fc4, index=i)
+    """Impose translational invariance on all indices
+
+    Max drifts removed at indices are returned.
+
+    """
+    return [set_translational_invariance_fc4_per_index(fc4, index=i)
+            for i in range(4)]
 
 def set_translational_invariance_fc4_per_index(fc4, index=0):
+    """Impose translational invariance on an index
+
+    Drift is computed and removed in the same pass over fc4. The max drift
+    (of fc4 before removal) is returned.
+
+    """
     try:
         import anharmonic._phono4py as phono4c
-        phono4c.translational_invariance_fc4(fc4, index)
+        return phono4c.translational_invariance_fc4(fc4, index)
     except ImportError:
-        set_translational_invariance_fc4_per_index_py(fc4, index)
-    
+        return set_translational_invariance_fc4_per_index_py(fc4, index)
+
 def set_translational_invariance_fc4_per_index_py(fc4, index=0):
-    for i, j, k, l, m, n, p in list(np.ndindex(
-            (fc4.shape[(1 + index) % 3],
-             fc4.shape[(2 + index) % 3],
-             fc4.shape[(3 + index) % 3]) + fc4.shape[4:])):
-        if index == 0:
-            fc4[:, i, j, k, l, m, n, p] -= np.sum(
-                fc4[:, i, j, k, l, m, n, p]) / fc4.shape[0]
-        elif index == 1:
-            fc4[k, :, i, j, l, m, n, p] -= np.sum(
-                fc4[j, :, i, k, l, m, n, p]) / fc4.shape[1]
-        elif index == 2:
-            fc4[j, k, :, i, l, m, n, p] -= np.sum(
-                fc4[j, k, :, i, l, m, n, p]) / fc4.shape[2]
-        elif index == 3:
-            fc4[i, j, k, :, l, m, n, p] -= np.sum(
-                fc4[i, j, k, :, l, m, n, p]) / fc4.shape[3]
+    drifts = fc4.sum(axis=index)
+    fc4 -= np.expand_dims(drifts, axis=index) / fc4.shape[index]
+    return _get_max_drift(drifts)
 
 def set_permutation_symmetry_fc4(fc4):
+    """Impose permutation symmetry
+
+    The max drift of the symmetrized fc4, which is the same at all
+    indices, is returned.
+
+    """
     try:
         import anharmonic._phono4py as phono4c
-        phono4c.permutation_symmetry_fc4(fc4)
+        return phono4c.permutation_symmetry_fc4(fc4)
     except ImportError:
-        num_atom = fc4.shape[0]
         fc4_sym = np.zeros(fc4.shape, dtype='double')
-        for (i, j, k, l) in list(
-            np.ndindex(num_atom, num_atom, num_atom, num_atom)):
-            fc4_sym[i, j, k, l] = set_permutation_symmetry_fc4_part(
-                fc4, i, j, k, l)
-    
-        for (i, j, k, l) in list(
-            np.ndindex(num_atom, num_atom, num_atom, num_atom)):
-            fc4[i, j, k, l] = fc4_sym[i, j, k, l]
+        for perm in itertools.permutations(range(4)):
+            fc4_sym += np.transpose(fc4, perm + tuple([x + 4 for x in perm]))
+        fc4_sym /= 24
+        fc4[:] = fc4_sym
+        return _get_max_drift(fc4_sym.sum(axis=0))
 
 def set_permutation_symmetry_fc4_part(fc4, a, b, c, d):
     tensor4 = np.zeros((3, 3, 3, 3), dtype='double')
-    for (i, j, k, l) in list(np.ndindex(3, 3, 3, 3)):
-        tensor4[i, j, k, l] = (
-            fc4[a, b, c, d, i, j, k, l] +
-            fc4[a, b, d, c, i, j, l, k] +
-            fc4[a, c, b, d, i, k, j, l] +
-            fc4[a, c, d, b, i, k, l, j] +
-            fc4[a, d, b, c, i, l, j, k] +
-            fc4[a, d, c, b, i, l, k, j] +
-            fc4[b, a, c, d, j, i, k, l] +
-            fc4[b, a, d, c, j, i, l, k] +
-            fc4[b, c, a, d, j, k, i, l] +
-            fc4[b, c, d, a, j, k, l, i] +
-            fc4[b, d, a, c, j, l, i, k] +
-            fc4[b, d, c, a, j, l, k, i] +
-            fc4[c, a, b, d, k, i, j, l] +
-            fc4[c, a, d, b, k, i, l, j] +
-            fc4[c, b, a, d, k, j, i, l] +
-            fc4[c, b, d, a, k, j, l, i] +
-            fc4[c, d, a, b, k, l, i, j] +
-            fc4[c, d, b, a, k, l, j, i] +
-            fc4[d, a, b, c, l, i, j, k] +
-            fc4[d, a, c, b, l, i, k, j] +
-            fc4[d, b, a, c, l, j, i, k] +
-            fc4[d, b, c, a, l, j, k, i] +
-            fc4[d, c, a, b, l, k, i, j] +
-            fc4[d, c, b, a, l, k, j, i]) / 24
-
-    return tensor4
+    atoms = (a, b, c, d)
+    for perm in itertools.permutations(range(4)):
+        tensor4 += np.transpose(fc4[tuple([atoms[x] for x in perm])],
+                                np.argsort(perm))
+    return tensor4 / 24
 
 def show_drift_fc4(fc4, name="fc4"):
     try:
@@ -154,28 +150,17 @@ def show_drift_fc4(fc4, name="fc4"):
          maxval3,
          maxval4) = phono4c.drift_fc4(fc4)
     except ImportError:
-        num_atom = fc4.shape[0]
-        maxval1 = 0
-        maxval2 = 0
-        maxval3 = 0
-        maxval4 = 0
-        for i, j, k, l, m, n, p in list(
-            np.ndindex((num_atom, num_atom, num_atom, 3, 3, 3, 3))):
-            val1 = fc4[:, i, j, k, l, m, n, p].sum()
-            val2 = fc4[k, :, i, j, l, m, n, p].sum()
-            val3 = fc4[j, k, :, i, l, m, n, p].sum()
-            val4 = fc4[i, j, k, :, l, m, n, p].sum()
-            if abs(val1) > abs(maxval1):
-                maxval1 = val1
-            if abs(val2) > abs(maxval2):
-                maxval2 = val2
-            if abs(val3) > abs(maxval3):
-                maxval3 = val3
-            if abs(val4) > abs(maxval4):
-                maxval4 = val4
-    
+        (maxval1,
+         maxval2,
+         maxval3,
+         maxval4) = [_get_max_drift(fc4.sum(axis=i)) for i in range(4)]
+
     print "max drift of %s:" % name,
     print ("%f " * 4) % (maxval1, maxval2, maxval3, maxval4)
+    return maxval1, maxval2, maxval3, maxval4
+
+def _get_max_drift(drifts):
+    return drifts.ravel()[np.abs(drifts).argmax()]
 
 def distribute_fc4(fc4_least_atoms,
                    first_disp_atoms,
@@ -194,65 +179,81 @@ def distribute_fc4(fc4_least_atoms,
         fc4 = np.zeros((num_atom, num_atom, num_atom, num_atom,
                         3, 3, 3, 3), dtype='double')
 
+    # atom_mappings[n, j]: Atom j is sent to atom_mappings[n, j] by
+    # n-th operation.
+    atom_mappings = _get_atom_mappings(positions,
+                                       rotations,
+                                       translations,
+                                       symprec)
+    atoms = []
+    mappings = []
+    rots_cart_inv = []
     for i in range(num_atom):
         if i in first_disp_atoms:
             continue
 
         for atom_index_done in first_disp_atoms:
-            rot_num = get_atom_mapping_by_symmetry(positions,
-                                                   i,
-                                                   atom_index_done,
-                                                   rotations,
-                                                   translations,
-                                                   symprec)
-            if rot_num > -1:
-                i_rot = atom_index_done
-                rot = rotations[rot_num]
-                trans = translations[rot_num]
+            rot_nums = np.where(atom_mappings[:, i] == atom_index_done)[0]
+            if len(rot_nums) > 0:
+                rot_num = rot_nums[0]
                 break
-
-        if rot_num < 0:
+        else:
             print "Position or symmetry may be wrong."
             raise ValueError
 
-        atom_mapping = np.zeros(num_atom, dtype='intc')
-        for j in range(num_atom):
-            atom_mapping[j] = get_atom_by_symmetry(positions,
-                                                   rot,
-                                                   trans,
-                                                   j,
-                                                   symprec)
-            
-        rot_cart_inv = np.array(
-            similarity_transformation(lattice, rot).T,
-            order='C', dtype='double')
-
-        if not (overwrite and i == i_rot):
-            if verbose > 1:
-                print "  [ %d, x, x, x ] to [ %d, x, x, x ]" % (i_rot + 1, i + 1)
-                sys.stdout.flush()
+        if verbose > 1:
+            print "  [ %d, x, x, x ] to [ %d, x, x, x ]" % (
+                atom_index_done + 1, i + 1)
+            sys.stdout.flush()
+
+        atoms.append(i)
+        mappings.append(atom_mappings[rot_num])
+        rots_cart_inv.append(
+            similarity_transformation(lattice, rotations[rot_num]).T)
+
+    atoms = np.array(atoms, dtype='intc')
+    mappings = np.array(mappings, dtype='intc').reshape(-1, num_atom)
+    rots_cart_inv = np.array(rots_cart_inv,
+                             dtype='double', order='C').reshape(-1, 3, 3)
 
-            try:
-                import anharmonic._phono4py as phono4c
-                phono4c.distribute_fc4(fc4,
-                                       fc4_least_atoms,
-                                       i,
-                                       atom_mapping,
-                                       rot_cart_inv)
-            
-            except ImportError:
-                for j in range(num_atom):
-                    j_rot = atom_mapping[j]
-                    for k in range(num_atom):
-                        k_rot = atom_mapping[k]
-                        for l in range(num_atom):
-                            l_rot = atom_mapping[l]
-                            fc4[i, j, k, l] = _fourth_rank_tensor_rotation(
-                                rot_cart_inv, fc4[i_rot, j_rot, k_rot, l_rot])
+    try:
+        import anharmonic._phono4py as phono4c
+        phono4c.distribute_fc4_atoms(fc4,
+                                     fc4_least_atoms,
+                                     atoms,
+                                     mappings,
+                                     rots_cart_inv)
+    except ImportError:
+        for i, atom_mapping, rot_cart_inv in zip(atoms,
+                                                 mappings,
+                                                 rots_cart_inv):
+            fc4_rot = fc4_least_atoms[atom_mapping[i]]
+            for j in range(num_atom):
+                fc4[i, j] = rotate_fourth_rank_tensors(
+                    rot_cart_inv,
+                    fc4_rot[atom_mapping[j]][np.ix_(atom_mapping,
+                                                    atom_mapping)])
 
     if not overwrite:
         return fc4
 
+def _get_atom_mappings(positions, rotations, translations, symprec):
+    """Atoms to which atoms are sent by symmetry operations
+
+    [num_operations, num_atom]
+
+    """
+    atom_mappings = np.zeros((len(rotations), len(positions)), dtype='intc')
+    for i, (r, t) in enumerate(zip(rotations, translations)):
+        diff = (np.dot(positions, r.T) + t)[:, None, :] - positions[None, :, :]
+        diff -= np.rint(diff)
+        is_found = (abs(diff) < symprec).all(axis=2)
+        if not is_found.any(axis=1).all():
+            print "Position or symmetry is wrong."
+            raise ValueError
+        atom_mappings[i] = np.argmax(is_found, axis=1)
+    return atom_mappings
+
 def _get_fc4_least_atoms(fc4,
                          supercell,
                          disp_dataset,
@@ -260,11 +261,55 @@ def _get_fc4_least_atoms(fc4,
                          symmetry,
                          translational_symmetry_type,
                          is_permutation_symmetry,
+                         scratch_dir,
+                         num_processes,
                          verbose):
-    symprec = symmetry.get_symmetry_tolerance()
     unique_first_atom_nums = np.unique(
         [x['number'] for x in disp_dataset['first_atoms']])
-    for first_atom_num in unique_first_atom_nums:
+    args = (fc4,
+            supercell,
+            disp_dataset,
+            fc3,
+            symmetry,
+            translational_symmetry_type,
+            is_permutation_symmetry,
+            scratch_dir,
+            verbose)
+
+    num_processes = min(num_processes, len(unique_first_atom_nums))
+    if num_processes > 1:
+        # Arguments are passed to workers by fork, not by pickling.
+        _fc4_context['args'] = args
+        pool = get_pool(num_processes)
+        try:
+            pool.map(_get_fc4_atoms_in_worker,
+                     [unique_first_atom_nums[i::num_processes]
+                      for i in range(num_processes)])
+        finally:
+            pool.close()
+            pool.join()
+            _fc4_context.clear()
+    else:
+        _get_fc4_atoms(unique_first_atom_nums, *args)
+
+_fc4_context = {}
+
+def _get_fc4_atoms_in_worker(first_atom_nums):
+    # Run in worker processes forked by _get_fc4_least_atoms
+    _get_fc4_atoms(first_atom_nums, *_fc4_context['args'])
+
+def _get_fc4_atoms(first_atom_nums,
+                   fc4,
+                   supercell,
+                   disp_dataset,
+                   fc3,
+                   symmetry,
+                   translational_symmetry_type,
+                   is_permutation_symmetry,
+                   scratch_dir,
+                   verbose):
+    symprec = symmetry.get_symmetry_tolerance()
+    for first_atom_num in first_atom_nums:
         _get_fc4_one_atom(fc4,
                           supercell,
                           disp_dataset,
@@ -274,6 +319,7 @@ def _get_fc4_least_atoms(fc4,
                           translational_symmetry_type,
                           is_permutation_symmetry,
                           symprec,
+                          scratch_dir,
                           verbose)
 
 def _get_fc4_one_atom(fc4,
@@ -285,14 +331,17 @@ def _get_fc4_one_atom(fc4,
                       translational_symmetry_type,
                       is_permutation_symmetry,
                       symprec,
+                      scratch_dir,
                       verbose):
     
+    datasets_first_atom = [x for x in disp_dataset['first_atoms']
+                           if x['number'] == first_atom_num]
+    delta_fc3s = _allocate_delta_fc3s(len(datasets_first_atom),
+                                      fc3.shape,
+                                      scratch_dir)
     displacements_first = []
-    delta_fc3s = []
-    for dataset_first_atom in disp_dataset['first_atoms']:
-        if first_atom_num != dataset_first_atom['number']:
-            continue
-
+    for dataset_first_atom, delta_fc3 in zip(datasets_first_atom,
+                                             delta_fc3s):
         displacements_first.append(dataset_first_atom['displacement'])
         direction = np.dot(dataset_first_atom['displacement'],
                            np.linalg.inv(supercell.get_cell()))
@@ -309,23 +358,24 @@ def _get_fc4_one_atom(fc4,
                 print "    [%7.4f %7.4f %7.4f]" % tuple(v)
                 sys.stdout.flush()
 
-        delta_fc3s.append(_get_delta_fc3(
-                dataset_first_atom,
-                fc3,
-                supercell,
-                reduced_site_sym,
-                translational_symmetry_type,
-                is_permutation_symmetry,
-                symprec,
-                verbose))
+        _get_delta_fc3(delta_fc3,
+                       dataset_first_atom,
+                       fc3,
+                       supercell,
+                       reduced_site_sym,
+                       translational_symmetry_type,
+                       is_permutation_symmetry,
+                       symprec,
+                       verbose)
 
     _solve_fc4(fc4,
                first_atom_num,
                supercell,
                site_symmetry,
                displacements_first,
-               np.array(delta_fc3s, dtype='double', order='C'),
+               delta_fc3s,
                symprec)
+    del delta_fc3s
 
     if verbose > 2:
         print "Site symmetry:"
@@ -335,7 +385,19 @@ def _get_fc4_one_atom(fc4,
             print "  [%2d %2d %2d]\n" % tuple(v[2])
             sys.stdout.flush()
 
-def _get_delta_fc3(dataset_first_atom,
+def _allocate_delta_fc3s(num_delta_fc3s, fc3_shape, scratch_dir):
+    shape = (num_delta_fc3s,) + fc3_shape
+    if scratch_dir is None:
+        return np.zeros(shape, dtype='double')
+    else:
+        # The file is unlinked at once. Its disk space is freed when
+        # the memory map is released.
+        with tempfile.NamedTemporaryFile(prefix='delta_fc3s-',
+                                         dir=scratch_dir) as f:
+            return np.memmap(f, dtype='double', mode='w+', shape=shape)
+
+def _get_delta_fc3(delta_fc3,
+                   dataset_first_atom,
                    fc3,
                    supercell,
                    reduced_site_sym,
@@ -343,18 +405,21 @@ def _get_delta_fc3(dataset_first_atom,
                    is_permutation_symmetry,
                    symprec,
                    verbose):
-    disp_fc3 = _get_constrained_fc3(supercell,
-                                    dataset_first_atom,
-                                    reduced_site_sym,
-                                    translational_symmetry_type,
-                                    is_permutation_symmetry,
-                                    symprec,
-                                    verbose)
+    # fc3 with the first displacement is written into delta_fc3 directly
+    # to avoid a temporary of the size of fc3.
+    _get_constrained_fc3(supercell,
+                         dataset_first_atom,
+                         reduced_site_sym,
+                         translational_symmetry_type,
+                         is_permutation_symmetry,
+                         symprec,
+                         verbose,
+                         delta_fc3=delta_fc3)
     
     if verbose:
-        show_drift_fc3(disp_fc3, name="delta fc3")
+        show_drift_fc3(delta_fc3, name="delta fc3")
 
-    return disp_fc3 - fc3
+    delta_fc3 -= fc3
 
 def _get_constrained_fc3(supercell,
                          displacements,
@@ -362,8 +427,12 @@ def _get_constrained_fc3(supercell,
                          translational_symmetry_type,
                          is_permutation_symmetry,
                          symprec,
-                         verbose):
+                         verbose,
+                         delta_fc3=None):
     """
+    With delta_fc3 given, which has to be zero, the result is written
+    into it.
+
     Two displacements and force constants calculation (e.g. DFPT)
 
         displacements = {'number': 3,
@@ -387,8 +456,9 @@ def _get_constrained_fc3(supercell,
     num_atom = supercell.get_number_of_atoms()
     atom1 = displacements['number']
     disp1 = displacements['displacement']
-    delta_fc3 = np.zeros((num_atom, num_atom, num_atom, 3, 3, 3),
-                         dtype='double')
+    if delta_fc3 is None:
+        delta_fc3 = np.zeros((num_atom, num_atom, num_atom, 3, 3, 3),
+                             dtype='double')
 
     if 'delta_forces' in displacements['second_atoms'][0]:
         fc2_with_one_disp = get_constrained_fc2(supercell,
@@ -494,46 +564,29 @@ def _solve_fc4(fc4,
                                                  symprec)
     
     rot_disps = get_rotated_displacement(displacements_first, site_sym_cart)
-    inv_U = np.linalg.pinv(rot_disps)
-
-    for (i, j, k) in list(np.ndindex(num_atom, num_atom, num_atom)):
-        fc4[first_atom_num, i, j, k] = np.dot(
-            inv_U, _rotate_delta_fc3s(
-                i, j, k, delta_fc3s, rot_map_syms, site_sym_cart)
-            ).reshape(3, 3, 3, 3)
-            
-def _rotate_delta_fc3s(i, j, k, delta_fc3s, rot_map_syms, site_sym_cart):
-    rotated_fc3s = np.zeros((len(delta_fc3s), len(site_sym_cart), 3, 3, 3),
-                            dtype='double')
+    inv_U = np.array(np.linalg.pinv(rot_disps), dtype='double', order='C')
+
     try:
         import anharmonic._phono4py as phono4c
-        phono4c.rotate_delta_fc3s_elem(rotated_fc3s,
-                                       delta_fc3s,
-                                       rot_map_syms,
-                                       site_sym_cart,
-                                       i,
-                                       j,
-                                       k)
-        return np.reshape(rotated_fc3s, (-1, 27))
+        phono4c.solve_fc4(fc4,
+                          first_atom_num,
+                          delta_fc3s,
+                          rot_map_syms,
+                          site_sym_cart,
+                          inv_U)
     except ImportError:
-        print "Expanding delta fc3s at (%d, %d, %d)" % (i + 1, j + 1, k + 1)
-        for l, fc3 in enumerate(delta_fc3s):
-            for m, (sym, map_sym) in enumerate(zip(site_sym_cart,
-                                                   rot_map_syms)):
-                fc3_rot = fc3[map_sym[i], map_sym[j], map_sym[k]]
-                rotated_fc3s[l, m] = third_rank_tensor_rotation(sym, fc3_rot)
-        return np.reshape(rotated_fc3s, (-1, 27))
-
-def _fourth_rank_tensor_rotation(rot_cart, tensor):
-    rot_tensor = np.zeros((3, 3, 3, 3), dtype='double')
-    for i, j, k, l in list(np.ndindex(3, 3, 3, 3)):
-        rot_tensor[i, j, k, l] = _fourth_rank_tensor_rotation_elem(
-            rot_cart, tensor, i, j, k, l)
-    return rot_tensor
-
-def _fourth_rank_tensor_rotation_elem(rot, tensor, l, m, n, p):
-    sum_elems = 0.
-    for i, j, k, l in list(np.ndindex(3, 3, 3, 3)):
-        sum_elems += (rot[l, i] * rot[m, j] * rot[n, k] * rot[p, l] *
-                      tensor[i, j, k, l])
-    return sum_elems
+        for (i, j) in list(np.ndindex(num_atom, num_atom)):
+            rot_fc3s = _rotate_delta_fc3s_py(
+                i, j, delta_fc3s, rot_map_syms, site_sym_cart)
+            fc4[first_atom_num, i, j] = np.tensordot(
+                inv_U, rot_fc3s, axes=(1, 0)).transpose(1, 0, 2).reshape(
+                -1, 3, 3, 3, 3)
+
+def _rotate_delta_fc3s_py(i, j, delta_fc3s, rot_map_syms, site_sym_cart):
+    # [num_delta_fc3s * num_rot, num_atom, 27] for (i, j, all k)
+    fc3s = delta_fc3s[:,
+                      rot_map_syms[:, i][:, None],
+                      rot_map_syms[:, j][:, None],
+                      rot_map_syms]
+    rotated_fc3s = rotate_third_rank_tensors(site_sym_cart[:, None], fc3s)
+    return rotated_fc3s.reshape(-1, len(rot_map_syms[0]), 27)
@@ -0,0 +1,47 @@
+import anharmonic.file_IO as file_IO
+
+# Settings of displacement generation written in the header of
+# disp_fc4.yaml. fill_excluded_displacements needs them to reproduce the
+# displacements excluded by cutoffs.
+_generation_keys = (('is_diagonal', '%s'),
+                    ('cutoff_pair_distance', '%.10f'),
+                    ('cutoff_triplet_distance', '%.10f'),
+                    ('max_num_shells', '%d'))
+
+def write_disp_fc4_yaml(dataset, supercell, filename='disp_fc4.yaml'):
+    num_disps = file_IO.write_disp_fc4_yaml(dataset,
+                                            supercell,
+                                            filename=filename)
+    lines = open(filename).readlines()
+    header = []
+    for key, fmt in _generation_keys:
+        if key in dataset:
+            value = dataset[key]
+            if key == 'is_diagonal':
+                value = str(bool(value)).lower()
+            header.append(("%s: " + fmt + "\n") % (key, value))
+    # After natom and the numbers of displacements
+    lines[4:4] = header
+    with open(filename, 'w') as w:
+        w.writelines(lines)
+
+    return num_disps
+
+def parse_disp_fc4_yaml(filename='disp_fc4.yaml'):
+    dataset = file_IO.parse_disp_fc4_yaml(filename=filename)
+    dataset.update(_parse_header(filename))
+    return dataset
+
+def _parse_header(filename):
+    import yaml
+
+    header = []
+    with open(filename) as f:
+        for line in f:
+            if line.startswith('first_atoms:'):
+                break
+            header.append(line)
+    data = yaml.safe_load(''.join(header))
+
+    return dict([(key, data[key]) for key, fmt in _generation_keys
+                 if key in data])
@@ -2,9 +2,11 @@ import numpy as np
 from phonopy.structure.symmetry import Symmetry
 import phonopy.structure.spglib as spg
 from phonopy.phonon.solver import set_phonon_py
+from phonopy.phonon.degeneracy import degenerate_sets
 from anharmonic.phonon3.triplets import get_grid_address, invert_grid_point
 from anharmonic.phonon3.imag_self_energy import occupation as be_func
-from anharmonic.phonon4.real_to_reciprocal import RealToReciprocal
+from anharmonic.phonon4.real_to_reciprocal import (RealToReciprocal,
+                                                   get_primitive_orbits)
 from phonopy.units import VaspToTHz
 from phonopy.units import Hbar, EV, Angstrom, THz, AMU
 from phonopy.harmonic.dynamical_matrix import get_smallest_vectors, get_dynamical_matrix
@@ -62,6 +64,8 @@ class FrequencyShift:
         self._nac_q_direction = None
 
         self._frequency_shifts = None
+        self._band_indices_at_q = None
+        self._frequency_shifts_at_q = None
         
         # Unit to THz of Delta
         self._unit_conversion = (EV / Angstrom ** 4 / AMU ** 2
@@ -72,33 +76,38 @@ class FrequencyShift:
         self._allocate_phonon()
 
     def run(self, lang='C'):
+        if lang=='C':
+            self._set_phonon_c([self._grid_point])
+        else:
+            self._set_phonon_py(self._grid_point)
+        self._set_band_indices_at_q()
+
         if lang=='C':
             self._run_c()
         else:
             self._run_py()
 
+        self._set_frequency_shifts()
+
     def set_grid_point(self, grid_point):
-        # if self._is_nosym:
-        #     quartets_at_q = np.arange(len(self._grid_address), dtype='intc')
-        #     weights_at_q = np.ones(len(self._grid_address), dtype='intc')
-        # else:
-        #     q = self._grid_address[grid_point].astype('double') / self._mesh
-        #     (grid_mapping_table,
-        #      grid_address) = spg.get_stabilized_reciprocal_mesh(
-        #         self._mesh,
-        #         self._point_group_operations,
-        #         is_shift=np.zeros(3, dtype='intc'),
-        #         is_time_reversal=True,
-        #         qpoints=np.double([q]))
-        #     quartets_at_q = np.intc(np.unique(grid_mapping_table))
-        #     weights_at_q_all = np.zeros_like(grid_mapping_table)
-        #     for g in grid_mapping_table:
-        #         weights_at_q[g] += 1
-        #     weights_at_q = weights_at_q_all[quartets_at_q]
-
-        # Only nosym is supported.
-        quartets_at_q = np.arange(np.prod(self._mesh), dtype='intc')
-        weights_at_q = np.ones(np.prod(self._mesh), dtype='intc')
+        if self._is_nosym:
+            quartets_at_q = np.arange(np.prod(self._mesh), dtype='intc')
+            weights_at_q = np.ones(np.prod(self._mesh), dtype='intc')
+        else:
+            # q' are reduced by the point group operations that leave q
+            # invariant, and the reduced q' are weighted by the numbers of
+            # their equivalent q'.
+            q = self._grid_address[grid_point].astype('double') / self._mesh
+            (grid_mapping_table,
+             grid_address) = spg.get_stabilized_reciprocal_mesh(
+                self._mesh,
+                self._point_group_operations,
+                is_shift=np.zeros(3, dtype='intc'),
+                is_time_reversal=True,
+                qpoints=np.double([q]))
+            quartets_at_q = np.intc(np.unique(grid_mapping_table))
+            weights_at_q = np.intc(
+                np.bincount(grid_mapping_table)[quartets_at_q])
 
         self._grid_point = grid_point
         self._quartets_at_q = quartets_at_q
@@ -143,9 +152,41 @@ class FrequencyShift:
             self._mesh,
             np.linalg.inv(self._primitive.get_cell()))
             
+    def _set_band_indices_at_q(self):
+        # With q' reduced by symmetry, frequency shifts of individual
+        # degenerate bands are not invariant, but their average is. So
+        # the shifts are calculated for all bands degenerate with the
+        # requested bands.
+        if self._is_nosym:
+            self._band_indices_at_q = self._band_indices
+        else:
+            freqs = self._frequencies[self._grid_point]
+            self._band_indices_at_q = np.intc(np.unique(
+                [i for dset in degenerate_sets(freqs)
+                 if set(dset) & set(self._band_indices) for i in dset]))
+        self._frequency_shifts_at_q = np.zeros(
+            (len(self._temperatures), len(self._band_indices_at_q)),
+            dtype='double')
+
+    def _set_frequency_shifts(self):
+        if self._is_nosym:
+            self._frequency_shifts[:] = self._frequency_shifts_at_q
+            return
+
+        freqs = self._frequencies[self._grid_point]
+        for dset in degenerate_sets(freqs):
+            indices = [i for i, bi in enumerate(self._band_indices_at_q)
+                       if bi in dset]
+            if len(indices) == 0:
+                continue
+            shift = self._frequency_shifts_at_q[:, indices].mean(axis=1)
+            for j, bi in enumerate(self._band_indices):
+                if bi in dset:
+                    self._frequency_shifts[:, j] = shift
+
     def _run_c(self):
         self._fc4_normal = np.zeros((len(self._quartets_at_q),
-                                     len(self._band_indices),
+                                     len(self._band_indices_at_q),
                                      len(self._frequencies[0])),
                                     dtype='double')
         if self._log_level:
@@ -158,7 +199,7 @@ class FrequencyShift:
         
     def _run_py(self):
         self._fc4_normal = np.zeros((len(self._quartets_at_q),
-                                     len(self._band_indices),
+                                     len(self._band_indices_at_q),
                                      len(self._frequencies[0])),
                                     dtype='complex128')
         self._calculate_fc4_normal_py()
@@ -171,6 +212,7 @@ class FrequencyShift:
                                                    self._symprec)
         p2s = self._primitive.get_primitive_to_supercell_map()
         s2p = self._primitive.get_supercell_to_primitive_map()
+        orbit_offsets, orbit_atoms = get_primitive_orbits(p2s, s2p)
         gp = self._grid_point
         self._set_phonon_c([gp])
         self._set_phonon_c(self._quartets_at_q)
@@ -188,19 +230,21 @@ class FrequencyShift:
             multiplicity,
             self._masses,
             p2s,
-            s2p,
-            self._band_indices,
+            orbit_offsets,
+            orbit_atoms,
+            self._band_indices_at_q,
             self._cutoff_frequency)
 
     def _set_frequency_shifts_c(self):
         import anharmonic._phono4py as phono4c
         phono4c.fc4_frequency_shifts(
-            self._frequency_shifts,
+            self._frequency_shifts_at_q,
             self._fc4_normal,
             self._frequencies,
             self._quartets_at_q,
+            self._weights_at_q,
             self._temperatures,
-            self._band_indices,
+            self._band_indices_at_q,
             self._unit_conversion)
 
     def _calculate_fc4_normal_py(self):
@@ -239,7 +283,7 @@ class FrequencyShift:
             fc4_reciprocal = r2r.get_fc4_reciprocal()
             self._set_phonon_py(gp1)
 
-            for j, band_index in enumerate(self._band_indices):
+            for j, band_index in enumerate(self._band_indices_at_q):
                 if self._frequencies[gp][band_index] < self._cutoff_frequency:
                     continue
                 if self._log_level > 1:
@@ -249,17 +293,18 @@ class FrequencyShift:
 
     def _set_frequency_shifts_py(self):
         for i, t in enumerate(self._temperatures):
-            for j, band_index in enumerate(self._band_indices):
+            for j, band_index in enumerate(self._band_indices_at_q):
                 shift = 0
-                for k, gp1 in enumerate(self._quartets_at_q):
+                for k, (gp1, w) in enumerate(zip(self._quartets_at_q,
+                                                 self._weights_at_q)):
                     if t > 0:
                         occupations = be_func(self._frequencies[gp1], t)
                     else:
                         occupations = np.zeros_like(self._frequencies[gp1])
                     shift += (self._fc4_normal[k, j] * self._unit_conversion *
-                              (2 * occupations + 1)).sum()
+                              (2 * occupations + 1)).sum() * w
                 print "band index:", band_index + 1, "temp:", t, "shift:", shift
-                self._frequency_shifts[i, j] = shift
+                self._frequency_shifts_at_q[i, j] = shift
 
     def _set_phonon_py(self, grid_point):
         set_phonon_py(grid_point,
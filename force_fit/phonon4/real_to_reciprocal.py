@@ -1,6 +1,23 @@
 import numpy as np
 from phonopy.harmonic.dynamical_matrix import get_smallest_vectors
 
+def get_primitive_orbits(p2s_map, s2p_map):
+    """Supercell atoms belonging to each primitive atom in CSR format
+
+    Atoms of primitive atom pi are
+    orbit_atoms[orbit_offsets[pi]:orbit_offsets[pi + 1]].
+
+    """
+    p2s_map = np.array(p2s_map)
+    s2p_map = np.array(s2p_map)
+    orbit_atoms = []
+    orbit_offsets = [0]
+    for s in p2s_map:
+        orbit_atoms += list(np.where(s2p_map == s)[0])
+        orbit_offsets.append(len(orbit_atoms))
+    return (np.array(orbit_offsets, dtype='intc'),
+            np.array(orbit_atoms, dtype='intc'))
+
 class RealToReciprocal:
     def __init__(self,
                  fc4,
@@ -17,12 +34,17 @@ class RealToReciprocal:
         num_satom = supercell.get_number_of_atoms()
         self._p2s_map = primitive.get_primitive_to_supercell_map()
         self._s2p_map = primitive.get_supercell_to_primitive_map()
+        (self._orbit_offsets,
+         self._orbit_atoms) = get_primitive_orbits(self._p2s_map,
+                                                   self._s2p_map)
         (self._smallest_vectors,
          self._multiplicity) = get_smallest_vectors(supercell,
                                                     primitive,
                                                     symprec)
         self._quartet = None
         self._fc4_reciprocal = None
+        self._fc4_q = None
+        self._quartet_first_stage = None
 
     def run(self, quartet, lang='py'):
         self._quartet = quartet
@@ -47,41 +69,61 @@ class RealToReciprocal:
                                     self._smallest_vectors,
                                     self._multiplicity,
                                     self._p2s_map,
-                                    self._s2p_map)
+                                    self._orbit_offsets,
+                                    self._orbit_atoms)
 
     def _real_to_reciprocal_py(self):
+        # The partial transform over the second atom depends only on
+        # quartet[1], so it is reused while q is unchanged.
+        if (self._fc4_q is None or
+            (self._quartet_first_stage != self._quartet[1]).any()):
+            self._real_to_reciprocal_first_stage()
+            self._quartet_first_stage = self._quartet[1].copy()
+        self._real_to_reciprocal_second_stage()
+
+    def _real_to_reciprocal_first_stage(self):
+        """fc4_q[pi0, pi1, k, l] = sum_j phase_1(j) fc4[p2s[pi0], j, k, l]"""
         num_patom = self._primitive.get_number_of_atoms()
-        for (i, j, k, l) in list(np.ndindex(
-                num_patom, num_patom, num_patom, num_patom)):
-            self._fc4_reciprocal[
-                i, j, k, l] = self._real_to_reciprocal_elements((i, j, k, l))
+        num_satom = self._supercell.get_number_of_atoms()
+        phases = self._get_phase_factors(1)
+        self._fc4_q = np.zeros((num_patom, num_patom, num_satom, num_satom,
+                                3, 3, 3, 3), dtype='complex128')
+        for i, j in np.ndindex(num_patom, num_patom):
+            atoms = self._get_orbit(j)
+            self._fc4_q[i, j] = np.tensordot(
+                phases[i, atoms], self._fc4[self._p2s_map[i], atoms],
+                axes=(0, 0))
 
-    def _real_to_reciprocal_elements(self, patom_indices):
+    def _real_to_reciprocal_second_stage(self):
+        """Sum of phase_2(k) phase_3(l) fc4_q[pi0, pi1, k, l] in orbits"""
+        num_patom = self._primitive.get_number_of_atoms()
+        phases2 = self._get_phase_factors(2)
+        phases3 = self._get_phase_factors(3)
+        for i, k, l in np.ndindex(num_patom, num_patom, num_patom):
+            atoms_k = self._get_orbit(k)
+            atoms_l = self._get_orbit(l)
+            # [pi1, k, l, ...] -> [pi1, ...]
+            fc4_q = self._fc4_q[i][:, atoms_k][:, :, atoms_l]
+            fc4_q = np.tensordot(fc4_q, phases3[i, atoms_l], axes=(2, 0))
+            fc4_q = np.tensordot(fc4_q, phases2[i, atoms_k], axes=(1, 0))
+            self._fc4_reciprocal[i, :, k, l] = fc4_q
+
+    def _get_orbit(self, patom_index):
+        return self._orbit_atoms[self._orbit_offsets[patom_index]:
+                                 self._orbit_offsets[patom_index + 1]]
+
+    def _get_phase_factors(self, slot):
+        """phases[pi0, j]: Phase factor of atom j relative to atom pi0"""
+        num_patom = self._primitive.get_number_of_atoms()
         num_satom = self._supercell.get_number_of_atoms()
-        pi = patom_indices
-        i = self._p2s_map[pi[0]]
-        fc4_reciprocal = np.zeros((3, 3, 3, 3), dtype='complex128')
-        for j in range(num_satom):
-            if self._s2p_map[j] != self._p2s_map[pi[1]]:
-                continue
-            for k in range(num_satom):
-                if self._s2p_map[k] != self._p2s_map[pi[2]]:
-                    continue
-                for l in range(num_satom):
-                    if self._s2p_map[l] != self._p2s_map[pi[3]]:
-                        continue
-                    phase = self._get_phase((j, k, l), pi[0])
-                    fc4_reciprocal += self._fc4[i, j, k, l] * phase
-        return fc4_reciprocal
+        phases = np.zeros((num_patom, num_satom), dtype='complex128')
+        for i, j in np.ndindex(num_patom, num_satom):
+            phases[i, j] = self._get_phase_factor(j, i, slot)
+        return phases
 
-    def _get_phase(self, satom_indices, patom0_index):
-        si = satom_indices
-        p0 = patom0_index
-        phase = 1+0j
-        for i in (0, 1, 2):
-            vs = self._smallest_vectors[si[i], p0,
-                                        :self._multiplicity[si[i], p0]]
-            phase *= (np.exp(2j * np.pi * np.dot(
-                        vs, self._quartet[i + 1].astype('double') /
-                        self._mesh)).sum() / self._multiplicity[si[i], p0])
-        return phase
+    def _get_phase_factor(self, satom_index, patom0_index, slot):
+        multi = self._multiplicity[satom_index, patom0_index]
+        vs = self._smallest_vectors[satom_index, patom0_index, :multi]
+        return (np.exp(2j * np.pi * np.dot(
+                    vs, self._quartet[slot].astype('double') /
+                    self._mesh)).sum() / multi)
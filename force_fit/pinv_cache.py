@@ -0,0 +1,105 @@
+import hashlib
+from collections import OrderedDict
+import numpy as np
+
+class PinvCache:
+    """Pseudo-inverses of displacement matrices keyed by their contents
+
+    Matrices that are equal up to the order of rows share one
+    pseudo-inverse. Rows are sorted after rounding to the given number
+    of decimals, and the sorted matrix is hashed. With P the row
+    permutation, pinv(A) = pinv(PA) P.
+
+    At most max_size pseudo-inverses are kept. When full, the least
+    recently used one is dropped. max_size=None leaves it unbounded.
+
+    """
+    def __init__(self, decimals=10, max_size=1000):
+        self._decimals = decimals
+        self._max_size = max_size
+        self._pinvs = OrderedDict()
+        self._num_inversions = 0
+        self._num_avoided = 0
+
+    def get_pinv(self, matrix, pinv_func=None):
+        return self.get_pinvs([matrix], pinv_func=pinv_func)[0]
+
+    def get_pinvs(self, matrices, pinv_func=None):
+        """Pseudo-inverses of matrices
+
+        pinv_func takes a list of matrices and returns the list of their
+        pseudo-inverses. Only matrices not found in the cache are passed,
+        each once.
+
+        """
+        keys = []
+        orders = []
+        new_keys = []
+        new_matrices = []
+        for matrix in matrices:
+            key, order = self._get_key(matrix)
+            keys.append(key)
+            orders.append(order)
+            if key in self._pinvs:
+                self._num_avoided += 1
+                # Mark as most recently used
+                self._pinvs[key] = self._pinvs.pop(key)
+            elif key in new_keys:
+                self._num_avoided += 1
+            else:
+                new_keys.append(key)
+                new_matrices.append(matrix[order])
+
+        if new_matrices:
+            if pinv_func is None:
+                new_pinvs = [np.linalg.pinv(m) for m in new_matrices]
+            else:
+                new_pinvs = pinv_func(new_matrices)
+            self._num_inversions += len(new_matrices)
+            new_pinvs = dict(zip(new_keys, new_pinvs))
+        else:
+            new_pinvs = {}
+
+        pinvs = []
+        for key, order in zip(keys, orders):
+            if key in new_pinvs:
+                pinv_sorted = new_pinvs[key]
+            else:
+                pinv_sorted = self._pinvs[key]
+            pinv = np.empty_like(pinv_sorted)
+            pinv[:, order] = pinv_sorted
+            pinvs.append(pinv)
+
+        for key in new_keys:
+            self._pinvs[key] = new_pinvs[key]
+            if self._max_size is not None:
+                while len(self._pinvs) > self._max_size:
+                    self._pinvs.popitem(last=False)
+
+        return pinvs
+
+    def clear(self):
+        self._pinvs.clear()
+
+    def get_number_of_inversions(self):
+        return self._num_inversions
+
+    def get_number_of_avoided_inversions(self):
+        return self._num_avoided
+
+    def add_statistics(self, num_inversions, num_avoided):
+        # For counts of caches in other processes
+        self._num_inversions += num_inversions
+        self._num_avoided += num_avoided
+
+    def show_statistics(self):
+        print("Pseudo-inverse cache: %d inversions, %d avoided" %
+              (self._num_inversions, self._num_avoided))
+
+    def _get_key(self, matrix):
+        # +0.0 turns -0.0 into 0.0
+        rounded = np.round(matrix, self._decimals) + 0.0
+        order = np.lexsort(rounded.T[::-1])
+        sorted_rows = np.ascontiguousarray(rounded[order])
+        digest = hashlib.sha1(sorted_rows.data).hexdigest()
+        return (matrix.shape, digest), order
@@ -0,0 +1,75 @@
+import numpy as np
+from phonopy.structure.cells import get_reduced_bases
+
+def get_smallest_vectors(supercell, primitive, symprec):
+    """Vectorized version of phonopy's get_smallest_vectors
+
+    shortest_vectors:
+      Shortest vectors from an atom in primitive cell to an atom in
+      supercell in the fractional coordinates of primitive cell.
+      [atom_super, atom_primitive, multiple-vectors, 3]
+
+    multiplicity:
+      Number of multiple shortest vectors
+      [atom_super, atom_primitive]
+
+    """
+    return get_smallest_vector_table(supercell,
+                                     primitive.get_primitive_to_supercell_map(),
+                                     primitive.get_cell(),
+                                     symprec)
+
+def get_smallest_vector_table(supercell, atom_nums, lattice, symprec):
+    """Shortest vectors from atoms in atom_nums to all supercell atoms
+
+    Vectors are given in the fractional coordinates of lattice (basis
+    vectors in rows). The arrays are indexed as those of
+    get_smallest_vectors with atom_nums in place of primitive atoms.
+
+    """
+    reduced_bases = get_reduced_bases(supercell.get_cell(), symprec)
+    positions = np.dot(supercell.get_positions(), np.linalg.inv(reduced_bases))
+    positions -= np.rint(positions)
+    lattice_points = np.array(list(np.ndindex(3, 3, 3))) - 1
+
+    # [atom_super, atom_center, 27, 3]
+    differences = (positions[:, None, None, :] +
+                   lattice_points[None, None, :, :] -
+                   positions[atom_nums][None, :, None, :])
+    distances = np.sqrt(
+        (np.dot(differences, reduced_bases) ** 2).sum(axis=3))
+    is_smallest = (
+        abs(distances - distances.min(axis=2)[:, :, None]) < symprec)
+    multiplicity = np.array(is_smallest.sum(axis=2), dtype='intc')
+
+    # Smallest vectors are packed to the front keeping the order of
+    # lattice points.
+    order = np.argsort(~is_smallest, axis=2, kind='mergesort')
+    i, j = np.ix_(np.arange(len(positions)), np.arange(len(atom_nums)))
+    differences = differences[i[:, :, None], j[:, :, None], order]
+    is_smallest = is_smallest[i[:, :, None], j[:, :, None], order]
+    relative_scale = np.dot(reduced_bases, np.linalg.inv(lattice))
+    shortest_vectors = np.dot(differences, relative_scale)
+    shortest_vectors[~is_smallest] = 0
+
+    return np.array(shortest_vectors, dtype='double', order='C'), multiplicity
+
+def get_mean_smallest_vectors(shortest_vectors, multiplicity):
+    """Average over equivalent shortest vectors
+
+    [atom_super, atom_center, 3]
+
+    """
+    return shortest_vectors.sum(axis=2) / multiplicity[:, :, None]
+
+def get_smallest_distances(supercell, symprec):
+    """Distances between all pairs of atoms under minimum image convention
+
+    [atom_super, atom_super]
+
+    """
+    lattice = supercell.get_cell()
+    num_atom = supercell.get_number_of_atoms()
+    svecs, multi = get_smallest_vector_table(supercell, np.arange(num_atom),
+                                             lattice, symprec)
+    return np.sqrt((np.dot(svecs[:, :, 0], lattice) ** 2).sum(axis=2))
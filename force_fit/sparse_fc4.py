@@ -0,0 +1,158 @@
+import sys
+import numpy as np
+from phonopy.harmonic.force_constants import similarity_transformation
+from anharmonic.phonon3.fc3 import (get_atom_mapping_by_symmetry,
+                                    get_atom_by_symmetry)
+from force_fit.tensor_rotation import rotate_fourth_rank_tensors
+
+class SparseFC4:
+    """fc4 stored as blocks of atom quartets
+
+    quartets: Atom indices (i, j, k, l) of stored blocks
+      [num_blocks, 4]
+    blocks: fc4[i, j, k, l]
+      [num_blocks, 3, 3, 3, 3]
+
+    Blocks not stored are zero.
+
+    """
+    def __init__(self, num_atom, quartets=None, blocks=None):
+        self._num_atom = num_atom
+        if quartets is None:
+            self._quartets = np.zeros((0, 4), dtype='intc')
+            self._blocks = np.zeros((0, 3, 3, 3, 3), dtype='double')
+        else:
+            self._quartets = np.array(quartets, dtype='intc')
+            self._blocks = np.array(blocks, dtype='double')
+        self._quartets_to_append = []
+        self._blocks_to_append = []
+        self._index = None
+
+    def append(self, first_atom_num, second_atom_num, third_atom_num,
+               fourth_atom_nums, blocks):
+        """Add fc4[first, second, third, fourth_atom_nums]"""
+        quartets = np.zeros((len(fourth_atom_nums), 4), dtype='intc')
+        quartets[:, 0] = first_atom_num
+        quartets[:, 1] = second_atom_num
+        quartets[:, 2] = third_atom_num
+        quartets[:, 3] = fourth_atom_nums
+        self._quartets_to_append.append(quartets)
+        self._blocks_to_append.append(
+            np.reshape(blocks, (-1, 3, 3, 3, 3)))
+        self._index = None
+
+    def get_number_of_atoms(self):
+        return self._num_atom
+
+    def get_quartets(self):
+        self._merge()
+        return self._quartets
+
+    def get_blocks(self):
+        self._merge()
+        return self._blocks
+
+    def get_block(self, i, j, k, l):
+        self._merge()
+        if self._index is None:
+            self._index = dict(
+                (tuple(q), n) for n, q in enumerate(self._quartets))
+        n = self._index.get((i, j, k, l))
+        if n is None:
+            return np.zeros((3, 3, 3, 3), dtype='double')
+        return self._blocks[n]
+
+    def to_dense(self):
+        self._merge()
+        num_atom = self._num_atom
+        fc4 = np.zeros((num_atom, num_atom, num_atom, num_atom,
+                        3, 3, 3, 3), dtype='double')
+        i, j, k, l = self._quartets.T
+        fc4[i, j, k, l] = self._blocks
+        return fc4
+
+    def distribute(self,
+                   first_disp_atoms,
+                   lattice,
+                   positions,
+                   rotations,
+                   translations,
+                   symprec,
+                   verbose=False):
+        """Sparse version of distribute_fc4
+
+        Blocks of atoms not in first_disp_atoms are replaced by those
+        obtained from blocks of first_disp_atoms by symmetry.
+
+        """
+        self._merge()
+        is_done = np.array([q in first_disp_atoms for q in self._quartets[:, 0]],
+                           dtype='bool')
+        done_quartets = self._quartets[is_done]
+        done_blocks = self._blocks[is_done]
+        quartets = [done_quartets]
+        blocks = [done_blocks]
+
+        for i in range(self._num_atom):
+            if i in first_disp_atoms:
+                continue
+
+            for atom_index_done in first_disp_atoms:
+                rot_num = get_atom_mapping_by_symmetry(positions,
+                                                       i,
+                                                       atom_index_done,
+                                                       rotations,
+                                                       translations,
+                                                       symprec)
+                if rot_num > -1:
+                    i_rot = atom_index_done
+                    rot = rotations[rot_num]
+                    trans = translations[rot_num]
+                    break
+
+            if rot_num < 0:
+                print "Position or symmetry may be wrong."
+                raise ValueError
+
+            if verbose > 1:
+                print "  [ %d, x, x, x ] to [ %d, x, x, x ]" % (i_rot + 1, i + 1)
+                sys.stdout.flush()
+
+            atom_mapping = np.array(
+                [get_atom_by_symmetry(positions, rot, trans, j, symprec)
+                 for j in range(self._num_atom)], dtype='intc')
+            inv_atom_mapping = np.argsort(atom_mapping)
+            rot_cart_inv = similarity_transformation(lattice, rot).T
+
+            indices = np.where(done_quartets[:, 0] == i_rot)[0]
+            quartets_i = inv_atom_mapping[done_quartets[indices]]
+            quartets_i[:, 0] = i
+            quartets.append(quartets_i)
+            blocks.append(
+                rotate_fourth_rank_tensors(rot_cart_inv, done_blocks[indices]))
+
+        self._quartets = np.array(np.vstack(quartets), dtype='intc')
+        self._blocks = np.array(np.vstack(blocks), dtype='double')
+        self._index = None
+
+    def _merge(self):
+        if self._quartets_to_append:
+            self._quartets = np.vstack(
+                [self._quartets] + self._quartets_to_append)
+            self._blocks = np.vstack([self._blocks] + self._blocks_to_append)
+            self._quartets_to_append = []
+            self._blocks_to_append = []
+
+def write_sparse_fc4_to_hdf5(sparse_fc4, filename='fc4.hdf5'):
+    import h5py
+    with h5py.File(filename, 'w') as w:
+        w.create_dataset('natom', data=sparse_fc4.get_number_of_atoms())
+        w.create_dataset('quartets', data=sparse_fc4.get_quartets())
+        w.create_dataset('fc4_blocks', data=sparse_fc4.get_blocks())
+
+def read_sparse_fc4_from_hdf5(filename='fc4.hdf5'):
+    import h5py
+    with h5py.File(filename, 'r') as f:
+        return SparseFC4(int(f['natom'][()]),
+                         quartets=f['quartets'][:],
+                         blocks=f['fc4_blocks'][:])
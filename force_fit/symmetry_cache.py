@@ -0,0 +1,117 @@
+import numpy as np
+from phonopy.harmonic.force_constants import (similarity_transformation,
+                                              get_positions_sent_by_rot_inv)
+from anharmonic.phonon3.displacement_fc3 import (get_reduced_site_symmetry,
+                                                 get_bond_symmetry)
+
+class SymmetryCache:
+    """Memoized site symmetries and rotated-position maps of a supercell
+
+    A symmetry is specified by displaced atoms and their displacements,
+    atom_nums=(a, b, ...) and disps=(u_a, u_b, ...):
+
+      (a,), ()            : site symmetry of a
+      (a,), (u_a,)        : site symmetry of a reduced by u_a
+      (a, b), (u_a,)      : bond symmetry of a-b
+      (a, b), (u_a, u_b)  : bond symmetry of a-b reduced by u_b
+
+    Atom maps and Cartesian rotations are given with respect to the last
+    atom in atom_nums. Returned arrays are shared and must not be
+    modified.
+
+    """
+    def __init__(self, supercell, symmetry):
+        self._lattice = supercell.get_cell().T
+        self._positions = supercell.get_scaled_positions()
+        self._symmetry = symmetry
+        self._symprec = symmetry.get_symmetry_tolerance()
+        self._inv_lattice = np.linalg.inv(self._lattice)
+
+        self._symmetries = {}
+        self._rot_map_syms = {}
+        self._rotations_cart = {}
+        self._num_hits = 0
+        self._num_misses = 0
+
+    def get_symmetry(self, atom_nums, disps=()):
+        key = self._get_key(atom_nums, disps)
+        if key in self._symmetries:
+            self._num_hits += 1
+        else:
+            self._num_misses += 1
+        return self._get_cached_symmetry(atom_nums, disps, key)
+
+    def get_rot_map_syms(self, atom_nums, disps=()):
+        key = self._get_key(atom_nums, disps)
+        if key in self._rot_map_syms:
+            self._num_hits += 1
+        else:
+            self._num_misses += 1
+            positions = (self._positions.copy() -
+                         self._positions[atom_nums[-1]])
+            self._rot_map_syms[key] = get_positions_sent_by_rot_inv(
+                self._lattice,
+                positions,
+                self._get_cached_symmetry(atom_nums, disps, key),
+                self._symprec)
+        return self._rot_map_syms[key]
+
+    def get_rotations_cart(self, atom_nums, disps=()):
+        key = self._get_key(atom_nums, disps)
+        if key in self._rotations_cart:
+            self._num_hits += 1
+        else:
+            self._num_misses += 1
+            self._rotations_cart[key] = np.array(
+                [similarity_transformation(self._lattice, r)
+                 for r in self._get_cached_symmetry(atom_nums, disps, key)],
+                dtype='double')
+        return self._rotations_cart[key]
+
+    def get_number_of_hits(self):
+        return self._num_hits
+
+    def get_number_of_misses(self):
+        return self._num_misses
+
+    def show_statistics(self):
+        print("Symmetry cache: %d hits, %d misses" %
+              (self._num_hits, self._num_misses))
+
+    def _get_cached_symmetry(self, atom_nums, disps, key=None):
+        # Lookups made internally are not counted in the statistics.
+        if key is None:
+            key = self._get_key(atom_nums, disps)
+        if key not in self._symmetries:
+            self._symmetries[key] = self._get_symmetry(atom_nums, disps)
+        return self._symmetries[key]
+
+    def _get_symmetry(self, atom_nums, disps):
+        if len(disps) == len(atom_nums):
+            if len(atom_nums) == 1:
+                sym = self._symmetry.get_site_symmetry(atom_nums[0])
+            else:
+                sym = self._get_cached_symmetry(atom_nums, disps[:-1])
+            direction = np.dot(self._inv_lattice, disps[-1])
+            return get_reduced_site_symmetry(sym, direction, self._symprec)
+        elif len(disps) == len(atom_nums) - 1:
+            if len(atom_nums) == 1:
+                return np.array(
+                    self._symmetry.get_site_symmetry(atom_nums[0]),
+                    dtype='intc')
+            return np.array(get_bond_symmetry(
+                self._get_cached_symmetry(atom_nums[:-1], disps),
+                self._positions,
+                atom_nums[0],
+                atom_nums[-1],
+                self._symprec), dtype='intc')
+        else:
+            raise ValueError("Numbers of atoms and displacements mismatch.")
+
+    def _get_key(self, atom_nums, disps):
+        # Displacements are compared within symprec
+        disp_keys = tuple(
+            tuple(np.rint(np.array(u, dtype='double') /
+                          self._symprec).astype(int))
+            for u in disps)
+        return (tuple(atom_nums), disp_keys, self._symprec)
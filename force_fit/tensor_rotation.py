@@ -0,0 +1,41 @@
+import numpy as np
+
+def rotate_second_rank_tensors(rotations, tensors):
+    """T'[..., a, b] = R[..., a, i] R[..., b, j] T[..., i, j]"""
+    return rotate_tensors(rotations, tensors, 2)
+
+def rotate_third_rank_tensors(rotations, tensors):
+    """T'[..., a, b, c] = R[..., a, i] R[..., b, j] R[..., c, k]
+                          * T[..., i, j, k]"""
+    return rotate_tensors(rotations, tensors, 3)
+
+def rotate_fourth_rank_tensors(rotations, tensors):
+    """T'[..., a, b, c, d] = R[..., a, i] R[..., b, j] R[..., c, k]
+                             * R[..., d, l] T[..., i, j, k, l]"""
+    return rotate_tensors(rotations, tensors, 4)
+
+def rotate_tensors(rotations, tensors, rank):
+    """Rotate stacks of Cartesian tensors of rank
+
+    rotations: Cartesian rotation matrices [..., 3, 3]
+    tensors: Tensors [..., 3, ..., 3] with rank trailing axes
+
+    Leading axes of rotations and tensors are broadcast against each
+    other, e.g., rotations [num_rot, 1, 3, 3] with tensors
+    [num_rot, num_atom, 3, 3, 3] rotate the tensors of all atoms by the
+    rotation of each row.
+
+    """
+    rotations = np.asarray(rotations, dtype='double')
+    rot_tensors = np.asarray(tensors, dtype='double')
+    # Insert axes of tensor indices not being contracted
+    rotations = rotations.reshape(
+        rotations.shape[:-2] + (1,) * (rank - 1) + (3, 3))
+    for i in range(rank):
+        # The last index is rotated and moved to the first tensor index.
+        # After rank times, all indices are rotated in the original order.
+        rot_tensors = np.einsum('...ai,...i->...a', rotations, rot_tensors)
+        rot_tensors = np.rollaxis(rot_tensors,
+                                  rot_tensors.ndim - 1,
+                                  rot_tensors.ndim - rank)
+    return np.array(rot_tensors, dtype='double', order='C')
@@ -17,11 +17,18 @@ include_dirs += include_dirs_numpy + include_dirs_lapacke
 
 extra_link_args = ['-lgomp',]
 
+# CBLAS (cblas.h and cblas_zgemm) is used in frequency_shift.c. OpenBLAS
+# and the libblas of common Linux distributions export cblas_*. If it
+# is in a separate library, give it by CBLAS_LIBS, e.g.,
+# CBLAS_LIBS="-lcblas" or CBLAS_LIBS="-lsatlas".
 if platform.system() == 'Darwin':
     include_dirs += ['/opt/local/include',]
     extra_link_args += ['/opt/local/lib/libopenblas.a']
 else:
-    extra_link_args += ['-llapacke', '-llapack', '-lblas']
+    extra_link_args += ['-llapacke', '-llapack']
+    if 'CBLAS_LIBS' in os.environ:
+        extra_link_args += os.environ['CBLAS_LIBS'].split()
+    extra_link_args += ['-lblas']
 
 extension_phono4py = Extension(
     'anharmonic._phono4py',
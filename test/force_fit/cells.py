@@ -0,0 +1,17 @@
+import numpy as np
+from phonopy.structure.atoms import Atoms
+from phonopy.structure.symmetry import Symmetry
+
+def get_cell_NaCl(symprec=1e-5):
+    """Conventional unit cell of NaCl (8 atoms) and its symmetry"""
+    a = 5.69
+    positions = [[0, 0, 0], [0, 0.5, 0.5], [0.5, 0, 0.5], [0.5, 0.5, 0],
+                 [0.5, 0.5, 0.5], [0.5, 0, 0], [0, 0.5, 0], [0, 0, 0.5]]
+    cell = Atoms(numbers=[11] * 4 + [17] * 4,
+                 cell=np.eye(3) * a,
+                 scaled_positions=positions)
+    return cell, Symmetry(cell, symprec=symprec)
+
+def get_random_forces(num_disps, num_atom):
+    """List of num_disps random sets of forces [num_atom, 3]"""
+    return list(np.random.randn(num_disps, num_atom, 3))
@@ -0,0 +1,125 @@
+import os
+import tempfile
+import unittest
+import numpy as np
+
+from force_fit.dataset import (get_displacement_dataset, get_dict_dataset,
+                               read_displacement_dataset,
+                               write_displacement_dataset)
+
+class TestDisplacementDataset(unittest.TestCase):
+
+    def setUp(self):
+        np.random.seed(0)
+        self._natom = 4
+        first_atoms = []
+        for i in (0, 2, 0):
+            second_atoms = []
+            for j in (1, 3, 1, 0):
+                third_atoms = [
+                    {'number': k,
+                     'displacement': np.random.randn(3),
+                     'forces': np.random.randn(self._natom, 3)}
+                    for k in (2, 2, 3)]
+                second_atoms.append({'number': j,
+                                     'displacement': np.random.randn(3),
+                                     'forces': np.random.randn(self._natom, 3),
+                                     'third_atoms': third_atoms})
+            first_atoms.append({'number': i,
+                                'displacement': np.random.randn(3),
+                                'second_atoms': second_atoms})
+        self._disp_dataset = {'natom': self._natom,
+                              'first_atoms': first_atoms}
+        self._dataset = get_displacement_dataset(self._disp_dataset)
+
+    def tearDown(self):
+        pass
+
+    def test_levels(self):
+        self.assertEqual(self._dataset.get_number_of_levels(), 3)
+        self.assertTrue(self._dataset.get_forces(0) is None)
+        self.assertEqual(self._dataset.get_forces(2).shape,
+                         (36, self._natom, 3))
+        self.assertTrue((self._dataset.get_first_atom_numbers() ==
+                         [0, 2]).all())
+
+    def test_indices(self):
+        dataset = self._dataset
+        first_atoms = self._disp_dataset['first_atoms']
+        for i in range(self._natom):
+            first_indices = dataset.get_first_atom_indices(i)
+            self.assertEqual(
+                list(first_indices),
+                [n for n, x in enumerate(first_atoms) if x['number'] == i])
+            for i1 in first_indices:
+                second_atoms = first_atoms[i1]['second_atoms']
+                for j in range(self._natom):
+                    second_indices = dataset.get_second_atom_indices(i1, j)
+                    self.assertTrue(
+                        (dataset.get_numbers(1)[second_indices] == j).all())
+                    self.assertTrue(
+                        np.allclose(
+                            dataset.get_displacements(1)[second_indices],
+                            np.reshape([x['displacement']
+                                        for x in second_atoms
+                                        if x['number'] == j], (-1, 3))))
+                    for i2, x in zip(second_indices,
+                                     [x for x in second_atoms
+                                      if x['number'] == j]):
+                        for k in range(self._natom):
+                            third_indices = dataset.get_third_atom_indices(
+                                i2, k)
+                            forces = [y['forces'] for y in x['third_atoms']
+                                      if y['number'] == k]
+                            self.assertEqual(len(third_indices), len(forces))
+                            if forces:
+                                self.assertTrue(np.allclose(
+                                    dataset.get_forces(2)[third_indices],
+                                    forces))
+
+    def test_dict_dataset(self):
+        disp_dataset = get_dict_dataset(self._dataset, is_delta_forces=True)
+        for x1, y1 in zip(self._disp_dataset['first_atoms'],
+                          disp_dataset['first_atoms']):
+            self.assertEqual(x1['number'], y1['number'])
+            for x2, y2 in zip(x1['second_atoms'], y1['second_atoms']):
+                self.assertTrue(np.allclose(x2['displacement'],
+                                            y2['displacement']))
+                for x3, y3 in zip(x2['third_atoms'], y2['third_atoms']):
+                    self.assertTrue(np.allclose(x3['forces'], y3['forces']))
+                    self.assertTrue(np.allclose(y3['delta_forces'],
+                                                y3['forces'] - y2['forces']))
+
+    def test_set_forces(self):
+        dataset = get_displacement_dataset(self._disp_dataset)
+        forces = np.random.randn(dataset.get_number_of_displacements(),
+                                 self._natom, 3)
+        dataset.set_forces(forces)
+        self.assertTrue(
+            (dataset.get_forces(1) == forces[3:15]).all())
+        self.assertRaises(ValueError, dataset.set_forces, forces[1:])
+
+    def test_files(self):
+        dataset = self._dataset
+        for ext in ('npz', 'hdf5'):
+            filename = os.path.join(tempfile.mkdtemp(), 'dataset.' + ext)
+            write_displacement_dataset(dataset, filename=filename)
+            dataset_read = read_displacement_dataset(filename=filename)
+            os.remove(filename)
+            self.assertEqual(dataset_read.get_number_of_atoms(), self._natom)
+            self.assertTrue(dataset_read.get_forces(0) is None)
+            for level in range(3):
+                self.assertTrue((dataset_read.get_numbers(level) ==
+                                 dataset.get_numbers(level)).all())
+                self.assertTrue((dataset_read.get_parents(level) ==
+                                 dataset.get_parents(level)).all())
+                self.assertTrue((dataset_read.get_displacements(level) ==
+                                 dataset.get_displacements(level)).all())
+            self.assertTrue((dataset_read.get_forces(2) ==
+                             dataset.get_forces(2)).all())
+
+if __name__ == '__main__':
+    suite = unittest.TestLoader().loadTestsFromTestCase(
+        TestDisplacementDataset)
+    unittest.TextTestRunner(verbosity=2).run(suite)
+    # unittest.main()
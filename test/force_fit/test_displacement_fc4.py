@@ -0,0 +1,163 @@
+import unittest
+import os
+import tempfile
+import numpy as np
+
+from phonopy.structure.atoms import Atoms
+from phonopy.structure.symmetry import Symmetry
+from phonopy.structure.cells import get_supercell
+from anharmonic.phonon4.displacement_fc4 import (get_fourth_order_displacements,
+                                                 direction_to_displacement,
+                                                 fill_excluded_displacements)
+from anharmonic.phonon4.file_IO import (write_disp_fc4_yaml,
+                                        parse_disp_fc4_yaml)
+from force_fit.smallest_vectors import get_smallest_distances
+
+class TestDisplacementFC4(unittest.TestCase):
+
+    def setUp(self):
+        unitcell = Atoms(numbers=[11, 17],
+                         cell=np.eye(3) * 3.0,
+                         scaled_positions=[[0, 0, 0], [0.5, 0.5, 0.5]])
+        self._cell = get_supercell(unitcell, np.diag([2, 2, 1]))
+        self._symmetry = Symmetry(self._cell, symprec=1e-5)
+
+    def tearDown(self):
+        pass
+
+    def test_cutoff(self):
+        dataset = self._get_dataset(cutoff_pair_distance=2.7,
+                                    cutoff_triplet_distance=2.7)
+        distances = get_smallest_distances(self._cell, 1e-5)
+        for disp1 in dataset['first_atoms']:
+            atom1 = disp1['number']
+            self.assertTrue(disp1['second_atoms'])
+            for disp2 in disp1['second_atoms']:
+                atom2 = disp2['number']
+                self.assertTrue(distances[atom1, atom2] < 2.7)
+                for disp3 in disp2['third_atoms']:
+                    atom3 = disp3['number']
+                    self.assertTrue(distances[atom1, atom3] < 2.7)
+                    self.assertTrue(distances[atom2, atom3] < 2.7)
+
+        dataset = self._get_dataset(max_num_shells=0)
+        for disp1 in dataset['first_atoms']:
+            self.assertEqual(
+                [x['number'] for x in disp1['second_atoms']],
+                [disp1['number']] * len(disp1['second_atoms']))
+
+    def test_fill_excluded_displacements(self):
+        dataset_full = self._get_dataset()
+        dataset = self._get_dataset(cutoff_pair_distance=2.7,
+                                    cutoff_triplet_distance=2.7)
+        self.assertEqual(fill_excluded_displacements(dataset_full,
+                                                     self._cell,
+                                                     self._symmetry), 0)
+        num_added = fill_excluded_displacements(dataset,
+                                                self._cell,
+                                                self._symmetry)
+        self.assertTrue(num_added > 0)
+        for disp1, disp1_full in zip(dataset['first_atoms'],
+                                     dataset_full['first_atoms']):
+            atoms = [x['number'] for x in disp1['second_atoms']]
+            atoms_full = [x['number'] for x in disp1_full['second_atoms']]
+            self.assertEqual(np.unique(atoms).tolist(),
+                             np.unique(atoms_full).tolist())
+            for disp2 in disp1['second_atoms']:
+                self.assertTrue(disp2['third_atoms'])
+                if 'delta_forces' in disp2:
+                    self.assertTrue((disp2['delta_forces'] == 0).all())
+
+    def test_fill_excluded_displacements_structure(self):
+        for is_diagonal in (False, True):
+            dataset_full = self._get_dataset(is_diagonal=is_diagonal)
+            dataset = self._get_dataset(cutoff_pair_distance=2.7,
+                                        cutoff_triplet_distance=2.7,
+                                        is_diagonal=is_diagonal)
+            fill_excluded_displacements(dataset,
+                                        self._cell,
+                                        self._symmetry,
+                                        is_diagonal=is_diagonal)
+            self.assertEqual(self._get_structure(dataset),
+                             self._get_structure(dataset_full))
+
+            # is_diagonal is guessed from the directions in the dataset.
+            dataset = self._get_dataset(cutoff_pair_distance=2.7,
+                                        cutoff_triplet_distance=2.7,
+                                        is_diagonal=is_diagonal)
+            fill_excluded_displacements(dataset, self._cell, self._symmetry)
+            self.assertEqual(self._get_structure(dataset),
+                             self._get_structure(dataset_full))
+
+    def test_disp_fc4_yaml(self):
+        # Settings for fill_excluded_displacements are read back.
+        dataset_full = self._get_dataset(is_diagonal=False)
+        dataset = self._get_dataset(cutoff_pair_distance=2.7,
+                                    cutoff_triplet_distance=2.7,
+                                    is_diagonal=False)
+        dataset['is_diagonal'] = False
+        dataset['cutoff_pair_distance'] = 2.7
+        dataset['cutoff_triplet_distance'] = 2.7
+        fd, filename = tempfile.mkstemp(suffix='.yaml')
+        os.close(fd)
+        try:
+            write_disp_fc4_yaml(dataset, self._cell, filename=filename)
+            dataset_yaml = parse_disp_fc4_yaml(filename=filename)
+        finally:
+            os.remove(filename)
+        self.assertTrue(dataset_yaml['is_diagonal'] is False)
+        self.assertAlmostEqual(dataset_yaml['cutoff_pair_distance'], 2.7)
+        self.assertAlmostEqual(dataset_yaml['cutoff_triplet_distance'], 2.7)
+        self.assertFalse('max_num_shells' in dataset_yaml)
+
+        num_atom = self._cell.get_number_of_atoms()
+        for disp1 in dataset_yaml['first_atoms']:
+            disp1['forces'] = np.zeros((num_atom, 3))
+            for disp2 in disp1['second_atoms']:
+                disp2['forces'] = np.zeros((num_atom, 3))
+        fill_excluded_displacements(dataset_yaml, self._cell, self._symmetry)
+        self.assertEqual(self._get_structure(dataset_yaml),
+                         self._get_structure(dataset_full))
+
+    def _get_structure(self, dataset):
+        structure = []
+        for disp1 in dataset['first_atoms']:
+            second_atoms = []
+            for disp2 in disp1['second_atoms']:
+                third_atoms = sorted(
+                    [(x['number'], self._get_direction(x))
+                     for x in disp2['third_atoms']])
+                second_atoms.append((disp2['number'],
+                                     self._get_direction(disp2),
+                                     third_atoms))
+            structure.append((disp1['number'], sorted(second_atoms)))
+        return structure
+
+    def _get_direction(self, disp):
+        if 'direction' in disp:
+            direction = np.array(disp['direction'], dtype='double')
+        else:
+            direction = np.dot(disp['displacement'],
+                               np.linalg.inv(self._cell.get_cell()))
+        return tuple(np.rint(direction / abs(direction).max() * 1000))
+
+    def _get_dataset(self, **kwargs):
+        dataset = direction_to_displacement(
+            get_fourth_order_displacements(self._cell,
+                                           self._symmetry,
+                                           **kwargs),
+            0.03,
+            self._cell)
+        num_atom = self._cell.get_number_of_atoms()
+        for disp1 in dataset['first_atoms']:
+            disp1['forces'] = np.zeros((num_atom, 3))
+            for disp2 in disp1['second_atoms']:
+                disp2['forces'] = np.zeros((num_atom, 3))
+                for disp3 in disp2['third_atoms']:
+                    disp3['forces'] = np.zeros((num_atom, 3))
+        return dataset
+
+if __name__ == '__main__':
+    suite = unittest.TestLoader().loadTestsFromTestCase(TestDisplacementFC4)
+    unittest.TextTestRunner(verbosity=2).run(suite)
+    # unittest.main()
@@ -0,0 +1,90 @@
+import unittest
+import numpy as np
+
+from phonopy.harmonic.force_constants import (set_permutation_symmetry,
+                                              set_translational_invariance)
+from force_fit.fc2 import FC2Fit
+
+from cells import get_cell_NaCl, get_random_forces
+
+class TestFC2Fit(unittest.TestCase):
+
+    def setUp(self):
+        self._symprec = 1e-5
+        self._set_cell_NaCl()
+
+    def tearDown(self):
+        pass
+
+    def test_kron_solver(self):
+        fc2_pinv = self._run_fc2fit('pinv')
+        fc2_kron = self._run_fc2fit('kron')
+        self.assertTrue(np.abs(fc2_pinv - fc2_kron).max() < 1e-8)
+
+    def test_kron_solver_ill_conditioned(self):
+        fc2fit = FC2Fit(self._cell, self._disp_dataset, self._symmetry)
+        num_atom = self._cell.get_number_of_atoms()
+        disp_mat = np.random.randn(48, 9)
+        disp_mat[:, 0] *= 1e-9
+        force_mat = np.random.randn(num_atom, 48)
+        inv_mat = np.zeros((0, 9 * num_atom + 3), dtype='double')
+        self.assertRaises(np.linalg.LinAlgError,
+                          fc2fit._solve_kron, disp_mat, force_mat, inv_mat)
+
+    def test_sparse_solver(self):
+        fc2fit = FC2Fit(self._cell, self._disp_dataset, self._symmetry)
+        fc2fit.run()
+        fc2 = fc2fit.get_fc2()
+        for i in range(10):
+            set_permutation_symmetry(fc2)
+            set_translational_invariance(fc2)
+        for disp1 in self._disp_dataset['first_atoms']:
+            disp1['forces'] = -np.dot(disp1['displacement'],
+                                      fc2[disp1['number']])
+        fc2_sparse = self._run_fc2fit('sparse', rotational_invariance=False)
+        self.assertTrue(np.abs(fc2 - fc2_sparse).max() < 1e-8)
+
+    def test_matrix_builders(self):
+        fc2fit = FC2Fit(self._cell, self._disp_dataset, self._symmetry)
+        first_atom_num = self._disp_dataset['first_atoms'][0]['number']
+        symmetry_cache = fc2fit._symmetry_cache
+        site_sym_cart = symmetry_cache.get_rotations_cart((first_atom_num,))
+        rot_map_syms = symmetry_cache.get_rot_map_syms((first_atom_num,))
+        disps = [self._disp_dataset['first_atoms'][0]['displacement']]
+        sets_of_forces = [self._disp_dataset['first_atoms'][0]['forces']]
+        self.assertTrue(np.allclose(
+            fc2fit._create_displacement_matrix(disps, site_sym_cart),
+            fc2fit._create_displacement_matrix_loop(disps, site_sym_cart)))
+        self.assertTrue(np.allclose(
+            fc2fit._create_force_matrix(sets_of_forces,
+                                        site_sym_cart,
+                                        rot_map_syms),
+            fc2fit._create_force_matrix_loop(sets_of_forces,
+                                             site_sym_cart,
+                                             rot_map_syms)))
+
+    def _run_fc2fit(self, solver, rotational_invariance=True):
+        fc2fit = FC2Fit(self._cell,
+                        self._disp_dataset,
+                        self._symmetry,
+                        translational_invariance=True,
+                        rotational_invariance=rotational_invariance,
+                        solver=solver)
+        fc2fit.run()
+        return fc2fit.get_fc2()
+
+    def _set_cell_NaCl(self):
+        self._cell, self._symmetry = get_cell_NaCl(symprec=self._symprec)
+        num_atom = self._cell.get_number_of_atoms()
+        np.random.seed(0)
+        first_atoms = []
+        for atom_num in self._symmetry.get_independent_atoms():
+            first_atoms.append({'number': atom_num,
+                                'displacement': [0.03, 0, 0],
+                                'forces': get_random_forces(1, num_atom)[0]})
+        self._disp_dataset = {'natom': num_atom, 'first_atoms': first_atoms}
+
+if __name__ == '__main__':
+    suite = unittest.TestLoader().loadTestsFromTestCase(TestFC2Fit)
+    unittest.TextTestRunner(verbosity=2).run(suite)
+    # unittest.main()
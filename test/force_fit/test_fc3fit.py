@@ -0,0 +1,80 @@
+import unittest
+import numpy as np
+
+from force_fit.fc3 import FC3Fit
+
+from cells import get_cell_NaCl, get_random_forces
+
+class TestFC3Fit(unittest.TestCase):
+
+    def setUp(self):
+        self._cell, self._symmetry = get_cell_NaCl()
+
+    def tearDown(self):
+        pass
+
+    def test_matrix_builders(self):
+        num_atom = self._cell.get_number_of_atoms()
+        fc3fit = FC3Fit(self._cell, {'natom': num_atom, 'first_atoms': []},
+                        self._symmetry)
+        symmetry_cache = fc3fit._symmetry_cache
+        site_syms_cart = symmetry_cache.get_rotations_cart((0,))
+        rot_map_syms = symmetry_cache.get_rot_map_syms((0,))
+
+        np.random.seed(0)
+        disp_pairs = []
+        sets_of_forces = []
+        for i in range(2):
+            u1 = np.random.randn(3)
+            num_disps = np.random.randint(1, 3, size=num_atom)
+            disp_pairs.append([[[u1, np.random.randn(3)] for k in range(n)]
+                               for n in num_disps])
+            sets_of_forces.append([get_random_forces(n, num_atom)
+                                   for n in num_disps])
+
+        for second_atom_num in (0, 1, 5):
+            rot_atom_map = rot_map_syms[:, second_atom_num]
+            self.assertTrue(np.allclose(
+                fc3fit._create_displacement_matrix(disp_pairs,
+                                                   site_syms_cart,
+                                                   rot_atom_map),
+                fc3fit._create_displacement_matrix_loop(disp_pairs,
+                                                        site_syms_cart,
+                                                        rot_atom_map)))
+            self.assertTrue(np.allclose(
+                fc3fit._create_force_matrix(sets_of_forces,
+                                            site_syms_cart,
+                                            rot_atom_map,
+                                            rot_map_syms),
+                fc3fit._create_force_matrix_loop(sets_of_forces,
+                                                 site_syms_cart,
+                                                 rot_atom_map,
+                                                 rot_map_syms)))
+
+    def test_pinv_cutoff(self):
+        num_atom = self._cell.get_number_of_atoms()
+        np.random.seed(0)
+        u, s, vt = np.linalg.svd(np.random.randn(40, 22),
+                                 full_matrices=False)
+        # Badly scaled: np.linalg.pinv would keep all of these.
+        s = 10 ** -(np.arange(22) * 0.5 + 4.25)
+        matrix = np.dot(u * s, vt)
+        for pinv_cutoff in (None, 1e-13, 1e-8):
+            fc3fit = FC3Fit(self._cell,
+                            {'natom': num_atom, 'first_atoms': []},
+                            self._symmetry,
+                            pinv_cutoff=pinv_cutoff)
+            if pinv_cutoff is None:
+                pinv_cutoff = 1e-13
+            # Singular values not larger than pinv_cutoff are dropped
+            # whatever the largest one is.
+            s_inv = np.where(s > pinv_cutoff, 1 / s, 0)
+            inv_matrix_ref = np.dot(vt.T * s_inv, u.T)
+            inv_matrix = fc3fit._invert_displacements([matrix])[0]
+            self.assertTrue(np.abs(inv_matrix - inv_matrix_ref).max() <
+                            1e-6 * np.abs(inv_matrix_ref).max())
+
+if __name__ == '__main__':
+    suite = unittest.TestLoader().loadTestsFromTestCase(TestFC3Fit)
+    unittest.TextTestRunner(verbosity=2).run(suite)
+    # unittest.main()
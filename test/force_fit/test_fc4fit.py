@@ -0,0 +1,57 @@
+import unittest
+import numpy as np
+
+from force_fit.fc4 import FC4Fit
+
+from cells import get_cell_NaCl, get_random_forces
+
+class TestFC4Fit(unittest.TestCase):
+
+    def setUp(self):
+        self._cell, self._symmetry = get_cell_NaCl()
+
+    def tearDown(self):
+        pass
+
+    def test_force_matrix(self):
+        num_atom = self._cell.get_number_of_atoms()
+        fc4fit = FC4Fit(self._cell, {'natom': num_atom, 'first_atoms': []},
+                        self._symmetry)
+        symmetry_cache = fc4fit._symmetry_cache
+        site_syms_cart = symmetry_cache.get_rotations_cart((0,))
+        rot_map_syms = symmetry_cache.get_rot_map_syms((0,))
+
+        np.random.seed(0)
+        sets_of_forces = []
+        for i in range(2):
+            sets_of_forces.append([])
+            for j in range(num_atom):
+                sets_of_forces[i].append(
+                    [get_random_forces(np.random.randint(1, 3), num_atom)
+                     for k in range(num_atom)])
+        force_triplets = fc4fit._create_force_triplets(sets_of_forces)
+        num_triplets = fc4fit._create_displacement_triplets_for_c(
+            sets_of_forces)[1]
+
+        for second_atom_num, third_atom_num in ((0, 0), (1, 4), (5, 7)):
+            force_matrix = fc4fit._create_force_matrix(
+                second_atom_num,
+                third_atom_num,
+                force_triplets,
+                num_triplets,
+                site_syms_cart,
+                rot_map_syms,
+                fourth_atom_nums=np.array([0, 2, 3]))
+            force_matrix_loop = fc4fit._create_force_matrix_loop(
+                second_atom_num,
+                third_atom_num,
+                sets_of_forces,
+                site_syms_cart,
+                rot_map_syms,
+                fourth_atom_nums=np.array([0, 2, 3]))
+            self.assertTrue(np.allclose(force_matrix, force_matrix_loop))
+
+if __name__ == '__main__':
+    suite = unittest.TestLoader().loadTestsFromTestCase(TestFC4Fit)
+    unittest.TextTestRunner(verbosity=2).run(suite)
+    # unittest.main()
@@ -0,0 +1,105 @@
+import unittest
+import numpy as np
+
+from phonopy.structure.atoms import Atoms
+from anharmonic.phonon4 import Phono4py
+from anharmonic.phonon4.frequency_shift import FrequencyShift
+from force_fit.dataset import get_displacement_dataset
+from force_fit.smallest_vectors import get_smallest_distances
+from phonopy.phonon.degeneracy import degenerate_sets
+
+try:
+    import anharmonic._phono4py
+    has_phono4c = True
+except ImportError:
+    has_phono4c = False
+
+class TestFrequencyShift(unittest.TestCase):
+
+    def setUp(self):
+        unitcell = Atoms(numbers=[11, 17],
+                         cell=np.eye(3) * 3.0,
+                         scaled_positions=[[0, 0, 0], [0.5, 0.5, 0.5]])
+        phono4py = Phono4py(unitcell, np.diag([2, 2, 2]))
+        phono4py.generate_displacements(cutoff_pair_distance=3.0,
+                                        cutoff_triplet_distance=2.7)
+        dataset = phono4py.get_displacement_dataset()
+        num_disps = get_displacement_dataset(
+            dataset).get_number_of_displacements()
+        natom = dataset['natom']
+        np.random.seed(0)
+        forces = np.random.randn(num_disps, natom, 3) * 0.01
+        phono4py.produce_fc4(forces, dataset)
+
+        self._fc4 = phono4py.get_fc4()
+        self._supercell = phono4py.get_supercell()
+        self._primitive = phono4py.get_primitive()
+
+        # Nearest neighbour springs
+        distances = get_smallest_distances(self._supercell, 1e-5)
+        self._fc2 = np.zeros((natom, natom, 3, 3), dtype='double')
+        for i in range(natom):
+            for j in range(natom):
+                if 0 < distances[i, j] < 2.7:
+                    self._fc2[i, j] = -np.eye(3)
+            self._fc2[i, i] = -self._fc2[i].sum(axis=0)
+
+    def tearDown(self):
+        pass
+
+    def test_nosym(self):
+        grid_point = 1
+        shifts_nosym, freqs = self._get_frequency_shifts(grid_point, True)
+        shifts_sym, _ = self._get_frequency_shifts(grid_point, False)
+        for dset in degenerate_sets(freqs):
+            self.assertTrue(
+                (abs(shifts_sym[:, dset] -
+                     shifts_nosym[:, dset].mean(axis=1)[:, None])
+                 < 1e-8).all())
+
+        # Only a part of a degenerate set is requested.
+        shifts_part, _ = self._get_frequency_shifts(grid_point, False,
+                                                    band_indices=[1])
+        self.assertTrue((abs(shifts_part[:, 0] - shifts_sym[:, 1])
+                         < 1e-8).all())
+
+    @unittest.skipIf(not has_phono4c, "anharmonic._phono4py is not built.")
+    def test_c(self):
+        # Two-stage Fourier transform and contraction in C
+        grid_point = 1
+        for is_nosym in (True, False):
+            shifts_py, _ = self._get_frequency_shifts(grid_point, is_nosym)
+            shifts_c, _ = self._get_frequency_shifts(grid_point, is_nosym,
+                                                     lang='C')
+            self.assertTrue((abs(shifts_c - shifts_py) < 1e-8).all())
+
+        # Weights of the reduced q' points and a part of a degenerate set
+        shifts_py, _ = self._get_frequency_shifts(grid_point, False,
+                                                  band_indices=[1, 4])
+        shifts_c, _ = self._get_frequency_shifts(grid_point, False,
+                                                 band_indices=[1, 4],
+                                                 lang='C')
+        self.assertTrue((abs(shifts_c - shifts_py) < 1e-8).all())
+
+    def _get_frequency_shifts(self,
+                              grid_point,
+                              is_nosym,
+                              band_indices=None,
+                              lang='Py'):
+        fs = FrequencyShift(self._fc4,
+                            self._supercell,
+                            self._primitive,
+                            [2, 2, 2],
+                            band_indices=band_indices,
+                            temperatures=[0, 300],
+                            is_nosym=is_nosym,
+                            cutoff_frequency=1e-2)
+        fs.set_dynamical_matrix(self._fc2, self._supercell, self._primitive)
+        fs.set_grid_point(grid_point)
+        fs.run(lang=lang)
+        frequencies = fs.get_phonons()[0][grid_point]
+        return fs.get_frequency_shifts().copy(), frequencies
+
+if __name__ == '__main__':
+    suite = unittest.TestLoader().loadTestsFromTestCase(TestFrequencyShift)
+    unittest.TextTestRunner(verbosity=2).run(suite)
@@ -0,0 +1,45 @@
+import unittest
+import numpy as np
+
+from force_fit.parallel import (get_pool, get_shared_file_array,
+                                get_shared_file_copy, open_shared_file_array,
+                                remove_shared_file_array)
+
+def _double(args):
+    source, target, index = args
+    source = open_shared_file_array(source)
+    target = open_shared_file_array(target)
+    target[index] = source[index] * 2
+    return index
+
+class TestParallel(unittest.TestCase):
+
+    def setUp(self):
+        np.random.seed(0)
+        self._array = np.random.randn(4, 3)
+
+    def tearDown(self):
+        pass
+
+    def test_shared_file_array(self):
+        # Arrays made after the workers are forked
+        pool = get_pool(2)
+        try:
+            source, source_descriptor = get_shared_file_copy(self._array)
+            target, target_descriptor = get_shared_file_array(
+                self._array.shape)
+            results = pool.map(_double,
+                               [(source_descriptor, target_descriptor, i)
+                                for i in range(len(self._array))])
+        finally:
+            pool.close()
+            pool.join()
+        self.assertEqual(results, range(len(self._array)))
+        self.assertTrue((target == self._array * 2).all())
+        remove_shared_file_array(source_descriptor)
+        remove_shared_file_array(target_descriptor)
+
+if __name__ == '__main__':
+    suite = unittest.TestLoader().loadTestsFromTestCase(TestParallel)
+    unittest.TextTestRunner(verbosity=2).run(suite)
+    # unittest.main()
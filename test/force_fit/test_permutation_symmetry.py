@@ -0,0 +1,51 @@
+import unittest
+import itertools
+import numpy as np
+
+from force_fit.phonon4.fc4 import set_permutation_symmetry_fc4
+
+try:
+    import anharmonic._phono4py
+    has_phono4c = True
+except ImportError:
+    has_phono4c = False
+
+class TestPermutationSymmetry(unittest.TestCase):
+
+    def setUp(self):
+        np.random.seed(0)
+        self._fc4 = np.random.randn(*((3,) * 4 + (3,) * 4))
+        fc4_sym = np.zeros_like(self._fc4)
+        for perm in itertools.permutations(range(4)):
+            fc4_sym += np.transpose(self._fc4,
+                                    perm + tuple([x + 4 for x in perm]))
+        self._fc4_sym = fc4_sym / 24
+
+    def tearDown(self):
+        pass
+
+    def test_fc4(self):
+        # With anharmonic._phono4py, this runs in C.
+        fc4 = self._fc4.copy()
+        drift = set_permutation_symmetry_fc4(fc4)
+        self.assertTrue(np.abs(fc4 - self._fc4_sym).max() < 1e-12)
+        for i in range(4):
+            drifts = self._fc4_sym.sum(axis=i)
+            self.assertAlmostEqual(
+                drift, drifts.ravel()[np.abs(drifts).argmax()])
+
+    @unittest.skipIf(not has_phono4c, "anharmonic._phono4py is not built.")
+    def test_c(self):
+        import anharmonic._phono4py as phono4c
+        fc4 = self._fc4.copy()
+        drift = phono4c.permutation_symmetry_fc4(fc4)
+        self.assertTrue(np.abs(fc4 - self._fc4_sym).max() < 1e-12)
+        drifts = self._fc4_sym.sum(axis=0)
+        self.assertAlmostEqual(drift,
+                               drifts.ravel()[np.abs(drifts).argmax()])
+
+if __name__ == '__main__':
+    suite = unittest.TestLoader().loadTestsFromTestCase(
+        TestPermutationSymmetry)
+    unittest.TextTestRunner(verbosity=2).run(suite)
+    # unittest.main()
@@ -0,0 +1,47 @@
+import unittest
+import numpy as np
+
+from force_fit.pinv_cache import PinvCache
+
+class TestPinvCache(unittest.TestCase):
+
+    def setUp(self):
+        np.random.seed(0)
+        self._matrix = np.random.randn(12, 4)
+
+    def tearDown(self):
+        pass
+
+    def test_permuted_rows(self):
+        pinv_cache = PinvCache()
+        perm = np.random.permutation(len(self._matrix))
+        pinvs = pinv_cache.get_pinvs([self._matrix, self._matrix[perm]])
+        pinvs.append(pinv_cache.get_pinv(self._matrix[perm[::-1]]))
+        for matrix, pinv in zip(
+            (self._matrix, self._matrix[perm], self._matrix[perm[::-1]]),
+            pinvs):
+            self.assertTrue(np.abs(pinv - np.linalg.pinv(matrix)).max()
+                            < 1e-10)
+        self.assertEqual(pinv_cache.get_number_of_inversions(), 1)
+        self.assertEqual(pinv_cache.get_number_of_avoided_inversions(), 2)
+
+    def test_max_size(self):
+        pinv_cache = PinvCache(max_size=2)
+        matrices = [self._matrix * (i + 1) for i in range(3)]
+        pinv_cache.get_pinv(matrices[0])
+        pinv_cache.get_pinv(matrices[1])
+        pinv_cache.get_pinv(matrices[0])
+        # matrices[1] is the least recently used and is dropped.
+        pinv_cache.get_pinv(matrices[2])
+        pinv_cache.get_pinv(matrices[0])
+        self.assertEqual(pinv_cache.get_number_of_inversions(), 3)
+        pinv_cache.get_pinv(matrices[1])
+        self.assertEqual(pinv_cache.get_number_of_inversions(), 4)
+        pinv_cache.clear()
+        pinv_cache.get_pinv(matrices[1])
+        self.assertEqual(pinv_cache.get_number_of_inversions(), 5)
+
+if __name__ == '__main__':
+    suite = unittest.TestLoader().loadTestsFromTestCase(TestPinvCache)
+    unittest.TextTestRunner(verbosity=2).run(suite)
+    # unittest.main()
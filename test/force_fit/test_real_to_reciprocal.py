@@ -0,0 +1,88 @@
+import unittest
+import numpy as np
+
+from phonopy.structure.atoms import Atoms
+from phonopy.structure.cells import get_supercell, get_primitive
+from anharmonic.phonon4.real_to_reciprocal import RealToReciprocal
+
+try:
+    import anharmonic._phono4py
+    has_phono4c = True
+except ImportError:
+    has_phono4c = False
+
+class TestRealToReciprocal(unittest.TestCase):
+
+    def setUp(self):
+        unitcell = Atoms(numbers=[11, 17],
+                         cell=np.eye(3) * 3.0,
+                         scaled_positions=[[0, 0, 0], [0.5, 0.5, 0.5]])
+        self._supercell = get_supercell(unitcell, np.diag([2, 2, 2]))
+        self._primitive = get_primitive(self._supercell,
+                                        np.diag([0.5, 0.5, 0.5]))
+        num_atom = self._supercell.get_number_of_atoms()
+        np.random.seed(0)
+        self._fc4 = np.random.randn(*((num_atom,) * 4 + (3,) * 4))
+        self._mesh = np.array([4, 4, 4], dtype='intc')
+        self._quartets = np.array(
+            [[[-1, 0, 0], [1, 0, 0], [0, 1, 2], [0, -1, -2]],
+             [[-1, 0, 0], [1, 0, 0], [1, 1, 3], [-1, -1, -3]]],
+            dtype='intc')
+
+    def tearDown(self):
+        pass
+
+    def test_two_stage(self):
+        # The second quartet reuses the first stage of the first one.
+        r2r = RealToReciprocal(self._fc4,
+                               self._supercell,
+                               self._primitive,
+                               self._mesh)
+        for quartet in self._quartets:
+            r2r.run(quartet)
+            self.assertTrue(
+                np.abs(r2r.get_fc4_reciprocal() -
+                       self._get_fc4_reciprocal(r2r, quartet)).max() < 1e-8)
+
+    @unittest.skipIf(not has_phono4c, "anharmonic._phono4py is not built.")
+    def test_c(self):
+        r2r = RealToReciprocal(self._fc4,
+                               self._supercell,
+                               self._primitive,
+                               self._mesh)
+        for quartet in self._quartets:
+            r2r.run(quartet, lang='C')
+            fc4_reciprocal_c = r2r.get_fc4_reciprocal().copy()
+            r2r.run(quartet)
+            self.assertTrue(
+                np.abs(r2r.get_fc4_reciprocal() - fc4_reciprocal_c).max()
+                < 1e-8)
+
+    def _get_fc4_reciprocal(self, r2r, quartet):
+        # Sum over all supercell atoms of the orbits
+        num_patom = self._primitive.get_number_of_atoms()
+        num_satom = self._supercell.get_number_of_atoms()
+        p2s = self._primitive.get_primitive_to_supercell_map()
+        s2p = self._primitive.get_supercell_to_primitive_map()
+        svecs = r2r._smallest_vectors
+        multi = r2r._multiplicity
+        q = quartet / self._mesh.astype('double')
+        fc4_reciprocal = np.zeros((num_patom,) * 4 + (3,) * 4,
+                                  dtype='complex128')
+        for pi in np.ndindex((num_patom,) * 4):
+            for j, k, l in np.ndindex((num_satom,) * 3):
+                if (s2p[j] != p2s[pi[1]] or s2p[k] != p2s[pi[2]] or
+                    s2p[l] != p2s[pi[3]]):
+                    continue
+                phase = 1
+                for i, s in enumerate((j, k, l)):
+                    vs = svecs[s, pi[0], :multi[s, pi[0]]]
+                    phase *= (np.exp(2j * np.pi * np.dot(vs, q[i + 1])).sum()
+                              / multi[s, pi[0]])
+                fc4_reciprocal[pi] += self._fc4[p2s[pi[0]], j, k, l] * phase
+        return fc4_reciprocal
+
+if __name__ == '__main__':
+    suite = unittest.TestLoader().loadTestsFromTestCase(TestRealToReciprocal)
+    unittest.TextTestRunner(verbosity=2).run(suite)
+    # unittest.main()
@@ -0,0 +1,50 @@
+import unittest
+import numpy as np
+
+from phonopy.structure.cells import get_supercell, get_primitive
+from phonopy.harmonic.dynamical_matrix import (
+    get_smallest_vectors as get_smallest_vectors_phonopy)
+from force_fit.smallest_vectors import (get_smallest_vectors,
+                                        get_smallest_distances)
+
+from cells import get_cell_NaCl
+
+class TestSmallestVectors(unittest.TestCase):
+
+    def setUp(self):
+        unitcell, _ = get_cell_NaCl()
+        self._supercell = get_supercell(unitcell, np.diag([2, 2, 1]))
+        self._primitive = get_primitive(self._supercell,
+                                        np.diag([0.5, 0.5, 1]))
+
+    def tearDown(self):
+        pass
+
+    def test_get_smallest_vectors(self):
+        svecs, multi = get_smallest_vectors(self._supercell,
+                                            self._primitive,
+                                            1e-5)
+        svecs_ref, multi_ref = get_smallest_vectors_phonopy(self._supercell,
+                                                            self._primitive,
+                                                            1e-5)
+        self.assertTrue((multi == multi_ref).all())
+        self.assertTrue(multi.max() > 1)
+        self.assertTrue(np.abs(svecs - svecs_ref).max() < 1e-8)
+
+    def test_get_smallest_distances(self):
+        distances = get_smallest_distances(self._supercell, 1e-5)
+        lattice = self._supercell.get_cell()
+        positions = self._supercell.get_scaled_positions()
+        lattice_points = np.array(list(np.ndindex(3, 3, 3))) - 1
+        distances_ref = np.zeros_like(distances)
+        for i, j in np.ndindex(distances.shape):
+            diffs = positions[i] - positions[j] + lattice_points
+            distances_ref[i, j] = np.sqrt(
+                (np.dot(diffs - np.rint(positions[i] - positions[j]),
+                        lattice) ** 2).sum(axis=1)).min()
+        self.assertTrue(np.abs(distances - distances_ref).max() < 1e-8)
+
+if __name__ == '__main__':
+    suite = unittest.TestLoader().loadTestsFromTestCase(TestSmallestVectors)
+    unittest.TextTestRunner(verbosity=2).run(suite)
+    # unittest.main()
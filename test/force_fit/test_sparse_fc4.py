@@ -0,0 +1,40 @@
+import os
+import tempfile
+import unittest
+import numpy as np
+
+from force_fit.sparse_fc4 import (SparseFC4, write_sparse_fc4_to_hdf5,
+                                  read_sparse_fc4_from_hdf5)
+
+class TestSparseFC4(unittest.TestCase):
+
+    def setUp(self):
+        np.random.seed(0)
+        self._fc4 = SparseFC4(4)
+        self._fc4.append(0, 1, 2, [0, 3], np.random.randn(2, 3, 3, 3, 3))
+        self._fc4.append(1, 1, 2, [2], np.random.randn(1, 3, 3, 3, 3))
+
+    def tearDown(self):
+        pass
+
+    def test_to_dense(self):
+        fc4 = self._fc4.to_dense()
+        self.assertEqual(fc4.shape, (4, 4, 4, 4, 3, 3, 3, 3))
+        self.assertTrue((fc4[0, 1, 2, 3] ==
+                         self._fc4.get_block(0, 1, 2, 3)).all())
+        self.assertTrue((fc4[1, 1, 2, 2] ==
+                         self._fc4.get_block(1, 1, 2, 2)).all())
+        self.assertEqual(np.count_nonzero(np.abs(fc4).sum(axis=(4, 5, 6, 7))),
+                         3)
+
+    def test_hdf5(self):
+        filename = os.path.join(tempfile.mkdtemp(), 'fc4.hdf5')
+        write_sparse_fc4_to_hdf5(self._fc4, filename=filename)
+        fc4 = read_sparse_fc4_from_hdf5(filename=filename)
+        os.remove(filename)
+        self.assertTrue((fc4.to_dense() == self._fc4.to_dense()).all())
+
+if __name__ == '__main__':
+    suite = unittest.TestLoader().loadTestsFromTestCase(TestSparseFC4)
+    unittest.TextTestRunner(verbosity=2).run(suite)
+    # unittest.main()
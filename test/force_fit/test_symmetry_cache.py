@@ -0,0 +1,60 @@
+import unittest
+import numpy as np
+
+from phonopy.harmonic.force_constants import get_positions_sent_by_rot_inv
+from anharmonic.phonon3.displacement_fc3 import (get_reduced_site_symmetry,
+                                                 get_bond_symmetry)
+from force_fit.symmetry_cache import SymmetryCache
+
+from cells import get_cell_NaCl
+
+class TestSymmetryCache(unittest.TestCase):
+
+    def setUp(self):
+        self._cell, self._symmetry = get_cell_NaCl()
+
+    def tearDown(self):
+        pass
+
+    def test_reduced_bond_symmetry(self):
+        cache = SymmetryCache(self._cell, self._symmetry)
+        lattice = self._cell.get_cell().T
+        positions = self._cell.get_scaled_positions()
+        disp1 = [0.03, 0, 0]
+        disp2 = [0, 0.03, 0]
+        site_sym = self._symmetry.get_site_symmetry(0)
+        bond_sym = get_bond_symmetry(
+            get_reduced_site_symmetry(site_sym,
+                                      np.dot(np.linalg.inv(lattice), disp1)),
+            positions, 0, 1)
+        bond_sym = get_reduced_site_symmetry(
+            bond_sym, np.dot(np.linalg.inv(lattice), disp2))
+        rot_map_syms = get_positions_sent_by_rot_inv(
+            lattice, positions - positions[1], bond_sym, 1e-5)
+
+        for i in range(2):
+            self.assertTrue(
+                (cache.get_symmetry((0, 1), (disp1, disp2)) ==
+                 bond_sym).all())
+            self.assertTrue(
+                (cache.get_rot_map_syms((0, 1), (disp1, disp2)) ==
+                 rot_map_syms).all())
+        num_misses = cache.get_number_of_misses()
+        cache.get_symmetry((0, 1), (disp1, np.add(disp2, 1e-8)))
+        self.assertEqual(cache.get_number_of_misses(), num_misses)
+        self.assertTrue(cache.get_number_of_hits() > 0)
+
+    def test_statistics(self):
+        cache = SymmetryCache(self._cell, self._symmetry)
+        cache.get_rot_map_syms((0, 1), ([0.03, 0, 0],))
+        self.assertEqual(cache.get_number_of_misses(), 1)
+        self.assertEqual(cache.get_number_of_hits(), 0)
+        cache.get_rotations_cart((0, 1), ([0.03, 0, 0],))
+        cache.get_symmetry((0, 1), ([0.03, 0, 0],))
+        self.assertEqual(cache.get_number_of_misses(), 2)
+        self.assertEqual(cache.get_number_of_hits(), 1)
+
+if __name__ == '__main__':
+    suite = unittest.TestLoader().loadTestsFromTestCase(TestSymmetryCache)
+    unittest.TextTestRunner(verbosity=2).run(suite)
+    # unittest.main()
@@ -0,0 +1,43 @@
+import unittest
+import numpy as np
+
+from force_fit.tensor_rotation import (rotate_second_rank_tensors,
+                                       rotate_third_rank_tensors,
+                                       rotate_fourth_rank_tensors)
+
+class TestTensorRotation(unittest.TestCase):
+
+    def setUp(self):
+        np.random.seed(0)
+        self._rots = np.array([np.linalg.qr(np.random.randn(3, 3))[0]
+                               for i in range(4)])
+
+    def tearDown(self):
+        pass
+
+    def test_second_rank(self):
+        tensors = np.random.randn(4, 3, 3)
+        self.assertTrue(np.allclose(
+            rotate_second_rank_tensors(self._rots, tensors),
+            np.einsum('mai,mbj,mij->mab', self._rots, self._rots, tensors)))
+
+    def test_third_rank(self):
+        tensors = np.random.randn(2, 4, 5, 3, 3, 3)
+        rots = self._rots
+        self.assertTrue(np.allclose(
+            rotate_third_rank_tensors(rots[:, None], tensors),
+            np.einsum('mai,mbj,mck,lmnijk->lmnabc',
+                      rots, rots, rots, tensors)))
+
+    def test_fourth_rank(self):
+        rot = self._rots[0]
+        tensors = np.random.randn(5, 3, 3, 3, 3)
+        self.assertTrue(np.allclose(
+            rotate_fourth_rank_tensors(rot, tensors),
+            np.einsum('ai,bj,ck,dl,mijkl->mabcd',
+                      rot, rot, rot, rot, tensors)))
+
+if __name__ == '__main__':
+    suite = unittest.TestLoader().loadTestsFromTestCase(TestTensorRotation)
+    unittest.TextTestRunner(verbosity=2).run(suite)
+    # unittest.main()